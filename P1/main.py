@@ -1,8 +1,7 @@
 ############### Imports ###############
-import socket
-
 import network
 import uasyncio as asyncio
+from httpserver import HTTPServer, Router, StaticAsset
 from machine import Pin
 
 #######################################
@@ -12,6 +11,15 @@ led = Pin(2, Pin.OUT)
 
 #######################################
 
+########### HTTP Server Setup #########
+HTTP_PORT = 80
+HTTP_MAX_CONNECTIONS = 4
+HTTP_REQUEST_TIMEOUT_MS = 5000
+HTTP_IDLE_TIMEOUT_MS = 5000
+HTTP_PANEL = "panel.html"
+
+#######################################
+
 
 ########### Wi-Fi Connection ##########
 async def connect_wifi():
@@ -38,44 +46,36 @@ async def connect_wifi():
 #######################################
 
 
-########## HTTP Request Handler #######
-async def handle_request(cl):
-    """
-    Handle incoming HTTP requests from a client socket.
+########## HTTP Request Handlers ######
+# Requests are dispatched by path and method (exact paths by a dict
+# lookup), so a new endpoint is just another decorated handler
+router = Router(
+    not_found=(404, "text/html", "<html><body><h1>Unrecognized command</h1></body></html>")
+)
+
 
-    1) Receive up to 1024 bytes of the request.
-    2) Check if the request asks to turn the LED on or off.
-    3) Prepare an HTML response based on the request.
-    4) Send the response, then close the client connection.
+@router.get("/on")
+async def led_on():
     """
-    request = cl.recv(1024)
-    print("Request received:", request)
-
-    response_body = ""
-
-    if b"/on" in request:
-        if led.value() == 1:
-            response_body = "<html><body><h1>The LED was already on</h1></body></html>"
-        else:
-            led.on()
-            response_body = "<html><body><h1>LED turned on</h1></body></html>"
-
-    elif b"/off" in request:
-        if led.value() == 0:
-            response_body = "<html><body><h1>The LED was not on</h1></body></html>"
-        else:
-            led.off()
-            response_body = "<html><body><h1>LED turned off</h1></body></html>"
-
-    else:
-        response_body = "<html><body><h1>Unrecognized command</h1></body></html>"
-
-    response = (
-        "HTTP/1.1 200 OK\r\n" "Content-Type: text/html\r\n" "\r\n" + response_body
-    )
+    Turns the LED on and returns an HTML page describing the result.
+    """
+    print("Request received: /on")
+    if led.value() == 1:
+        return 200, "text/html", "<html><body><h1>The LED was already on</h1></body></html>"
+    led.on()
+    return 200, "text/html", "<html><body><h1>LED turned on</h1></body></html>"
 
-    cl.send(response.encode())
-    cl.close()
+
+@router.get("/off")
+async def led_off():
+    """
+    Turns the LED off and returns an HTML page describing the result.
+    """
+    print("Request received: /off")
+    if led.value() == 0:
+        return 200, "text/html", "<html><body><h1>The LED was not on</h1></body></html>"
+    led.off()
+    return 200, "text/html", "<html><body><h1>LED turned off</h1></body></html>"
 
 
 #######################################
@@ -84,24 +84,30 @@ async def handle_request(cl):
 ########### HTTP Server Setup #########
 async def start_server():
     """
-    Create and start a simple HTTP server on port 80.
-
-    1) Bind to '0.0.0.0' to listen on all available interfaces on port 80.
-    2) Listen for incoming connections.
-    3) Accept clients in an infinite loop and handle each request asynchronously.
+    Create and start the HTTP server on port 80.
+
+    1) Listen on all available interfaces through asyncio.start_server,
+       so waiting for clients never blocks the event loop.
+    2) Serve up to HTTP_MAX_CONNECTIONS clients concurrently, each request
+       within HTTP_REQUEST_TIMEOUT_MS, dispatched by the router.
+    3) Serve the control panel (panel.html) at "/" from a response
+       precompiled at startup (gzip when possible, ETag, 304).
+    4) Keep the task alive while the server runs in the background.
     """
-    addr = socket.getaddrinfo("0.0.0.0", 80)[0][-1]
-    s = socket.socket()
-    s.bind(addr)
-    s.listen(1)
-
-    print("HTTP server listening on:", addr)
+    server = HTTPServer(
+        router.dispatch,
+        port=HTTP_PORT,
+        max_connections=HTTP_MAX_CONNECTIONS,
+        request_timeout_ms=HTTP_REQUEST_TIMEOUT_MS,
+        idle_timeout_ms=HTTP_IDLE_TIMEOUT_MS,
+    )
+    panel = StaticAsset.from_file(HTTP_PANEL, "text/html; charset=utf-8")
+    server.add_static(b"/", panel)
+    server.add_static(b"/panel.html", panel)
+    await server.start()
 
     while True:
-        cl, remote_addr = s.accept()
-        print("Client connected from:", remote_addr)
-
-        await handle_request(cl)
+        await asyncio.sleep(1)
 
 
 #######################################
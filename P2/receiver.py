@@ -3,6 +3,7 @@ from time import sleep, sleep_ms
 
 import uasyncio as asyncio
 from machine import SPI, Pin
+from sensorcodec import SENSOR_V1, SUMMARY_V2, SensorCodec
 from sx127x import SX127x
 
 #######################################
@@ -70,6 +71,9 @@ class LoraReceiverApp:
             parameters=LoraReceiverApp.LORA_PARAMETERS,
         )
 
+        # Register every schema version the senders may use
+        self.codec = SensorCodec(SENSOR_V1, SUMMARY_V2)
+
         self.evt_msg_rx = asyncio.Event()
 
         asyncio.create_task(self.TriggeredLed())
@@ -82,11 +86,23 @@ class LoraReceiverApp:
         """
         Asynchronously check for received LoRa messages:
         1. Continuously poll the LoRa module for new messages.
-        2. When a message is received, print it and trigger the event for LED signaling.
+        2. When a message is received, decode it (sensor readings) or print it
+           as is (text and unknown payloads).
+        3. Trigger the event for LED signaling.
         """
         while True:
             if self.lora.received_packet():
-                print("Payload: {}".format(self.lora.read_payload()))
+                payload = self.lora.read_payload()
+                try:
+                    if self.codec.is_batch(payload):
+                        version, seq, period_ms, readings = self.codec.decode_batch(payload)
+                        for i, reading in enumerate(readings):
+                            print("Reading v{} #{}: {}".format(version, seq + i, reading))
+                    else:
+                        version, reading = self.codec.decode(payload)
+                        print("Reading v{}: {}".format(version, reading))
+                except ValueError:
+                    print("Payload: {}".format(payload))
                 self.evt_msg_rx.set()
             await asyncio.sleep_ms(10)
 
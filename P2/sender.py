@@ -1,8 +1,11 @@
 ############### Imports ###############
 from time import sleep, sleep_ms
 
+import random
+
 import uasyncio as asyncio
 from machine import SPI, Pin
+from sensorcodec import SENSOR_V1
 from sx127x import SX127x
 
 #######################################
@@ -12,6 +15,8 @@ from sx127x import SX127x
 class LoraSenderApp:
     """
     Application to send messages using an SX127x LoRa module when a button is pressed.
+    Readings are sent in the binary sensorcodec layout (5 bytes instead of
+    about 60 as JSON text), so each packet spends as little airtime as possible.
     """
     ###### Protocol Configuration ######
     DEVICE_CONFIG = {
@@ -38,6 +43,8 @@ class LoraSenderApp:
 
     APP_PARAMETERS = {
         "btn_pin": 36,
+        # False sends the plain "Button pressed" text instead of a reading
+        "send_readings": True,
     }
 
     ###############################
@@ -98,17 +105,35 @@ class LoraSenderApp:
         """
         Send a message when triggered by a button press:
         1. Wait for the lock to be released by the button press.
-        2. Send a predefined payload via LoRa.
+        2. Send a sensor reading (or a predefined text) via LoRa.
         """
         while True:
             await self.lock_button_push.acquire()
 
-            payload = "Button pressed"
-            print("Sending packet: \n{}\n".format(payload))
+            if LoraSenderApp.APP_PARAMETERS["send_readings"]:
+                reading = self.generate_data()
+                payload = SENSOR_V1.encode(reading)
+                print("Sending reading {} ({} bytes)".format(reading, len(payload)))
+            else:
+                payload = "Button pressed"
+                print("Sending packet: \n{}\n".format(payload))
             self.lora.println(payload)
     
     ##########################################
 
+    ######## Simulated sensor reading ########
+    def generate_data(self):
+        """
+        Returns a random reading in SENSOR_V1 field order
+        (humidity, status, temperature).
+        """
+        humidity = random.randint(30, 90)
+        temperature = round(random.uniform(15.0, 30.0), 2)
+        status = "OK" if humidity < 70 else "Error"
+        return humidity, status, temperature
+    
+    ##########################################
+
     ########## Start the event loop ##########
     def Loop(self):
         """
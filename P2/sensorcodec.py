@@ -0,0 +1,306 @@
+############### Imports ###############
+try:
+    import ustruct as struct
+except ImportError:
+    import struct
+
+#######################################
+
+######## Integer ranges of the struct codes ########
+_RANGES = {
+    "b": (-128, 127),
+    "B": (0, 255),
+    "h": (-32768, 32767),
+    "H": (0, 65535),
+    "i": (-2147483648, 2147483647),
+    "I": (0, 4294967295),
+}
+
+####################################################
+
+# Batch packets carry the schema version with this bit set, followed by
+# the sample count, the sequence number of the first sample and the
+# sampling period in ms, then the samples without their version byte.
+BATCH_FLAG = 0x80
+_BATCH_HEADER = "<BBII"
+_BATCH_HEADER_SIZE = struct.calcsize(_BATCH_HEADER)
+
+
+########## Sensor Schema ##########
+class SensorSchema:
+    """
+    Binary layout of a sensor reading, shared by the node that encodes it
+    (LoRa sender, MQTT publisher) and the receiver or gateway that
+    decodes it.
+
+    A schema is a version number plus a sequence of fields:
+    - (name, code): integer stored with the struct code (b, B, h, H, i, I)
+    - (name, code, scale): fixed point number, stored as
+      round(value * scale), e.g. ("temperature", "h", 100) keeps two
+      decimals in two bytes
+    - (name, code, (value, ...)): enum, stored as the index of the value
+
+    Packets start with the version byte, so receivers can tell layouts
+    apart and a schema can evolve without breaking deployed nodes
+    (register every version with the receiver's SensorCodec). Evenly
+    spaced samples can also be sent together in one batch packet
+    (encode_batch), which adds a 10 byte header to the samples and
+    drops their version bytes.
+
+    Usage:
+        SENSOR_V1 = SensorSchema(1, (("humidity", "B"),
+                                     ("status", "B", ("OK", "Error")),
+                                     ("temperature", "h", 100)))
+        lora.println(SENSOR_V1.encode((56, "OK", 22.47)))  # 5 bytes
+    """
+
+    def __init__(self, version, fields):
+        """
+        :param version: Schema version (0-127), first byte of every packet
+        :param fields: Field definitions, in wire order
+        """
+        assert 0 <= version < BATCH_FLAG
+        self.version = version
+        self.names = []
+        self.scales = []
+        self.enums = []
+        self.codes = []
+        self.ranges = []
+        fmt = "<"
+        for field in fields:
+            name, code = field[0], field[1]
+            arg = field[2] if len(field) > 2 else None
+            fmt += code
+            self.names.append(name)
+            self.ranges.append(_RANGES[code])
+            if isinstance(arg, (tuple, list)):
+                self.enums.append(tuple(arg))
+                self.codes.append({value: i for i, value in enumerate(arg)})
+                self.scales.append(None)
+            else:
+                self.enums.append(None)
+                self.codes.append(None)
+                self.scales.append(arg)
+        # record_fmt packs the fields only, fmt a whole single packet
+        self.record_fmt = fmt
+        self.record_size = struct.calcsize(fmt)
+        self.fmt = "<B" + fmt[1:]
+        self.size = struct.calcsize(self.fmt)
+        self.buf = bytearray(self.size)
+        self.mv = memoryview(self.buf)
+        self.batch_buf = bytearray(0)
+        self._ints = [0] * len(self.names)
+
+    ###############################
+
+    ###### Encoding ######
+    def _to_ints(self, values):
+        """
+        Converts a reading, given as values in field order, to the stored
+        integers. Raises ValueError for unknown enum values or out of
+        range numbers.
+        """
+        ints = self._ints
+        for k, value in enumerate(values):
+            codes = self.codes[k]
+            if codes is not None:
+                if value not in codes:
+                    raise ValueError("%s: unknown value %r" % (self.names[k], value))
+                n = codes[value]
+            else:
+                scale = self.scales[k]
+                n = int(round(value * scale)) if scale else int(value)
+                low, high = self.ranges[k]
+                if n < low or n > high:
+                    raise ValueError("%s: %r out of range" % (self.names[k], value))
+            ints[k] = n
+        return ints
+
+    def encode(self, values):
+        """
+        Packs one reading, given as values in field order, and returns a
+        memoryview of the internal buffer (valid until the next call).
+        """
+        struct.pack_into(self.fmt, self.buf, 0, self.version, *self._to_ints(values))
+        return self.mv
+
+    def encode_dict(self, reading):
+        """
+        Same as encode() for a reading given as a dict.
+        """
+        return self.encode([reading[name] for name in self.names])
+
+    def encode_batch(self, seq, period_ms, samples):
+        """
+        Packs up to 255 evenly spaced readings into one batch packet and
+        returns a memoryview of the internal batch buffer (grown when
+        needed, valid until the next call).
+
+        :param seq: Sequence number of the first sample
+        :param period_ms: Time between two consecutive samples
+        :param samples: Readings (values in field order), oldest first
+        """
+        count = len(samples)
+        if count > 255:
+            raise ValueError("at most 255 samples per batch")
+        size = _BATCH_HEADER_SIZE + count * self.record_size
+        if len(self.batch_buf) < size:
+            self.batch_buf = bytearray(size)
+        buf = self.batch_buf
+        struct.pack_into(_BATCH_HEADER, buf, 0, self.version | BATCH_FLAG,
+                         count, seq & 0xFFFFFFFF, period_ms)
+        offset = _BATCH_HEADER_SIZE
+        for values in samples:
+            struct.pack_into(self.record_fmt, buf, offset, *self._to_ints(values))
+            offset += self.record_size
+        return memoryview(buf)[:size]
+
+    ######################
+
+    ###### Decoding ######
+    def _reading(self, ints):
+        """
+        Converts the stored integers of one sample back to a dict. Fixed
+        point fields are scaled back to floats; enum codes without a name
+        are returned as integers.
+        """
+        reading = {}
+        for k, name in enumerate(self.names):
+            n = ints[k]
+            enum = self.enums[k]
+            if enum is not None:
+                reading[name] = enum[n] if n < len(enum) else n
+            elif self.scales[k]:
+                reading[name] = n / self.scales[k]
+            else:
+                reading[name] = n
+        return reading
+
+    def decode(self, packet):
+        """
+        Unpacks a single packet of this schema into a dict.
+        """
+        if packet[0] != self.version:
+            raise ValueError("schema version %d, expected %d" % (packet[0], self.version))
+        if len(packet) != self.size:
+            raise ValueError("packet is %d bytes, expected %d" % (len(packet), self.size))
+        return self._reading(struct.unpack_from(self.record_fmt, packet, 1))
+
+    def decode_batch(self, packet):
+        """
+        Unpacks a batch packet of this schema.
+
+        :return: (seq, period_ms, list of reading dicts)
+        """
+        # Truncated packets must fail like any other bad packet, with
+        # ValueError, not with struct.error from unpack_from
+        if len(packet) < _BATCH_HEADER_SIZE:
+            raise ValueError("batch packet is %d bytes, header needs %d"
+                             % (len(packet), _BATCH_HEADER_SIZE))
+        version, count, seq, period_ms = struct.unpack_from(_BATCH_HEADER, packet)
+        if version != self.version | BATCH_FLAG:
+            raise ValueError("not a batch of schema version %d" % self.version)
+        offset = _BATCH_HEADER_SIZE
+        if len(packet) != offset + count * self.record_size:
+            raise ValueError("batch of %d samples is %d bytes" % (count, len(packet)))
+        readings = []
+        for _ in range(count):
+            readings.append(self._reading(struct.unpack_from(self.record_fmt, packet, offset)))
+            offset += self.record_size
+        return seq, period_ms, readings
+
+    ######################
+
+#######################################
+
+
+########## Sensor Codec ##########
+class SensorCodec:
+    """
+    Decodes packets of any registered schema version, for receivers and
+    gateways that hear nodes running different firmware.
+
+    Usage:
+        codec = SensorCodec(SENSOR_V1)
+        if codec.is_batch(packet):
+            version, seq, period_ms, readings = codec.decode_batch(packet)
+        else:
+            version, reading = codec.decode(packet)
+    """
+
+    def __init__(self, *schemas):
+        self.schemas = {}
+        for schema in schemas:
+            self.register(schema)
+
+    def register(self, schema):
+        self.schemas[schema.version] = schema
+
+    def _schema(self, packet):
+        if not packet:
+            raise ValueError("empty packet")
+        version = packet[0] & ~BATCH_FLAG
+        schema = self.schemas.get(version)
+        if schema is None:
+            raise ValueError("unknown schema version %d" % version)
+        return schema
+
+    @staticmethod
+    def is_batch(packet):
+        return len(packet) > 0 and packet[0] & BATCH_FLAG != 0
+
+    def decode(self, packet):
+        """
+        Returns (version, reading dict). Raises ValueError for empty
+        packets, unknown versions and packets of the wrong length.
+        """
+        schema = self._schema(packet)
+        if packet[0] & BATCH_FLAG:
+            raise ValueError("batch packet, use decode_batch()")
+        if len(packet) != schema.size:
+            raise ValueError("packet is %d bytes, schema %d expects %d"
+                             % (len(packet), schema.version, schema.size))
+        return schema.version, schema.decode(packet)
+
+    def decode_batch(self, packet):
+        """
+        Returns (version, seq, period_ms, list of reading dicts) for a
+        batch packet; sample i was taken period_ms * i after sample seq.
+        Raises ValueError like decode(), truncated packets included.
+        """
+        schema = self._schema(packet)
+        return (schema.version,) + schema.decode_batch(packet)
+
+##################################
+
+
+######## Schemas shared by the practice nodes ########
+# humidity %, status, temperature in hundredths of a degree
+SENSOR_V1 = SensorSchema(
+    1,
+    (
+        ("humidity", "B"),
+        ("status", "B", ("OK", "Error")),
+        ("temperature", "h", 100),
+    ),
+)
+
+# Window summary of WindowAggregator (aggregator.py) over humidity and
+# temperature, in the order of WindowAggregator.names
+SUMMARY_V2 = SensorSchema(
+    2,
+    (
+        ("seq", "I"),
+        ("count", "H"),
+        ("humidity_min", "B"),
+        ("humidity_max", "B"),
+        ("humidity_mean", "H", 100),
+        ("humidity_last", "B"),
+        ("temperature_min", "h", 100),
+        ("temperature_max", "h", 100),
+        ("temperature_mean", "h", 100),
+        ("temperature_last", "h", 100),
+    ),
+)
+
+######################################################
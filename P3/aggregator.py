@@ -0,0 +1,143 @@
+############### Imports ###############
+from array import array
+
+#######################################
+
+# Statistics kept per metric, in summary order
+STATS = ("min", "max", "mean", "last")
+
+
+########## Windowed aggregation ##########
+class WindowAggregator:
+    """
+    Reduces a stream of samples to one summary per window of
+    window_samples samples, so the number of messages grows with the
+    number of windows instead of the number of samples.
+
+    For each metric the running min, max, sum and last value live in
+    preallocated array("f") buffers (one slot per metric), so adding a
+    sample allocates nothing. When a window is complete, emit is called
+    with a summary list (reused between windows) in the order of names:
+        seq, count, <metric>_min, <metric>_max, <metric>_mean,
+        <metric>_last, ...
+    where seq is the sequence number of the first sample of the window.
+
+    Report by exception: a metric with a deadband emits the raw sample
+    right away when it moves more than the deadband away from the last
+    value reported for it (by an exception or a window summary), so
+    sudden changes are not held back until the window closes.
+
+    Usage:
+        agg = WindowAggregator(((0, "humidity"), (2, "temperature")),
+                               window_samples=12, emit=send,
+                               deadbands={2: 1.0})
+        agg.add(seq, (humidity, status, temperature))
+    """
+
+    def __init__(self, metrics, window_samples, emit, deadbands=None):
+        """
+        :param metrics: Sequence of (value index, name) to aggregate
+        :param window_samples: Samples per window
+        :param emit: Called as emit("window", seq, summary) at the end of
+                     every window and emit("change", seq, values) for
+                     reports by exception
+        :param deadbands: {value index: deadband} of the metrics to watch
+        """
+        deadbands = deadbands or {}
+        n = len(metrics)
+        self.index = [m[0] for m in metrics]
+        self.names = ["seq", "count"]
+        for _, name in metrics:
+            for stat in STATS:
+                self.names.append("%s_%s" % (name, stat))
+        self.window_samples = window_samples
+        self.emit = emit
+        self.min = array("f", [0.0] * n)
+        self.max = array("f", [0.0] * n)
+        self.sum = array("f", [0.0] * n)
+        self.last = array("f", [0.0] * n)
+        self.reported = array("f", [0.0] * n)
+        # A negative deadband disables report by exception for the metric
+        self.deadband = array("f", [deadbands.get(i, -1.0) for i in self.index])
+        self.watched = any(d >= 0 for d in self.deadband)
+        self.has_reported = False
+        self.count = 0
+        self.first_seq = 0
+        self.summary = [0] * len(self.names)
+        self.windows = 0
+        self.changes = 0
+
+    ##########################################
+
+    ###### Sample input ######
+    def add(self, seq, values):
+        """
+        Adds one sample (values indexed as in metrics) to the current
+        window.
+        """
+        if self.count == 0:
+            self.first_seq = seq
+        for k, i in enumerate(self.index):
+            v = values[i]
+            if self.count == 0:
+                self.min[k] = v
+                self.max[k] = v
+                self.sum[k] = v
+            else:
+                if v < self.min[k]:
+                    self.min[k] = v
+                if v > self.max[k]:
+                    self.max[k] = v
+                self.sum[k] += v
+            self.last[k] = v
+        self.count += 1
+
+        if self.watched and self._exceeds_deadband():
+            self._mark_reported()
+            self.changes += 1
+            self.emit("change", seq, values)
+
+        if self.count >= self.window_samples:
+            self.flush()
+
+    def _exceeds_deadband(self):
+        if not self.has_reported:
+            return True
+        for k, deadband in enumerate(self.deadband):
+            if deadband >= 0 and abs(self.last[k] - self.reported[k]) > deadband:
+                return True
+        return False
+
+    def _mark_reported(self):
+        for k in range(len(self.index)):
+            self.reported[k] = self.last[k]
+        self.has_reported = True
+
+    ##########################
+
+    ###### Window output ######
+    def flush(self):
+        """
+        Emits the summary of the current (possibly partial) window and
+        starts a new one.
+        """
+        if self.count == 0:
+            return
+        summary = self.summary
+        summary[0] = self.first_seq
+        summary[1] = self.count
+        j = 2
+        for k in range(len(self.index)):
+            summary[j] = self.min[k]
+            summary[j + 1] = self.max[k]
+            summary[j + 2] = self.sum[k] / self.count
+            summary[j + 3] = self.last[k]
+            j += 4
+        self.count = 0
+        self.windows += 1
+        self._mark_reported()
+        self.emit("window", summary[0], summary)
+
+    ###########################
+
+##########################################
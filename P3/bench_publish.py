@@ -0,0 +1,59 @@
+############### Imports ###############
+from benchutil import alloc_per_call, time_per_call
+from umqttsimple import MQTTClient
+
+#######################################
+
+#### Benchmark setup ####
+TOPIC = b"notification"
+PAYLOAD_SIZES = (20, 50, 100, 200)
+ITERATIONS = 20000
+ROUNDS = 5
+
+#########################
+
+
+#### Socket stand-in that discards everything ####
+class NullSocket:
+    """
+    Accepts writes without sending them anywhere, so the benchmark only
+    measures the cost of encoding a PUBLISH frame.
+    """
+
+    def write(self, buf, n=None):
+        return len(buf) if n is None else n
+
+
+##################################################
+
+
+#### Main benchmark ####
+def main():
+    """
+    Compares MQTTClient.publish() with a PreparedPublish from
+    MQTTClient.prepare() for typical telemetry payload sizes (QoS 0).
+    """
+    client = MQTTClient(b"bench", "localhost")
+    client.sock = NullSocket()
+    prepared = client.prepare(TOPIC)
+
+    def publish(msg):
+        client.publish(TOPIC, msg)
+
+    print("payload  publish()  prepared  speedup  alloc/msg (publish/prepared)")
+    for size in PAYLOAD_SIZES:
+        msg = b"x" * size
+        plain_us = time_per_call(publish, msg, ITERATIONS, ROUNDS)
+        prepared_us = time_per_call(prepared, msg, ITERATIONS, ROUNDS)
+        plain_alloc = alloc_per_call(publish, msg)
+        allocs = "n/a"
+        if plain_alloc is not None:
+            allocs = "%d B / %d B" % (plain_alloc, alloc_per_call(prepared, msg))
+        print("%5d B  %6.2f us  %6.2f us  %5.2fx  %s" % (
+            size, plain_us, prepared_us, plain_us / prepared_us, allocs))
+
+
+if __name__ == "__main__":
+    main()
+
+########################
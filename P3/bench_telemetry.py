@@ -0,0 +1,60 @@
+############### Imports ###############
+from benchutil import alloc_per_call, time_per_call
+from sensorcodec import SENSOR_V1
+from telemetry import ENUM, FLOAT, INT, TelemetryEncoder
+
+#######################################
+
+#### Benchmark setup ####
+ITERATIONS = 20000
+ROUNDS = 5
+SAMPLE = {"humidity": 56, "status": "OK", "temperature": 22.47}
+VALUES = (56, "OK", 22.47)
+
+#########################
+
+
+#### Encoders under test ####
+encoder = TelemetryEncoder(
+    (
+        ("humidity", INT),
+        ("status", ENUM, ("OK", "Error")),
+        ("temperature", FLOAT, 2),
+    )
+)
+
+
+def str_replace(sample):
+    """
+    The original publisher.py encoding.
+    """
+    return str(sample).replace("'", '"')
+
+
+#############################
+
+
+#### Main benchmark ####
+def main():
+    """
+    Compares bytes per sample and encode time of str(dict).replace()
+    with the precompiled JSON template and the sensorcodec binary layout.
+    """
+    cases = (
+        ("str(dict).replace", str_replace, SAMPLE),
+        ("json template", encoder.json, VALUES),
+        ("sensorcodec v1", SENSOR_V1.encode, VALUES),
+    )
+    print("encoder             bytes  time/sample  alloc/sample")
+    for name, fn, arg in cases:
+        size = len(fn(arg))
+        us = time_per_call(fn, arg, ITERATIONS, ROUNDS)
+        alloc = alloc_per_call(fn, arg)
+        print("%-18s %6d  %8.2f us  %s" % (
+            name, size, us, "n/a" if alloc is None else "%d B" % alloc))
+
+
+if __name__ == "__main__":
+    main()
+
+########################
@@ -0,0 +1,45 @@
+############### Imports ###############
+import gc
+
+from ticks import ticks_diff, ticks_us
+
+#######################################
+
+
+#### Measurement helpers ####
+# Shared by bench_telemetry.py and bench_publish.py; runs on MicroPython
+# and CPython.
+def time_per_call(fn, arg, iterations=20000, rounds=5):
+    """
+    Returns the average time of fn(arg) in microseconds, taking the
+    best of rounds runs to filter out scheduler noise.
+    """
+    best = None
+    for _ in range(rounds):
+        start = ticks_us()
+        for _ in range(iterations):
+            fn(arg)
+        elapsed = ticks_diff(ticks_us(), start)
+        if best is None or elapsed < best:
+            best = elapsed
+    return best / iterations
+
+
+def alloc_per_call(fn, arg):
+    """
+    Returns the heap bytes allocated per fn(arg) call. Only available on
+    MicroPython (gc.mem_alloc); returns None elsewhere.
+    """
+    if not hasattr(gc, "mem_alloc"):
+        return None
+    gc.collect()
+    gc.disable()
+    start = gc.mem_alloc()
+    for _ in range(100):
+        fn(arg)
+    used = gc.mem_alloc() - start
+    gc.enable()
+    return used / 100
+
+
+#############################
@@ -1,10 +1,13 @@
 ############### Imports ###############
 import random
-import time
 
 import machine
 import network
 import ubinascii
+from aggregator import WindowAggregator
+from scheduler import BatchReporter, FixedRateScheduler
+from sensorcodec import SENSOR_V1, SUMMARY_V2
+from telemetry import ENUM, FLOAT, INT, TelemetryEncoder
 from umqttsimple import MQTTClient
 
 #######################################
@@ -24,6 +27,52 @@ topic_pub = b"notification"
 
 ##################
 
+#### Payload encoding ####
+# "json" for readable payloads, "binary" for the 5 byte sensorcodec
+# layout (decode with sensorcodec.SensorCodec(SENSOR_V1))
+payload_format = "json"
+encoder = TelemetryEncoder(
+    (
+        ("humidity", INT),
+        ("status", ENUM, ("OK", "Error")),
+        ("temperature", FLOAT, 2),
+    )
+)
+
+##########################
+
+#### Reporting mode ####
+# "summary": one min/max/mean/last summary per window of window_samples
+#            samples, plus single samples reported by exception
+# "batch":   every sample, in batches (see Sampling and reporting)
+report_mode = "summary"
+window_samples = 12
+# Metrics summarised per window (value index in generate_data(), name)
+metrics = ((0, "humidity"), (2, "temperature"))
+# A sample is reported right away when a metric moved more than its
+# deadband away from the last reported value
+deadbands = {0: 15, 2: 5.0}
+
+summary_encoder = TelemetryEncoder(
+    [("seq", INT), ("count", INT)]
+    + [("%s_%s" % (name, stat), FLOAT, 2)
+       for _, name in metrics for stat in ("min", "max", "mean", "last")]
+)
+
+########################
+
+#### Sampling and reporting ####
+sample_period_ms = 5000
+# A batch is published after batch_samples samples or once its oldest
+# sample is batch_age_ms old, whichever comes first
+batch_samples = 12
+batch_age_ms = 60000
+# Publish early when a value leaves or re-enters its band
+# (value index in generate_data(): (low, high), None = unbounded)
+thresholds = {0: (None, 70), 2: (None, 28.0)}
+
+################################
+
 #### Connect to Wi-Fi ####
 station = network.WLAN(network.STA_IF)
 station.active(True)
@@ -39,11 +88,12 @@ print(station.ifconfig())
 
 
 #### Function to generate random data ####
+# Returns the values in the encoder's field order
 def generate_data():
     humidity = random.randint(30, 90)
     temperature = round(random.uniform(15.0, 30.0), 2)
     status = "OK" if humidity < 70 else "Error"
-    return {"humidity": humidity, "status": status, "temperature": temperature}
+    return humidity, status, temperature
 
 
 #######################################
@@ -63,12 +113,32 @@ def connect_mqtt():
 #### Main loop to publish data ####
 def main():
     client = connect_mqtt()
+    publish = client.prepare(topic_pub)
+
+    def send(seq, samples):
+        if payload_format == "binary":
+            publish(SENSOR_V1.encode_batch(seq, sample_period_ms, samples))
+        else:
+            publish(encoder.json_batch(seq, sample_period_ms, samples))
+        print(f"Published {len(samples)} samples from #{seq}, last: {samples[-1]}")
+
+    def send_report(kind, seq, values):
+        binary = payload_format == "binary"
+        if kind == "window":
+            publish(SUMMARY_V2.encode(values) if binary else summary_encoder.json(values))
+            print(f"Published summary of {values[1]} samples from #{seq}")
+        else:
+            publish(SENSOR_V1.encode(values) if binary else encoder.json(values))
+            print(f"Published change #{seq}: {values}")
+
+    if report_mode == "summary":
+        reporter = WindowAggregator(metrics, window_samples, send_report, deadbands)
+    else:
+        reporter = BatchReporter(send, batch_samples, batch_age_ms, thresholds)
+    scheduler = FixedRateScheduler(sample_period_ms)
     while True:
-        data = generate_data()
-        msg = str(data).replace("'", '"')
-        client.publish(topic_pub, msg)
-        print(f"Published: {msg}")
-        time.sleep(5)
+        seq = scheduler.wait()
+        reporter.add(seq, generate_data())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,138 @@
+############### Imports ###############
+from ticks import sleep_ms, ticks_add, ticks_diff, ticks_ms
+
+#######################################
+
+
+########## Fixed-rate scheduler ##########
+class FixedRateScheduler:
+    """
+    Wakes up on absolute deadlines start + n * period_ms, so the time
+    spent sampling, encoding and publishing does not accumulate as drift
+    (sleep(period) after the work would stretch every period by it).
+
+    When the caller falls more than a whole period behind (e.g. a slow
+    reconnect), the missed deadlines are skipped and counted instead of
+    being replayed in a burst; the returned sequence numbers still count
+    them, so gaps are visible to the receiver.
+
+    Usage:
+        scheduler = FixedRateScheduler(5000)
+        while True:
+            seq = scheduler.wait()
+            sample(seq)
+    """
+
+    def __init__(self, period_ms, sleep=sleep_ms):
+        """
+        :param period_ms: Sampling period
+        :param sleep: Function sleeping for a number of ms; pass e.g.
+                      machine.lightsleep to save power between samples
+        """
+        self.period_ms = period_ms
+        self.sleep = sleep
+        self.deadline = ticks_ms()
+        self.seq = 0
+        self.missed = 0
+
+    def wait(self):
+        """
+        Sleeps until the next deadline and returns its sequence number.
+        """
+        late = ticks_diff(ticks_ms(), self.deadline)
+        if late < 0:
+            self.sleep(-late)
+        elif late >= self.period_ms:
+            skip = late // self.period_ms
+            self.deadline = ticks_add(self.deadline, skip * self.period_ms)
+            self.seq += skip
+            self.missed += skip
+        seq = self.seq
+        self.seq += 1
+        self.deadline = ticks_add(self.deadline, self.period_ms)
+        return seq
+
+##########################################
+
+
+########## Batched reporting ##########
+class BatchReporter:
+    """
+    Buffers samples taken on a fixed grid and hands them to send() as one
+    batch when max_samples are buffered, when the oldest buffered sample
+    is max_age_ms old, or as soon as a watched value crosses its
+    threshold (so alarms are not delayed by batching).
+
+    Batches only hold consecutive sequence numbers: a gap (skipped
+    deadlines) flushes the samples buffered before it, so every batch is
+    fully described by its first sequence number and the period.
+
+    Usage:
+        reporter = BatchReporter(send, max_samples=12,
+                                 thresholds={2: (None, 28.0)})
+        reporter.add(seq, (humidity, status, temperature))
+    """
+
+    def __init__(self, send, max_samples=12, max_age_ms=60000, thresholds=None):
+        """
+        :param send: Called as send(first_seq, samples) for each batch
+        :param max_samples: Samples per batch
+        :param max_age_ms: Maximum time a sample waits in the buffer
+        :param thresholds: {value index: (low, high)}; a batch is sent
+                           early when a value leaves or re-enters its
+                           band. Either bound may be None.
+        """
+        self.send = send
+        self.max_samples = max_samples
+        self.max_age_ms = max_age_ms
+        self.thresholds = thresholds or {}
+        self.samples = []
+        self.first_seq = 0
+        self.first_ms = 0
+        self.outside = {}
+        self.batches = 0
+        self.early = 0
+
+    def _crossed(self, values):
+        """
+        Returns True when a watched value changed sides of its threshold
+        band since the previous sample (values start inside their band).
+        """
+        crossed = False
+        for k, (low, high) in self.thresholds.items():
+            value = values[k]
+            outside = (low is not None and value < low) or (high is not None and value > high)
+            if outside != self.outside.get(k, False):
+                self.outside[k] = outside
+                crossed = True
+        return crossed
+
+    def add(self, seq, values):
+        """
+        Buffers one sample and sends the batch if it is due.
+        """
+        if self.samples and seq != self.first_seq + len(self.samples):
+            self.flush()
+        if not self.samples:
+            self.first_seq = seq
+            self.first_ms = ticks_ms()
+        self.samples.append(values)
+        if self._crossed(values):
+            self.early += 1
+            self.flush()
+        elif (len(self.samples) >= self.max_samples
+              or ticks_diff(ticks_ms(), self.first_ms) >= self.max_age_ms):
+            self.flush()
+
+    def flush(self):
+        """
+        Sends the buffered samples, if any.
+        """
+        if not self.samples:
+            return
+        samples = self.samples
+        self.samples = []
+        self.batches += 1
+        self.send(self.first_seq, samples)
+
+#######################################
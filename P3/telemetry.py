@@ -0,0 +1,157 @@
+######## Field kinds ########
+INT = "int"
+FLOAT = "float"  # argument: number of decimals
+ENUM = "enum"  # argument: tuple of allowed string values
+
+#############################
+
+
+#### Number formatting without intermediate strings ####
+def _put_uint(buf, i, n, width=0):
+    """
+    Writes the decimal digits of n >= 0 into buf at i, zero-padded to
+    width digits. Returns the index after the last digit.
+    """
+    d = 1
+    p = 10
+    while p <= n:
+        d += 1
+        p *= 10
+    if d < width:
+        d = width
+    end = i + d
+    while d:
+        d -= 1
+        buf[i + d] = 48 + n % 10
+        n //= 10
+    return end
+
+
+def _put_number(buf, i, value, decimals):
+    """
+    Writes value as a JSON number with a fixed number of decimals.
+    """
+    if decimals:
+        scale = 10 ** decimals
+        n = int(round(value * scale))
+    else:
+        n = int(value)
+    if n < 0:
+        buf[i] = 45  # "-"
+        i += 1
+        n = -n
+    if not decimals:
+        return _put_uint(buf, i, n)
+    i = _put_uint(buf, i, n // scale)
+    buf[i] = 46  # "."
+    return _put_uint(buf, i + 1, n % scale, decimals)
+
+
+def _json_string(s):
+    return b'"' + s.replace("\\", "\\\\").replace('"', '\\"').encode() + b'"'
+
+
+########################################################
+
+
+########## Telemetry Encoder ##########
+class TelemetryEncoder:
+    """
+    Encodes samples of a fixed schema without building per-sample
+    dicts or strings.
+
+    The schema is a sequence of (name, kind[, arg]) fields. At
+    construction the JSON text between values is precompiled into byte
+    fragments and enum values are pre-encoded (quoted and escaped), so
+    encoding a sample only copies fragments and writes digits into one
+    reusable buffer. For the compact binary layout see sensorcodec.py.
+
+    json() and json_batch() take the values in field order and return a
+    memoryview of an internal buffer, valid until the next call.
+
+    Usage:
+        enc = TelemetryEncoder((("humidity", INT),
+                                ("status", ENUM, ("OK", "Error")),
+                                ("temperature", FLOAT, 2)))
+        client.publish(topic, enc.json((56, "OK", 22.5)))
+    """
+
+    def __init__(self, fields):
+        self.fields = []
+        size = 2
+        sep = b"{"
+        for field in fields:
+            name, kind = field[0], field[1]
+            arg = field[2] if len(field) > 2 else 0
+            prefix = sep + _json_string(name) + b":"
+            sep = b","
+            if kind == ENUM:
+                codes = {}
+                for value in arg:
+                    codes[value] = _json_string(value)
+                width = max(len(v) for v in codes.values())
+            else:
+                codes = None
+                width = 24
+            self.fields.append((prefix, kind, arg, codes))
+            size += len(prefix) + width
+        self.sample_size = size
+        self.buf = bytearray(size)
+        self.mv = memoryview(self.buf)
+        self.batch_buf = bytearray(0)
+
+    ###### JSON ######
+    def _write(self, buf, i, values):
+        """
+        Writes one sample object into buf at i and returns the index
+        after its closing brace.
+        """
+        for k, (prefix, kind, arg, codes) in enumerate(self.fields):
+            n = len(prefix)
+            buf[i:i + n] = prefix
+            i += n
+            value = values[k]
+            if codes is not None:
+                text = codes[value]
+                n = len(text)
+                buf[i:i + n] = text
+                i += n
+            else:
+                i = _put_number(buf, i, value, arg if kind == FLOAT else 0)
+        buf[i] = 125  # "}"
+        return i + 1
+
+    def json(self, values):
+        """
+        Encodes one sample as compact JSON, e.g.
+        {"humidity":56,"status":"OK","temperature":22.50}
+        """
+        return self.mv[:self._write(self.buf, 0, values)]
+
+    def json_batch(self, seq, period_ms, samples):
+        """
+        Encodes evenly spaced samples as one JSON object, e.g.
+        {"seq":40,"period_ms":5000,"samples":[{...},{...}]}
+        where samples[i] was taken period_ms * i after sample seq.
+        """
+        size = 64 + len(samples) * (self.sample_size + 1)
+        if len(self.batch_buf) < size:
+            self.batch_buf = bytearray(size)
+        buf = self.batch_buf
+        buf[0:7] = b'{"seq":'
+        i = _put_uint(buf, 7, seq)
+        buf[i:i + 13] = b',"period_ms":'
+        i = _put_uint(buf, i + 13, period_ms)
+        buf[i:i + 12] = b',"samples":['
+        i += 12
+        for k, values in enumerate(samples):
+            if k:
+                buf[i] = 44  # ","
+                i += 1
+            i = self._write(buf, i, values)
+        buf[i:i + 2] = b"]}"
+        return memoryview(buf)[:i + 2]
+
+    ##################
+
+#######################################
@@ -0,0 +1,23 @@
+# time.ticks_*() and sleep_ms() exist on MicroPython only. The modules of
+# this directory that also run on a PC (tests, benchmarks) import them
+# from here instead of each carrying its own CPython fallback. Every
+# session directory has this same file, as each is flashed on its own.
+try:
+    from time import sleep_ms, ticks_add, ticks_diff, ticks_ms, ticks_us
+except ImportError:
+    from time import monotonic, perf_counter, sleep
+
+    def ticks_ms():
+        return int(monotonic() * 1000)
+
+    def ticks_us():
+        return int(perf_counter() * 1000000)
+
+    def ticks_add(a, b):
+        return a + b
+
+    def ticks_diff(a, b):
+        return a - b
+
+    def sleep_ms(ms):
+        sleep(ms / 1000)
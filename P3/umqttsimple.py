@@ -3,27 +3,200 @@ try:
 except:
     import socket
 
-import ustruct as struct
-from ubinascii import hexlify
+try:
+    import ustruct as struct
+    from ubinascii import hexlify
+except ImportError:
+    import struct
+    from binascii import hexlify
+
+from ticks import ticks_diff, ticks_ms
 
 
 class MQTTException(Exception):
     pass
 
+# CPython sockets have no stream read/write methods. This wrapper
+# provides the subset MQTTClient uses, so the client also runs on a PC
+# (e.g. against tools/mqttbroker.py).
+class _StreamSocket:
+
+    def __init__(self, sock, again=(BlockingIOError,)):
+        self.sock = sock
+        # Exceptions meaning "no data yet" on a non-blocking socket
+        self.again = again
+
+    def write(self, buf, n=None):
+        if n is not None:
+            buf = memoryview(buf)[:n]
+        self.sock.sendall(buf)
+
+    def readinto(self, buf):
+        try:
+            return self.sock.recv_into(buf)
+        except self.again:
+            return None
+
+    def setblocking(self, flag):
+        self.sock.setblocking(flag)
+
+    def settimeout(self, t):
+        self.sock.settimeout(t)
+
+    def close(self):
+        self.sock.close()
+
+_ssl = None
+
+# ssl_params keys MQTTClient can apply to an SSLContext. Other keys were
+# only ever passed through to ssl.wrap_socket() and are refused instead
+# of being dropped.
+_SSL_PARAMS = ("cert_reqs", "cadata", "cert", "key", "server_hostname")
+
+# Checked when the client is created, so a bad configuration fails there
+# and not on the first connect inside a background task. "cert" and "key"
+# come as a pair: MicroPython's load_cert_chain() needs both.
+def _check_ssl_params(p):
+    unknown = [k for k in p if k not in _SSL_PARAMS]
+    if unknown:
+        raise ValueError("unsupported ssl_params: %s" % ", ".join(sorted(unknown)))
+    if ("cert" in p) != ("key" in p):
+        raise ValueError("ssl_params: 'cert' and 'key' must be given together")
+
+# Imports the TLS module on first use only, so clients without TLS never
+# pay for (or need) it.
+def _ssl_module():
+    global _ssl
+    if _ssl is None:
+        try:
+            import ssl
+        except ImportError:
+            import ussl as ssl
+        _ssl = ssl
+    return _ssl
+
+# Width of the integer-valued MQTT 5 properties, keyed by identifier.
+# Every other property is a length-prefixed string/binary, except
+# 0x0B (variable byte integer) and 0x26 (string pair).
+_PROP_INT = {0x01: 1, 0x02: 4, 0x11: 4, 0x13: 2, 0x17: 1, 0x18: 4, 0x19: 1,
+             0x21: 2, 0x22: 2, 0x23: 2, 0x24: 1, 0x25: 1, 0x27: 4,
+             0x28: 1, 0x29: 1, 0x2a: 1}
+
+def _decode_varint(buf, i):
+    n = 0
+    sh = 0
+    while 1:
+        b = buf[i]
+        i += 1
+        n |= (b & 0x7f) << sh
+        if not b & 0x80:
+            return n, i
+        sh += 7
+
+# Parses an MQTT 5 property block starting at buf[i]. Returns the
+# integer-valued properties as a dict and the index after the block.
+def _parse_props(buf, i):
+    n, i = _decode_varint(buf, i)
+    end = i + n
+    props = {}
+    while i < end:
+        pid = buf[i]
+        i += 1
+        w = _PROP_INT.get(pid)
+        if w:
+            v = 0
+            for k in range(w):
+                v = v << 8 | buf[i + k]
+            props[pid] = v
+            i += w
+        elif pid == 0x0b:
+            props[pid], i = _decode_varint(buf, i)
+        elif pid == 0x26:
+            i += 2 + (buf[i] << 8 | buf[i + 1])
+            i += 2 + (buf[i] << 8 | buf[i + 1])
+        else:
+            i += 2 + (buf[i] << 8 | buf[i + 1])
+    return props, end
+
+# Routes messages to handlers registered under MQTT topic filters.
+# Filters are compiled into a trie with one node per topic level, so
+# dispatch cost depends on topic depth, not on the number of filters.
+# A node is [children, handlers]; "+" and "#" are ordinary child keys.
+class TopicRouter:
+
+    def __init__(self):
+        self.root = [{}, []]
+        self.count = 0
+
+    def add(self, topic_filter, f):
+        levels = topic_filter.split(b"/")
+        node = self.root
+        for i, level in enumerate(levels):
+            assert level == b"#" and i == len(levels) - 1 or b"#" not in level
+            assert level == b"+" or b"+" not in level
+            node = node[0].setdefault(level, [{}, []])
+        node[1].append(f)
+        self.count += 1
+
+    # Calls every handler whose filter matches topic; returns how many.
+    def dispatch(self, topic, msg):
+        levels = bytes(topic).split(b"/")
+        return self._dispatch(self.root, levels, 0, topic, msg)
+
+    def _dispatch(self, node, levels, i, topic, msg):
+        n = 0
+        children = node[0]
+        # Wildcards never match topics starting with "$" at the first level
+        wild = i or not levels[0].startswith(b"$")
+        if wild and b"#" in children:
+            for f in children[b"#"][1]:
+                f(topic, msg)
+                n += 1
+        if i == len(levels):
+            for f in node[1]:
+                f(topic, msg)
+                n += 1
+            return n
+        child = children.get(levels[i])
+        if child:
+            n += self._dispatch(child, levels, i + 1, topic, msg)
+        if wild and b"+" in children:
+            n += self._dispatch(children[b"+"], levels, i + 1, topic, msg)
+        return n
+
 class MQTTClient:
 
+    # MQTT 5 only: seconds the broker keeps a session (clean_session=False)
+    # after the connection is gone.
+    SESSION_EXPIRY = 3600
+
+    # ssl: False, True, or a prepared SSLContext to wrap connections with.
+    # socket_timeout: seconds a socket operation may block before it fails
+    # with OSError (None blocks forever). Callers running in an event loop
+    # (see MQTTSupervisor) set it so a stalled broker cannot freeze them.
     def __init__(self, client_id, server, port=0, user=None, password=None, keepalive=0,
-                 ssl=False, ssl_params={}):
+                 ssl=False, ssl_params={}, version=4, rbuf_size=512, socket_timeout=None):
         if port == 0:
             port = 8883 if ssl else 1883
+        assert version in (4, 5)
+        _check_ssl_params(ssl_params)
         self.client_id = client_id
         self.sock = None
+        self._tcp = None
+        self.socket_timeout = socket_timeout
         self.server = server
         self.port = port
         self.ssl = ssl
         self.ssl_params = ssl_params
+        self.ssl_ctx = None if ssl is True else ssl or None
+        self.ssl_session = None
+        self.tls_handshake_ms = -1
+        self.tls_resumed = False
+        self.version = version
         self.pid = 0
         self.cb = None
+        self.cb_copy = False
+        self.router = TopicRouter()
         self.user = user
         self.pswd = password
         self.keepalive = keepalive
@@ -31,23 +204,86 @@ class MQTTClient:
         self.lw_msg = None
         self.lw_qos = 0
         self.lw_retain = False
+        self.last_tx = 0
+        self.last_rx = 0
+        self.ping_sent = 0
+        self.ping_outstanding = False
+        self.rtt_ms = -1
+        # Limits announced by an MQTT 5 broker in CONNACK
+        self.topic_alias_max = 0
+        self.receive_max = 65535
+        self.topic_aliases = {}
+        # Inbound data is read in large chunks into one reusable buffer
+        # and frames are parsed in place; _rpos/_rend delimit unread data.
+        self._rbuf = bytearray(rbuf_size)
+        self._rmv = memoryview(self._rbuf)
+        self._rpos = 0
+        self._rend = 0
+
+    def _next_pid(self):
+        self.pid = self.pid % 65535 + 1
+        return self.pid
 
     def _send_str(self, s):
         self.sock.write(struct.pack("!H", len(s)))
         self.sock.write(s)
 
+    # Makes sure at least n unread bytes are in the receive buffer,
+    # growing it if a single frame does not fit.
+    def _fill(self, n):
+        avail = self._rend - self._rpos
+        if avail >= n:
+            return
+        if not avail:
+            self._rpos = self._rend = 0
+        elif self._rpos + n > len(self._rbuf):
+            self._rbuf[:avail] = self._rbuf[self._rpos:self._rend]
+            self._rpos = 0
+            self._rend = avail
+        if n > len(self._rbuf):
+            buf = bytearray(n)
+            buf[:avail] = self._rbuf[self._rpos:self._rend]
+            self._rbuf = buf
+            self._rmv = memoryview(buf)
+            self._rpos = 0
+            self._rend = avail
+        while self._rend - self._rpos < n:
+            r = self.sock.readinto(self._rmv[self._rend:])
+            if not r:
+                raise OSError(-1)
+            self._rend += r
+            self.last_rx = ticks_ms()
+
+    def _read_byte(self):
+        self._fill(1)
+        self._rpos += 1
+        return self._rbuf[self._rpos - 1]
+
+    # Returns a view of the next n bytes; only valid until the next read.
+    def _read(self, n):
+        self._fill(n)
+        i = self._rpos
+        self._rpos = i + n
+        return self._rmv[i:i + n]
+
     def _recv_len(self):
         n = 0
         sh = 0
         while 1:
-            b = self.sock.read(1)[0]
+            b = self._read_byte()
             n |= (b & 0x7f) << sh
             if not b & 0x80:
                 return n
             sh += 7
 
-    def set_callback(self, f):
+    # Global callback for messages that no per-subscription handler
+    # (see .subscribe()) matched. Callback and handlers get memoryviews
+    # of topic and payload that point into the receive buffer: they are
+    # only valid until the call returns (or calls back into the client).
+    # Pass copy=True to get bytes instead.
+    def set_callback(self, f, copy=False):
         self.cb = f
+        self.cb_copy = copy
 
     def set_last_will(self, topic, msg, retain=False, qos=0):
         assert 0 <= qos <= 2
@@ -57,17 +293,51 @@ class MQTTClient:
         self.lw_qos = qos
         self.lw_retain = retain
 
+    # Connects with the configured protocol version. If an MQTT 5
+    # connection is refused as unsupported (3.1.1 brokers answer with
+    # return code 1 or just close the socket), retries once with 3.1.1.
+    # A timeout or any other socket error is raised as is and leaves the
+    # version alone, so the caller's next attempt asks for MQTT 5 again.
     def connect(self, clean_session=True):
-        self.sock = socket.socket()
+        try:
+            return self._connect(clean_session)
+        except MQTTException as e:
+            if self.version != 5 or e.args[0] not in (1, 0x84):
+                raise
+        self.sock.close()
+        self.version = 4
+        return self._connect(clean_session)
+
+    def _connect(self, clean_session):
+        self.sock = self._tcp = socket.socket()
+        if self.socket_timeout is not None:
+            self.sock.settimeout(self.socket_timeout)
         addr = socket.getaddrinfo(self.server, self.port)[0][-1]
         self.sock.connect(addr)
+        # A publish is several small writes; with Nagle enabled the
+        # later ones wait for the broker's delayed ACK (~40 ms).
+        if hasattr(socket, "TCP_NODELAY"):
+            try:
+                self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except OSError:
+                pass
+        again = (BlockingIOError,)
         if self.ssl:
-            import ussl
-            self.sock = ussl.wrap_socket(self.sock, **self.ssl_params)
+            self._wrap_tls()
+            again += (getattr(_ssl, "SSLWantReadError", BlockingIOError),)
+        if not hasattr(self.sock, "readinto"):
+            self.sock = _StreamSocket(self.sock, again)
+        self._rpos = self._rend = 0
         premsg = bytearray(b"\x10\0\0\0\0\0")
         msg = bytearray(b"\x04MQTT\x04\x02\0\0")
+        msg[5] = self.version
+        props = b""
+        if self.version == 5 and not clean_session:
+            props = struct.pack("!BI", 0x11, self.SESSION_EXPIRY)
 
         sz = 10 + 2 + len(self.client_id)
+        if self.version == 5:
+            sz += 1 + len(props)
         msg[6] = clean_session << 1
         if self.user is not None:
             sz += 2 + len(self.user) + 2 + len(self.pswd)
@@ -78,6 +348,8 @@ class MQTTClient:
             msg[8] |= self.keepalive & 0x00FF
         if self.lw_topic:
             sz += 2 + len(self.lw_topic) + 2 + len(self.lw_msg)
+            if self.version == 5:
+                sz += 1
             msg[6] |= 0x4 | (self.lw_qos & 0x1) << 3 | (self.lw_qos & 0x2) << 3
             msg[6] |= self.lw_retain << 5
 
@@ -90,19 +362,82 @@ class MQTTClient:
 
         self.sock.write(premsg, i + 2)
         self.sock.write(msg)
+        if self.version == 5:
+            self.sock.write(bytes((len(props),)))
+            self.sock.write(props)
         #print(hex(len(msg)), hexlify(msg, ":"))
         self._send_str(self.client_id)
         if self.lw_topic:
+            if self.version == 5:
+                self.sock.write(b"\0")
             self._send_str(self.lw_topic)
             self._send_str(self.lw_msg)
         if self.user is not None:
             self._send_str(self.user)
             self._send_str(self.pswd)
-        resp = self.sock.read(4)
-        assert resp[0] == 0x20 and resp[1] == 0x02
-        if resp[3] != 0:
-            raise MQTTException(resp[3])
-        return resp[2] & 1
+        try:
+            op = self._read_byte()
+        except OSError as e:
+            # _fill() raises OSError(-1) on EOF: the broker hung up on
+            # the MQTT 5 CONNECT instead of answering it
+            if self.version != 5 or e.args[:1] != (-1,):
+                raise
+            raise MQTTException(1)
+        assert op == 0x20
+        resp = self._read(self._recv_len())
+        if resp[1] != 0:
+            raise MQTTException(resp[1])
+        self.topic_aliases = {}
+        if self.version == 5:
+            props = _parse_props(resp, 2)[0]
+            self.topic_alias_max = props.get(0x22, 0)
+            self.receive_max = props.get(0x21, 65535)
+        self.last_tx = ticks_ms()
+        self.ping_outstanding = False
+        self.rtt_ms = -1
+        if self.ssl:
+            # TLS 1.3 tickets arrive after the handshake, so the session
+            # is only picked up once the broker has answered.
+            tls = getattr(self.sock, "sock", self.sock)
+            self.ssl_session = getattr(tls, "session", None)
+        return resp[0] & 1
+
+    # Builds the SSL context once per client from ssl_params (checked in
+    # __init__), so reconnects skip parsing certificates and keys again.
+    # Returns None on ports whose ssl module has no SSLContext.
+    def _tls_context(self):
+        ssl = _ssl_module()
+        if self.ssl_ctx is None and hasattr(ssl, "SSLContext"):
+            p = self.ssl_params
+            ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            cert_reqs = p.get("cert_reqs", ssl.CERT_NONE)
+            if cert_reqs == ssl.CERT_NONE and hasattr(ctx, "check_hostname"):
+                ctx.check_hostname = False
+            ctx.verify_mode = cert_reqs
+            if "cadata" in p:
+                ctx.load_verify_locations(cadata=p["cadata"])
+            if "cert" in p:
+                ctx.load_cert_chain(p["cert"], p["key"])
+            self.ssl_ctx = ctx
+        return self.ssl_ctx
+
+    # Performs the TLS handshake, resuming the previous session (ticket
+    # or session id) where the ssl module supports it, and records how
+    # long it took.
+    def _wrap_tls(self):
+        start = ticks_ms()
+        ctx = self._tls_context()
+        if ctx is None:
+            self.sock = _ssl.wrap_socket(self.sock, **self.ssl_params)
+        else:
+            hostname = self.ssl_params.get("server_hostname", self.server)
+            try:
+                self.sock = ctx.wrap_socket(self.sock, server_hostname=hostname,
+                                            session=self.ssl_session)
+            except TypeError:
+                self.sock = ctx.wrap_socket(self.sock, server_hostname=hostname)
+        self.tls_handshake_ms = ticks_diff(ticks_ms(), start)
+        self.tls_resumed = getattr(self.sock, "session_reused", False)
 
     def disconnect(self):
         self.sock.write(b"\xe0\0")
@@ -110,13 +445,47 @@ class MQTTClient:
 
     def ping(self):
         self.sock.write(b"\xc0\0")
+        self.last_tx = self.ping_sent = ticks_ms()
+        self.ping_outstanding = True
+
+    # Milliseconds since the last packet was sent to the broker.
+    def idle_ms(self):
+        return ticks_diff(ticks_ms(), self.last_tx)
 
-    def publish(self, topic, msg, retain=False, qos=0):
+    # Milliseconds since anything was received from the broker. A client
+    # that keeps sending QoS 0 is never idle by idle_ms(), yet may not
+    # have heard from the broker in a long time.
+    def rx_idle_ms(self):
+        return ticks_diff(ticks_ms(), self.last_rx)
+
+    # Builds the MQTT 5 PUBLISH property block. The first publish on a
+    # topic (while the broker's Topic Alias Maximum allows) binds an
+    # alias to it; later publishes send the alias and an empty topic.
+    # Returns (topic to send, properties).
+    def _publish_props(self, topic, expiry):
+        props = b""
+        if expiry is not None:
+            props = struct.pack("!BI", 0x02, expiry)
+        alias = self.topic_aliases.get(topic)
+        if alias:
+            return b"", props + struct.pack("!BH", 0x23, alias)
+        if len(self.topic_aliases) < self.topic_alias_max:
+            alias = len(self.topic_aliases) + 1
+            self.topic_aliases[topic] = alias
+            props += struct.pack("!BH", 0x23, alias)
+        return topic, props
+
+    # expiry: MQTT 5 Message Expiry Interval in seconds (ignored by 3.1.1).
+    def publish(self, topic, msg, retain=False, qos=0, expiry=None):
         pkt = bytearray(b"\x30\0\0\0")
         pkt[0] |= qos << 1 | retain
+        if self.version == 5:
+            topic, props = self._publish_props(topic, expiry)
         sz = 2 + len(topic) + len(msg)
         if qos > 0:
             sz += 2
+        if self.version == 5:
+            sz += 1 + len(props)
         assert sz < 2097152
         i = 1
         while sz > 0x7f:
@@ -128,41 +497,129 @@ class MQTTClient:
         self.sock.write(pkt, i + 1)
         self._send_str(topic)
         if qos > 0:
-            self.pid += 1
-            pid = self.pid
+            pid = self._next_pid()
             struct.pack_into("!H", pkt, 0, pid)
             self.sock.write(pkt, 2)
+        if self.version == 5:
+            self.sock.write(bytes((len(props),)))
+            self.sock.write(props)
         self.sock.write(msg)
+        self.last_tx = ticks_ms()
         if qos == 1:
-            while 1:
-                op = self.wait_msg()
-                if op == 0x40:
-                    sz = self.sock.read(1)
-                    assert sz == b"\x02"
-                    rcv_pid = self.sock.read(2)
-                    rcv_pid = rcv_pid[0] << 8 | rcv_pid[1]
-                    if pid == rcv_pid:
-                        return
+            self._wait_puback(pid)
         elif qos == 2:
             assert 0
 
-    def subscribe(self, topic, qos=0):
-        assert self.cb is not None, "Subscribe callback is not set"
+    def _wait_puback(self, pid):
+        while 1:
+            op = self.wait_msg()
+            if op == 0x40:
+                sz = self._recv_len()
+                rcv_pid = self._read(sz)
+                if sz > 2 and rcv_pid[2] >= 0x80:
+                    raise MQTTException(rcv_pid[2])
+                rcv_pid = rcv_pid[0] << 8 | rcv_pid[1]
+                if pid == rcv_pid:
+                    return
+
+    # Returns a PreparedPublish for a topic that is published repeatedly.
+    def prepare(self, topic, qos=0, retain=False):
+        return PreparedPublish(self, topic, qos, retain)
+
+    # Appends a complete PUBLISH frame to buf.
+    def _encode_publish(self, buf, topic, msg, retain, qos, pid):
+        if self.version == 5:
+            topic, props = self._publish_props(topic, None)
+        sz = 2 + len(topic) + len(msg)
+        if qos > 0:
+            sz += 2
+        if self.version == 5:
+            sz += 1 + len(props)
+        assert sz < 2097152
+        buf.append(0x30 | qos << 1 | retain)
+        while sz > 0x7f:
+            buf.append((sz & 0x7f) | 0x80)
+            sz >>= 7
+        buf.append(sz)
+        buf += struct.pack("!H", len(topic))
+        buf += topic
+        if qos > 0:
+            buf += struct.pack("!H", pid)
+        if self.version == 5:
+            buf.append(len(props))
+            buf += props
+        buf += msg
+
+    # Waits for the PUBACKs of pending ({pid: index}) and stores the
+    # outcome of each in results[index].
+    def _wait_pubacks(self, pending, results):
+        while pending:
+            op = self.wait_msg()
+            if op == 0x40:
+                sz = self._recv_len()
+                resp = self._read(sz)
+                pid = resp[0] << 8 | resp[1]
+                if pid in pending:
+                    results[pending.pop(pid)] = not (sz > 2 and resp[2] >= 0x80)
+
+    # Publishes many messages with as few socket writes as possible.
+    # msgs is an iterable of (topic, msg, qos) or (topic, msg, qos, retain)
+    # tuples. All frames are encoded into one buffer and written at once;
+    # QoS 1 messages are pipelined, at most receive_max of them unacked.
+    # Returns a list with, per message, True if it was sent (QoS 0) or
+    # acknowledged (QoS 1), and False if the broker rejected it.
+    def publish_many(self, msgs):
+        results = []
+        pending = {}
+        buf = bytearray()
+        for m in msgs:
+            topic, msg, qos = m[0], m[1], m[2]
+            retain = len(m) > 3 and m[3]
+            assert qos < 2
+            pid = 0
+            if qos:
+                if len(pending) >= self.receive_max:
+                    self.sock.write(buf)
+                    buf = bytearray()
+                    self._wait_pubacks(pending, results)
+                pid = self._next_pid()
+                pending[pid] = len(results)
+            results.append(not qos)
+            self._encode_publish(buf, topic, msg, retain, qos, pid)
+        if buf:
+            self.sock.write(buf)
+            self.last_tx = ticks_ms()
+        self._wait_pubacks(pending, results)
+        return results
+
+    # f: optional handler for messages matching this topic filter
+    # ("+" and "#" wildcards allowed). Messages no handler matches go
+    # to the callback set by .set_callback().
+    def subscribe(self, topic, qos=0, f=None):
+        if f is not None:
+            self.router.add(topic, f)
+        assert self.cb is not None or self.router.count, "Subscribe callback is not set"
         pkt = bytearray(b"\x82\0\0\0")
-        self.pid += 1
-        struct.pack_into("!BH", pkt, 1, 2 + 2 + len(topic) + 1, self.pid)
+        self._next_pid()
+        sz = 2 + 2 + len(topic) + 1
+        if self.version == 5:
+            sz += 1
+        struct.pack_into("!BH", pkt, 1, sz, self.pid)
         #print(hex(len(pkt)), hexlify(pkt, ":"))
         self.sock.write(pkt)
+        if self.version == 5:
+            self.sock.write(b"\0")
         self._send_str(topic)
         self.sock.write(qos.to_bytes(1, "little"))
+        self.last_tx = ticks_ms()
         while 1:
             op = self.wait_msg()
             if op == 0x90:
-                resp = self.sock.read(4)
+                resp = self._read(self._recv_len())
                 #print(resp)
-                assert resp[1] == pkt[2] and resp[2] == pkt[3]
-                if resp[3] == 0x80:
-                    raise MQTTException(resp[3])
+                assert resp[0] == pkt[2] and resp[1] == pkt[3]
+                if resp[-1] >= 0x80:
+                    raise MQTTException(resp[-1])
                 return
 
     # Wait for a single incoming MQTT message and process it.
@@ -170,30 +627,38 @@ class MQTTClient:
     # set by .set_callback() method. Other (internal) MQTT
     # messages processed internally.
     def wait_msg(self):
-        res = self.sock.read(1)
-        self.sock.setblocking(True)
-        if res is None:
-            return None
-        if res == b"":
-            raise OSError(-1)
-        if res == b"\xd0":  # PINGRESP
-            sz = self.sock.read(1)[0]
+        op = self._read_byte()
+        if op == 0xd0:  # PINGRESP
+            sz = self._read_byte()
             assert sz == 0
+            self.rtt_ms = ticks_diff(ticks_ms(), self.ping_sent)
+            self.ping_outstanding = False
             return None
-        op = res[0]
         if op & 0xf0 != 0x30:
             return op
         sz = self._recv_len()
-        topic_len = self.sock.read(2)
-        topic_len = (topic_len[0] << 8) | topic_len[1]
-        topic = self.sock.read(topic_len)
-        sz -= topic_len + 2
+        self._fill(sz)
+        buf = self._rbuf
+        i = self._rpos
+        end = i + sz
+        topic_len = buf[i] << 8 | buf[i + 1]
+        i += 2
+        topic = self._rmv[i:i + topic_len]
+        i += topic_len
         if op & 6:
-            pid = self.sock.read(2)
-            pid = pid[0] << 8 | pid[1]
-            sz -= 2
-        msg = self.sock.read(sz)
-        self.cb(topic, msg)
+            pid = buf[i] << 8 | buf[i + 1]
+            i += 2
+        if self.version == 5:
+            n, i = _decode_varint(buf, i)
+            i += n
+        msg = self._rmv[i:end]
+        self._rpos = end
+        if self.cb_copy:
+            topic = bytes(topic)
+            msg = bytes(msg)
+        if not (self.router.count and self.router.dispatch(topic, msg)):
+            if self.cb is not None:
+                self.cb(topic, msg)
         if op & 6 == 2:
             pkt = bytearray(b"\x40\x02\0\0")
             struct.pack_into("!H", pkt, 2, pid)
@@ -205,5 +670,92 @@ class MQTTClient:
     # If not, returns immediately with None. Otherwise, does
     # the same processing as wait_msg.
     def check_msg(self):
-        self.sock.setblocking(False)
-        return self.wait_msg()
\ No newline at end of file
+        if self._rend == self._rpos:
+            self._rpos = self._rend = 0
+            self.sock.setblocking(False)
+            try:
+                r = self.sock.readinto(self._rmv)
+            finally:
+                self._blocking()
+            if r is None:
+                return None
+            if not r:
+                raise OSError(-1)
+            self._rend = r
+        return self.wait_msg()
+
+    # Switches the socket back to blocking mode after check_msg().
+    # setblocking(True) alone would also clear socket_timeout.
+    def _blocking(self):
+        if self.socket_timeout is None:
+            self.sock.setblocking(True)
+        elif hasattr(self.sock, "settimeout"):
+            self.sock.settimeout(self.socket_timeout)
+        else:
+            # MicroPython TLS sockets: the timeout lives on the TCP socket
+            self._tcp.settimeout(self.socket_timeout)
+
+# Publisher for a fixed topic/QoS/retain combination. The fixed header
+# byte and the length-prefixed topic are encoded once into a header
+# buffer; each call only fills in the remaining length (written right
+# before the topic block) and the packet id, then sends header and
+# payload with two writes. For QoS 0 the header is reused as is while
+# the payload size does not change. On MQTT 5 connections it defers to
+# MQTTClient.publish(), which shortens repeated topics with aliases.
+class PreparedPublish:
+
+    def __init__(self, client, topic, qos=0, retain=False):
+        assert 0 <= qos <= 1
+        self.client = client
+        self.topic = topic
+        self.qos = qos
+        self.retain = retain
+        self.flags = 0x30 | qos << 1 | retain
+        # [fixed header byte + up to 4 length bytes][topic block][pid]
+        self.hdr = bytearray(5 + 2 + len(topic) + 2)
+        struct.pack_into("!H", self.hdr, 5, len(topic))
+        self.hdr[7:7 + len(topic)] = topic
+        self.mv = memoryview(self.hdr)
+        self.fixed = 2 + len(topic) + (2 if qos else 0)
+        self.last_n = -1
+        self.last_hdr = None
+
+    # Encodes the header for a payload of n bytes in place and returns
+    # the view of it to send.
+    def encode(self, n, pid=0):
+        hdr = self.hdr
+        sz = self.fixed + n
+        assert sz < 2097152
+        i = 4 if sz < 0x80 else 3 if sz < 0x4000 else 2
+        hdr[i - 1] = self.flags
+        k = i
+        while sz > 0x7f:
+            hdr[k] = (sz & 0x7f) | 0x80
+            sz >>= 7
+            k += 1
+        hdr[k] = sz
+        end = 5 + self.fixed
+        if pid:
+            hdr[end - 2] = pid >> 8
+            hdr[end - 1] = pid & 0xff
+        return self.mv[i - 1:end]
+
+    def __call__(self, msg):
+        client = self.client
+        if client.version == 5:
+            return client.publish(self.topic, msg, self.retain, self.qos)
+        n = len(msg)
+        pid = 0
+        if self.qos:
+            pid = client._next_pid()
+            hdr = self.encode(n, pid)
+        elif n == self.last_n:
+            hdr = self.last_hdr
+        else:
+            hdr = self.last_hdr = self.encode(n)
+            self.last_n = n
+        client.sock.write(hdr)
+        client.sock.write(msg)
+        client.last_tx = ticks_ms()
+        if self.qos:
+            client._wait_puback(pid)
\ No newline at end of file
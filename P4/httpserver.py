@@ -0,0 +1,1057 @@
+############### Imports ###############
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+from ticks import ticks_diff, ticks_ms
+
+try:
+    import hashlib
+except ImportError:
+    import uhashlib as hashlib
+
+try:
+    from ubinascii import hexlify
+except ImportError:
+    from binascii import hexlify
+
+try:
+    import gzip
+except ImportError:
+    gzip = None
+
+try:
+    import io
+
+    import deflate
+except ImportError:
+    deflate = None
+
+#######################################
+
+######## HTTP status reasons ########
+REASONS = {
+    200: b"OK",
+    202: b"Accepted",
+    304: b"Not Modified",
+    400: b"Bad Request",
+    404: b"Not Found",
+    405: b"Method Not Allowed",
+    408: b"Request Timeout",
+    413: b"Payload Too Large",
+    431: b"Request Header Fields Too Large",
+    500: b"Internal Server Error",
+    501: b"Not Implemented",
+    503: b"Service Unavailable",
+    505: b"HTTP Version Not Supported",
+}
+
+#####################################
+
+
+class HTTPError(Exception):
+    """
+    Raised by the request parser; the server answers with the status and
+    closes the connection.
+    """
+
+    def __init__(self, status):
+        super().__init__(status)
+        self.status = status
+
+
+######## Incremental request parser ########
+# MicroPython's bytearray has no find(); fall back to a copy of the
+# searched window there
+if hasattr(bytearray, "find"):
+
+    def _find(buf, mv, sub, start, end):
+        return buf.find(sub, start, end)
+
+else:
+
+    def _find(buf, mv, sub, start, end):
+        i = bytes(mv[start:end]).find(sub)
+        return i if i < 0 else start + i
+
+
+async def _readinto(reader, mv):
+    """
+    Reads available bytes from an asyncio stream into mv. uasyncio has
+    StreamReader.readinto; CPython's StreamReader only has read().
+    """
+    if hasattr(reader, "readinto"):
+        return await reader.readinto(mv)
+    data = await reader.read(len(mv))
+    mv[:len(data)] = data
+    return len(data)
+
+
+class HTTPRequest:
+    """
+    Parses requests from a stream into one preallocated buffer, across
+    however many partial reads they arrive in. One instance serves all
+    the requests of a connection (and is then reused by the server for
+    the next connection); bytes of pipelined requests read together with
+    the current one are kept for the next call.
+
+    Limits are enforced while reading: a head (request line and headers)
+    longer than max_head is rejected with 431 as soon as the buffer is
+    full, a Content-Length above max_body with 413 before any of the
+    body is read.
+
+    After read(), the parsed fields are available as bytes: method,
+    path, query, version, headers (lower case names) and body (a
+    memoryview of the buffer, valid until the next read()).
+    """
+
+    def __init__(self, max_head=1024, max_body=1024):
+        self.max_head = max_head
+        self.max_body = max_body
+        self.buf = bytearray(max_head + max_body)
+        self.mv = memoryview(self.buf)
+        self.end = 0
+        self.used = 0
+        self._clear()
+
+    def _clear(self):
+        self.method = b""
+        self.path = b""
+        self.query = b""
+        self.version = b""
+        self.headers = {}
+        self.body = self.mv[:0]
+        self.keep_alive = False
+
+    def reset(self):
+        """
+        Drops any buffered bytes, for reuse on a new connection.
+        """
+        self.end = 0
+        self.used = 0
+        self._clear()
+
+    async def _fill(self, reader):
+        n = await _readinto(reader, self.mv[self.end:])
+        if not n:
+            raise EOFError
+        self.end += n
+
+    async def wait(self, reader):
+        """
+        Discards the previous request and waits until bytes of the next
+        one are buffered. Returns False when the client closed the
+        connection instead.
+        """
+        if self.used:
+            left = self.end - self.used
+            if left:
+                self.mv[:left] = self.mv[self.used:self.end]
+            self.end = left
+            self.used = 0
+        self._clear()
+        if self.end:
+            return True
+        try:
+            await self._fill(reader)
+        except EOFError:
+            return False
+        return True
+
+    async def read(self, reader):
+        """
+        Reads and parses one complete request. Raises HTTPError for
+        malformed or oversized requests and EOFError when the client
+        disconnects halfway.
+        """
+        scan = 0
+        while True:
+            head_end = _find(self.buf, self.mv, b"\r\n\r\n", scan, min(self.end, self.max_head))
+            if head_end >= 0:
+                break
+            if self.end >= self.max_head:
+                raise HTTPError(431)
+            scan = max(0, self.end - 3)
+            await self._fill(reader)
+
+        lines = bytes(self.mv[:head_end]).split(b"\r\n")
+        parts = lines[0].split(b" ")
+        if len(parts) != 3 or not parts[0].isalpha() or not parts[1].startswith(b"/"):
+            raise HTTPError(400)
+        self.method, target, self.version = parts
+        if not self.version.startswith(b"HTTP/1."):
+            raise HTTPError(505)
+        self.path, _, self.query = target.partition(b"?")
+        keep_alive = self.version == b"HTTP/1.1"
+        headers = self.headers
+        for line in lines[1:]:
+            name, sep, value = line.partition(b":")
+            if not sep:
+                raise HTTPError(400)
+            name = name.strip().lower()
+            value = value.strip()
+            headers[name] = value
+            if name == b"connection":
+                value = value.lower()
+                if value == b"close":
+                    keep_alive = False
+                elif value == b"keep-alive":
+                    keep_alive = True
+        self.keep_alive = keep_alive
+
+        if b"transfer-encoding" in headers:
+            raise HTTPError(501)
+        length = headers.get(b"content-length", b"0")
+        if not length.isdigit():
+            raise HTTPError(400)
+        length = int(length)
+        if length > self.max_body:
+            raise HTTPError(413)
+        body_start = head_end + 4
+        body_end = body_start + length
+        while self.end < body_end:
+            await self._fill(reader)
+        self.body = self.mv[body_start:body_end]
+        self.used = body_end
+        return self
+
+############################################
+
+
+########## Request routing ##########
+class _Node:
+    """
+    Node of the segment trie: literal children by segment, plus at most
+    one parameter child.
+    """
+
+    def __init__(self):
+        self.children = {}
+        self.param = None
+        self.param_name = None
+        self.handlers = None
+
+
+class Router:
+    """
+    Dispatches requests to handlers registered with decorators, so adding
+    an endpoint never lengthens an if/elif chain.
+
+    Paths without parameters go into a dict ({path: {method: handler}}),
+    found with one lookup. Paths with {name} segments are compiled into a
+    trie of segments walked once per request, so the cost depends on the
+    depth of the path, not on the number of routes. Exact paths win over
+    parameterized ones (/led/status before /led/{state}) and, within the
+    trie, a literal segment wins over a parameter at the same position.
+
+    Handlers are coroutines returning (status, content type, body); they
+    get the arguments passed to dispatch() followed by the path
+    parameters (str) as keyword arguments, and the request body
+    (body=, a memoryview) when registered with body=True. Unknown paths
+    get 404, known paths with another method 405 with an Allow header
+    listing the methods the path has.
+
+    Usage:
+        router = Router()
+
+        @router.get("/led/{state}")
+        async def led(state):
+            return 200, "text/plain", state
+
+        server = HTTPServer(router.dispatch)
+    """
+
+    def __init__(self, not_found=(404, "text/plain", "Not Found")):
+        """
+        :param not_found: Response (status, content type, body) for paths
+                          without a route
+        """
+        self.exact = {}
+        self.trie = _Node()
+        self.not_found = not_found
+        self.with_body = set()
+
+    ###### Registration ######
+    def route(self, method, pattern, body=False):
+        """
+        Decorator registering a handler for method (e.g. "GET") and
+        pattern (e.g. "/publish/{channel}"). Returns the function
+        unchanged, so it also works on methods in a class body.
+
+        :param body: Pass the request body to the handler
+        """
+        method = method.encode()
+
+        def register(handler):
+            if body:
+                self.with_body.add(handler)
+            if "{" not in pattern:
+                self.exact.setdefault(pattern.encode(), {})[method] = handler
+                return handler
+            node = self.trie
+            for seg in pattern.split("/")[1:]:
+                if seg.startswith("{") and seg.endswith("}"):
+                    name = seg[1:-1]
+                    if node.param is None:
+                        node.param = _Node()
+                        node.param_name = name
+                    elif node.param_name != name:
+                        raise ValueError("%s: {%s} clashes with {%s}" % (pattern, name, node.param_name))
+                    node = node.param
+                else:
+                    node = node.children.setdefault(seg.encode(), _Node())
+            if node.handlers is None:
+                node.handlers = {}
+            node.handlers[method] = handler
+            return handler
+
+        return register
+
+    def get(self, pattern, body=False):
+        return self.route("GET", pattern, body)
+
+    def post(self, pattern, body=False):
+        return self.route("POST", pattern, body)
+
+    ##########################
+
+    ###### Dispatching ######
+    def match(self, path):
+        """
+        Returns ({method: handler}, params) for path (bytes), or
+        (None, None) when no route matches.
+        """
+        handlers = self.exact.get(path)
+        if handlers is not None:
+            return handlers, None
+        node = self.trie
+        params = None
+        for seg in path.split(b"/")[1:]:
+            child = node.children.get(seg)
+            if child is None:
+                child = node.param
+                if child is None or not seg:
+                    return None, None
+                if params is None:
+                    params = {}
+                params[node.param_name] = seg.decode()
+            node = child
+        if node.handlers is None:
+            return None, None
+        return node.handlers, params
+
+    async def dispatch(self, method, path, *args, body=None):
+        """
+        Runs the handler of the request and returns its (status, content
+        type, body).
+        """
+        handlers, params = self.match(path)
+        if handlers is None:
+            return self.not_found
+        handler = handlers.get(method)
+        if handler is None:
+            # RFC 9110 requires a 405 to list the methods of the path
+            return (405, "text/plain", "Method Not Allowed",
+                    b"Allow: %s\r\n" % b", ".join(sorted(handlers)))
+        if handler in self.with_body:
+            if params is None:
+                params = {}
+            params["body"] = body
+        if params:
+            return await handler(*args, **params)
+        return await handler(*args)
+
+    #########################
+
+#####################################
+
+
+######## Precompiled static responses ########
+def _gzip(data):
+    """
+    Returns data gzip-compressed, or None when this firmware cannot
+    compress (MicroPython's deflate module only compresses when built
+    with MICROPY_PY_DEFLATE_COMPRESS).
+    """
+    try:
+        if gzip is not None:
+            return gzip.compress(data, 9, mtime=0)
+        if deflate is not None:
+            stream = io.BytesIO()
+            with deflate.DeflateIO(stream, deflate.GZIP) as f:
+                f.write(data)
+            return stream.getvalue()
+    except (AttributeError, OSError, ValueError):
+        pass
+    return None
+
+
+class StaticAsset:
+    """
+    A static response built once: the body (and its gzip variant, when
+    smaller) and complete header blocks, so serving it only writes
+    preencoded bytes. The strong ETag is a hash of the body; requests
+    whose If-None-Match carries it get a 304 without body.
+
+    Usage:
+        server.add_static(b"/", StaticAsset.from_file("panel.html", "text/html"))
+    """
+
+    def __init__(self, body, content_type, cache_control="no-cache", gzip_body=None):
+        """
+        :param body: Response body (bytes or str)
+        :param content_type: Content-Type of the body
+        :param cache_control: Cache-Control header; "no-cache" makes
+                              browsers revalidate every load (304 when
+                              unchanged)
+        :param gzip_body: Precompressed body, e.g. read from a .gz file
+                          built on the PC; compressed here when None
+        """
+        if isinstance(body, str):
+            body = body.encode()
+        if gzip_body is None:
+            gzip_body = _gzip(body)
+        if gzip_body is not None and len(gzip_body) >= len(body):
+            gzip_body = None
+        self.tag = hexlify(hashlib.sha256(body).digest()[:8])
+        self.body = body
+        self.gzip_body = gzip_body
+        common = b"ETag: \"%s%s\"\r\nCache-Control: %s\r\nVary: Accept-Encoding\r\n"
+        cache_control = cache_control.encode()
+        self.head = (
+            b"HTTP/1.1 200 OK\r\nContent-Type: %s\r\nContent-Length: %d\r\n"
+            % (content_type.encode(), len(body))
+            + common % (self.tag, b"", cache_control)
+        )
+        if gzip_body is not None:
+            self.head_gzip = (
+                b"HTTP/1.1 200 OK\r\nContent-Type: %s\r\nContent-Encoding: gzip\r\n"
+                b"Content-Length: %d\r\n" % (content_type.encode(), len(gzip_body))
+                + common % (self.tag, b"-gz", cache_control)
+            )
+            self.head_304_gzip = b"HTTP/1.1 304 Not Modified\r\n" + common % (
+                self.tag, b"-gz", cache_control)
+        self.head_304 = b"HTTP/1.1 304 Not Modified\r\n" + common % (
+            self.tag, b"", cache_control)
+
+    @classmethod
+    def from_file(cls, filename, content_type, cache_control="no-cache"):
+        """
+        Loads a file, using filename + ".gz" as the compressed variant
+        when it exists (gzip -9k panel.html on the PC).
+        """
+        with open(filename, "rb") as f:
+            body = f.read()
+        try:
+            with open(filename + ".gz", "rb") as f:
+                gzip_body = f.read()
+        except OSError:
+            gzip_body = None
+        return cls(body, content_type, cache_control, gzip_body)
+
+
+##############################################
+
+
+########## Server-Sent Events ##########
+class _Subscriber:
+    """
+    One connected event stream client: its pending frames and the event
+    its writer task waits on.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.writer = None
+        self.queue = []
+        self.wake = asyncio.Event()
+        self.dropped = False
+
+
+class EventStream:
+    """
+    Pushes events to every connected browser over Server-Sent Events
+    (text/event-stream, read with EventSource in JavaScript), so pages
+    update when something changes instead of polling.
+
+    publish() encodes a frame once and appends it to the queue of every
+    subscriber; each subscriber has its own writer task. Queues hold at
+    most queue_size frames: a client that cannot keep up (slow Wi-Fi,
+    suspended tab) is dropped instead of buffering without bound or
+    holding back the others (its connection is closed). Its browser
+    reconnects after retry_ms.
+
+    Events published with retain=True are also remembered per event
+    name and sent first to clients that connect later, so a new page
+    starts with the current state (e.g. the LED) without a request.
+
+    Usage:
+        events = EventStream()
+        server.add_stream(b"/events", events)
+        events.publish("led", "ON", retain=True)
+    """
+
+    def __init__(self, max_clients=2, queue_size=8, retry_ms=3000, heartbeat_ms=15000):
+        """
+        :param max_clients: Streams open at the same time; more get 503
+        :param queue_size: Frames queued per client before it is dropped
+        :param retry_ms: Reconnect delay suggested to the browser
+        :param heartbeat_ms: Idle time after which a comment is sent, so
+                             dead connections are noticed
+        """
+        self.max_clients = max_clients
+        self.queue_size = queue_size
+        self.heartbeat_ms = heartbeat_ms
+        self.head = (
+            b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+            b"Cache-Control: no-cache\r\nConnection: close\r\n\r\nretry: %d\n\n" % retry_ms
+        )
+        self.subscribers = []
+        self.retained = {}
+        self.published = 0
+        self.dropped = 0
+
+    def subscribe(self):
+        """
+        Registers a new client and returns its subscriber, or None when
+        max_clients are already connected.
+        """
+        if len(self.subscribers) >= self.max_clients:
+            return None
+        sub = _Subscriber(self)
+        sub.queue.extend(self.retained.values())
+        self.subscribers.append(sub)
+        return sub
+
+    ########################################
+
+    ###### Publishing ######
+    def publish(self, event, data, retain=False):
+        """
+        Queues one event for every connected client. Never blocks.
+
+        :param event: Event name (addEventListener(name) in the browser)
+        :param data: Event payload (str), may span several lines
+        :param retain: Also send it to clients connecting later
+        """
+        frame = ("event: %s\ndata: %s\n\n" % (event, data.replace("\n", "\ndata: "))).encode()
+        if retain:
+            self.retained[event] = frame
+        self.published += 1
+        for sub in self.subscribers[:]:
+            if len(sub.queue) < self.queue_size:
+                sub.queue.append(frame)
+            else:
+                self._drop(sub)
+            sub.wake.set()
+
+    def _drop(self, sub):
+        """
+        Disconnects a client whose queue is full. Closing the socket also
+        ends a writer task blocked in drain() on it.
+        """
+        sub.dropped = True
+        self.dropped += 1
+        self.subscribers.remove(sub)
+        if sub.writer is not None:
+            try:
+                sub.writer.close()
+            except OSError:
+                pass
+
+    ########################
+
+    ###### Serving a client ######
+    async def serve(self, sub, writer):
+        """
+        Streams events to a subscribed client until it goes away or is
+        dropped.
+        """
+        sub.writer = writer
+        try:
+            writer.write(self.head)
+            await writer.drain()
+            while not sub.dropped:
+                if sub.queue:
+                    frames = sub.queue
+                    sub.queue = []
+                    for frame in frames:
+                        writer.write(frame)
+                else:
+                    sub.wake.clear()
+                    try:
+                        await asyncio.wait_for(sub.wake.wait(), self.heartbeat_ms / 1000)
+                        continue
+                    except asyncio.TimeoutError:
+                        writer.write(b": ping\n\n")
+                await writer.drain()
+        except OSError:
+            pass
+        finally:
+            if sub in self.subscribers:
+                self.subscribers.remove(sub)
+
+    ##############################
+
+########################################
+
+
+######## Chunked transfer encoding ########
+_HEX = b"0123456789abcdef"
+# Every chunk is framed in the send buffer itself: 4 hex digits of
+# length and CRLF before the data, CRLF after it
+_CHUNK_HEAD = 6
+_CHUNK_FRAMING = 8
+
+
+def _frame_chunk(buf, size):
+    """
+    Writes the chunk header for size bytes of data at buf[6:] and the
+    trailing CRLF, in place. Returns the framed length.
+    """
+    buf[0] = _HEX[(size >> 12) & 15]
+    buf[1] = _HEX[(size >> 8) & 15]
+    buf[2] = _HEX[(size >> 4) & 15]
+    buf[3] = _HEX[size & 15]
+    buf[4] = 13
+    buf[5] = 10
+    buf[_CHUNK_HEAD + size] = 13
+    buf[_CHUNK_HEAD + size + 1] = 10
+    return size + _CHUNK_FRAMING
+
+###########################################
+
+
+########## Asynchronous HTTP server ##########
+class HTTPServer:
+    """
+    Minimal HTTP server on top of asyncio.start_server. Accepting and
+    reading happen through the event loop's stream reader and writer, so
+    other tasks (button polling, LoRa, MQTT) keep running while clients
+    connect or send slowly.
+
+    Connections are persistent (HTTP/1.1 keep-alive): every response
+    carries Content-Length, so a browser polling the panel reuses one
+    connection instead of opening a new one per request. Requests
+    pipelined on a connection are answered in order. A connection is
+    closed when the client asks for it (Connection: close, or HTTP/1.0
+    without keep-alive), after max_requests requests or after
+    idle_timeout_ms without a new request.
+
+    Static assets registered with add_static() are answered by the
+    server itself from their precompiled StaticAsset (200, gzip or 304),
+    without calling the handler.
+
+    Event streams registered with add_stream() take over their
+    connection: once the stream is open, the connection no longer counts
+    against max_connections (EventStream.max_clients limits them).
+
+    Requests are parsed incrementally by a pool of max_connections
+    preallocated HTTPRequest buffers (max_head and max_body bytes each),
+    so a connection allocates no receive buffers of its own.
+
+    Up to max_connections clients are served concurrently; further
+    clients get 503 right away instead of queueing behind the others.
+    Reading and handling a request must finish within the request
+    timeout, and every drain of the response within the same time again,
+    so a stalled client only holds its own connection slot while a long
+    stream to a slow but live client is not cut off.
+
+    The handler is a coroutine taking the method and path (bytes) and
+    the request body (keyword body, a memoryview valid until the
+    handler returns) and returning (status, content type, body),
+    usually Router.dispatch. A fourth element, if present, holds extra
+    header lines (bytes, each ending in CRLF) for the response.
+
+    A response body that is not str or bytes is streamed instead of
+    being built in RAM: a file opened in binary mode (read with
+    readinto) or a generator yielding bytes or str pieces. It is sent
+    with chunked transfer encoding in chunk_size pieces through a send
+    buffer preallocated per connection slot, draining the writer (which
+    completes partial socket writes) before the buffer is refilled, so
+    memory stays flat whatever the response size. The file or
+    generator is closed afterwards.
+
+    Usage:
+        async def handler(method, path, body=None):
+            return 200, "text/plain", "hello"
+
+        server = HTTPServer(handler)
+        await server.start()
+    """
+
+    def __init__(self, handler, host="0.0.0.0", port=80,
+                 max_connections=4, request_timeout_ms=5000,
+                 idle_timeout_ms=5000, max_requests=100, backlog=5,
+                 max_head=1024, max_body=1024, on_response=None, chunk_size=512):
+        """
+        :param handler: Coroutine function (method, path, body=) ->
+                        (status, content type, body[, headers])
+        :param max_connections: Connections served at the same time
+        :param request_timeout_ms: Time allowed for reading and handling
+                                   one request, and for each drain of
+                                   its response
+        :param idle_timeout_ms: Time a kept-alive connection may wait for
+                                its next request
+        :param max_requests: Requests served on one connection
+        :param backlog: Listen backlog of the server socket
+        :param max_head: Largest request line plus headers accepted
+        :param max_body: Largest request body accepted
+        :param on_response: Called as on_response(status, elapsed ms)
+                            after every response, e.g. for metrics
+        :param chunk_size: Data bytes per chunk of streamed responses
+        """
+        assert 0 < chunk_size <= 0xFFFF
+        self.handler = handler
+        self.host = host
+        self.port = port
+        self.max_connections = max_connections
+        self.request_timeout_ms = request_timeout_ms
+        self.idle_timeout_ms = idle_timeout_ms
+        self.max_requests = max_requests
+        self.backlog = backlog
+        self.on_response = on_response
+        self.server = None
+        self._pool = [HTTPRequest(max_head, max_body) for _ in range(max_connections)]
+        self.chunk_size = chunk_size
+        self._send_pool = [bytearray(chunk_size + _CHUNK_FRAMING) for _ in range(max_connections)]
+        self.static = {}
+        self.streams = {}
+        self.active = 0
+        self.connections = 0
+        self.requests = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.bad_requests = 0
+        self.not_modified = 0
+
+    def add_static(self, path, asset):
+        """
+        Serves asset for GET and HEAD requests of path (bytes).
+        """
+        self.static[path] = asset
+
+    def add_stream(self, path, stream):
+        """
+        Serves an EventStream for GET requests of path (bytes).
+        """
+        self.streams[path] = stream
+
+    ##############################################
+
+    ###### Server lifecycle ######
+    async def start(self):
+        """
+        Starts listening. Connections are served by tasks of their own.
+        """
+        self.server = await asyncio.start_server(
+            self._serve, self.host, self.port, backlog=self.backlog
+        )
+        print("HTTP server listening on port", self.port)
+        return self
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    ##############################
+
+    ###### Connection handling ######
+    async def _serve(self, reader, writer):
+        """
+        Serves one connection: rejects it when all slots are taken,
+        otherwise handles its requests, each within the request timeout,
+        until the connection is closed or goes idle.
+        """
+        if self.active >= self.max_connections:
+            self.rejected += 1
+            # Read the request first: closing a socket with unread data
+            # resets the connection before the client sees the 503
+            try:
+                await asyncio.wait_for(self._read_head(reader), self.request_timeout_ms / 1000)
+            except (asyncio.TimeoutError, OSError):
+                pass
+            await self._respond(writer, 503, "text/plain", "Server busy", False)
+            await self._close(writer)
+            return
+        self.active += 1
+        self.connections += 1
+        request = self._pool.pop()
+        request.reset()
+        held = True
+        served = 0
+        try:
+            keep_alive = True
+            while keep_alive and served < self.max_requests:
+                # A new connection gets the request timeout to send its
+                # first request, a kept-alive one the idle timeout
+                wait_ms = self.idle_timeout_ms if served else self.request_timeout_ms
+                try:
+                    if not await asyncio.wait_for(request.wait(reader), wait_ms / 1000):
+                        break
+                except asyncio.TimeoutError:
+                    if not served:
+                        self.timeouts += 1
+                        await self._respond(writer, 408, "text/plain", "Request timeout", False)
+                    break
+                served += 1
+                keep_alive = await self._handle(request, reader, writer,
+                                                served < self.max_requests)
+                if isinstance(keep_alive, _Subscriber):
+                    # Give the slot back before streaming for good
+                    held = False
+                    self._pool.append(request)
+                    self.active -= 1
+                    await keep_alive.stream.serve(keep_alive, writer)
+                    break
+        except HTTPError as e:
+            self.bad_requests += 1
+            await self._respond(writer, e.status, "text/plain", REASONS[e.status], False)
+        except asyncio.TimeoutError:
+            # Only reading or handling the request times out here, before
+            # anything was written; timeouts while sending are handled
+            # where the response is written
+            self.timeouts += 1
+            await self._respond(writer, 408, "text/plain", "Request timeout", False)
+        except (EOFError, OSError):
+            pass
+        except Exception as e:
+            self.errors += 1
+            print("HTTP handler error:", str(e))
+            await self._respond(writer, 500, "text/plain", "Internal error", False)
+        finally:
+            if held:
+                self._pool.append(request)
+                self.active -= 1
+            await self._close(writer)
+
+    async def _handle(self, request, reader, writer, may_keep_alive):
+        """
+        Reads the rest of the request, runs the handler (or serves the
+        static asset) and sends the response. Returns True when the
+        connection stays open, or the event stream subscriber the
+        connection switches to.
+
+        Reading and the handler share one request timeout
+        (asyncio.TimeoutError, answered 408 by the caller). Sending is
+        bounded per drain instead, see _drain().
+        """
+        received = ticks_ms()
+        timeout = self.request_timeout_ms / 1000
+        await asyncio.wait_for(request.read(reader), timeout)
+        start = ticks_ms()
+        keep_alive = request.keep_alive and may_keep_alive
+        self.requests += 1
+        stream = self.streams.get(request.path)
+        if stream is not None and request.method == b"GET":
+            sub = stream.subscribe()
+            if sub is not None:
+                return sub
+            await self._respond(writer, 503, "text/plain", "Too many event streams", False)
+            keep_alive = False
+            status = 503
+        else:
+            asset = self.static.get(request.path)
+            if asset is not None and request.method in (b"GET", b"HEAD"):
+                headers = request.headers
+                status, sent = await self._send_static(
+                    writer, asset, headers.get(b"if-none-match"),
+                    b"gzip" in headers.get(b"accept-encoding", b""),
+                    keep_alive, request.method == b"HEAD")
+                keep_alive = keep_alive and sent
+            else:
+                left = timeout - ticks_diff(start, received) / 1000
+                response = await asyncio.wait_for(
+                    self.handler(request.method, request.path, body=request.body),
+                    max(left, 0),
+                )
+                status, content_type, body = response[:3]
+                extra = response[3] if len(response) > 3 else b""
+                if isinstance(body, (str, bytes)):
+                    sent = await self._respond(writer, status, content_type, body, keep_alive,
+                                               extra)
+                    keep_alive = keep_alive and sent
+                else:
+                    # HTTP/1.0 clients cannot parse chunks: send the raw
+                    # stream and mark its end by closing the connection
+                    chunked = request.version == b"HTTP/1.1"
+                    keep_alive = await self._stream(writer, status, content_type, body,
+                                                    keep_alive and chunked, chunked, extra)
+        if self.on_response is not None:
+            self.on_response(status, ticks_diff(ticks_ms(), start))
+        return keep_alive
+
+    async def _read_head(self, reader):
+        """
+        Reads the request line and skips the headers. Returns the request
+        line.
+        """
+        request_line = await reader.readline()
+        while True:
+            line = await reader.readline()
+            if not line or line == b"\r\n":
+                break
+        return request_line
+
+    async def _drain(self, writer):
+        """
+        Waits until the client took what was written so far, within the
+        request timeout. The bound is per drain, not per response, so a
+        long stream to a slow but live client goes on; a stalled client
+        raises asyncio.TimeoutError.
+        """
+        transport = getattr(writer, "transport", None)
+        if transport is not None and not transport.get_write_buffer_size():
+            # Everything was sent already: skip the wait_for task
+            await writer.drain()
+            return
+        try:
+            await asyncio.wait_for(writer.drain(), self.request_timeout_ms / 1000)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+
+    async def _respond(self, writer, status, content_type, body, keep_alive, extra=b""):
+        """
+        Sends a response framed by Content-Length, with the extra header
+        lines if given. Returns False when the client went away or
+        stopped reading.
+        """
+        if isinstance(body, str):
+            body = body.encode()
+        try:
+            writer.write(
+                b"HTTP/1.1 %d %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n%sConnection: %s\r\n\r\n"
+                % (status, REASONS.get(status, b""), content_type.encode(), len(body), extra,
+                   b"keep-alive" if keep_alive else b"close")
+            )
+            writer.write(body)
+            await self._drain(writer)
+            return True
+        except (OSError, asyncio.TimeoutError):
+            return False
+
+    async def _stream(self, writer, status, content_type, source, keep_alive, chunked,
+                      extra=b""):
+        """
+        Streams a file or generator as the response body, with the extra
+        header lines if given. Returns False
+        when the connection has to be closed (client gone or stalled, or
+        the source failed after the headers were sent).
+        """
+        buf = self._send_pool.pop()
+        mv = memoryview(buf)
+        start = _CHUNK_HEAD if chunked else 0
+        end = start + self.chunk_size
+        readinto = getattr(source, "readinto", None)
+        pieces = None if readinto is not None else iter(source)
+        piece = None
+        offset = 0
+        transport = getattr(writer, "transport", None)
+        if transport is not None:
+            # CPython: make drain() wait until everything is sent, as
+            # uasyncio's does, before the buffer is refilled (restored
+            # for the rest of the connection afterwards)
+            limits = transport.get_write_buffer_limits()
+            transport.set_write_buffer_limits(0)
+        try:
+            writer.write(
+                b"HTTP/1.1 %d %s\r\nContent-Type: %s\r\n%s%sConnection: %s\r\n\r\n"
+                % (status, REASONS.get(status, b""), content_type.encode(),
+                   b"Transfer-Encoding: chunked\r\n" if chunked else b"", extra,
+                   b"keep-alive" if keep_alive else b"close")
+            )
+            while True:
+                # Fill the buffer: straight from the file, or by packing
+                # (and splitting) the pieces the generator yields
+                n = start
+                if readinto is not None:
+                    n += readinto(mv[start:end]) or 0
+                else:
+                    while n < end:
+                        if piece is None:
+                            try:
+                                piece = next(pieces)
+                            except StopIteration:
+                                break
+                            if isinstance(piece, str):
+                                piece = piece.encode()
+                            piece = memoryview(piece)
+                            offset = 0
+                        take = min(end - n, len(piece) - offset)
+                        mv[n:n + take] = piece[offset:offset + take]
+                        n += take
+                        offset += take
+                        if offset >= len(piece):
+                            piece = None
+                size = n - start
+                if not size:
+                    break
+                writer.write(mv[:_frame_chunk(buf, size)] if chunked else mv[:size])
+                await self._drain(writer)
+            if chunked:
+                writer.write(b"0\r\n\r\n")
+            await self._drain(writer)
+            return keep_alive
+        except (OSError, asyncio.TimeoutError):
+            # Headers are out: no 408 any more, just close
+            return False
+        except Exception as e:
+            # Too late for a 500: cut the stream, the client sees the
+            # missing last chunk
+            self.errors += 1
+            print("HTTP stream error:", str(e))
+            return False
+        finally:
+            self._send_pool.append(buf)
+            if transport is not None:
+                transport.set_write_buffer_limits(limits[1], limits[0])
+            close = getattr(source, "close", None)
+            if close is not None:
+                close()
+
+    async def _send_static(self, writer, asset, if_none_match, accepts_gzip,
+                           keep_alive, head_only):
+        """
+        Writes the precompiled response of a static asset: 304 when the
+        client's copy is current, else the gzip or plain variant. Returns
+        the status and whether the response was sent completely.
+        """
+        connection = b"Connection: keep-alive\r\n\r\n" if keep_alive else b"Connection: close\r\n\r\n"
+        if if_none_match is not None and (asset.tag in if_none_match or if_none_match.strip() == b"*"):
+            self.not_modified += 1
+            status = 304
+            if b"-gz" in if_none_match and asset.gzip_body is not None:
+                head, body = asset.head_304_gzip, None
+            else:
+                head, body = asset.head_304, None
+        elif accepts_gzip and asset.gzip_body is not None:
+            status = 200
+            head, body = asset.head_gzip, asset.gzip_body
+        else:
+            status = 200
+            head, body = asset.head, asset.body
+        try:
+            writer.write(head)
+            writer.write(connection)
+            if body is not None and not head_only:
+                writer.write(body)
+            await self._drain(writer)
+        except (OSError, asyncio.TimeoutError):
+            return status, False
+        return status, True
+
+    async def _close(self, writer):
+        try:
+            writer.close()
+            await writer.wait_closed()
+        except OSError:
+            pass
+
+    #################################
+
+##############################################
@@ -0,0 +1,183 @@
+############### Imports ###############
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+from ticks import ticks_diff, ticks_ms
+
+#######################################
+
+# Job states, in the order a job goes through them
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+########## Job ##########
+class Job:
+    """
+    One unit of background work and its outcome.
+    """
+
+    def __init__(self, job_id, name, fn, args):
+        self.id = job_id
+        self.name = name
+        self.fn = fn
+        self.args = args
+        self.state = QUEUED
+        self.result = None
+        self.error = None
+        self.created_ms = ticks_ms()
+        self.started_ms = None
+        self.finished_ms = None
+
+    @property
+    def finished(self):
+        return self.state in (DONE, FAILED)
+
+    def to_dict(self):
+        """
+        Status of the job, ready for JSON: id, name, state, result or
+        error, and how long it waited and ran (ms).
+        """
+        status = {"id": self.id, "name": self.name, "state": self.state}
+        if self.started_ms is not None:
+            status["queued_ms"] = ticks_diff(self.started_ms, self.created_ms)
+        if self.finished_ms is not None:
+            status["run_ms"] = ticks_diff(self.finished_ms, self.started_ms)
+        if self.state == DONE:
+            status["result"] = self.result
+        elif self.state == FAILED:
+            status["error"] = self.error
+        return status
+
+#########################
+
+
+########## Job queue ##########
+class JobQueue:
+    """
+    Runs slow commands (LoRa transmits, MQTT publishes) in a background
+    task, so an HTTP handler only enqueues them and can answer 202 with
+    the job id right away; its latency no longer depends on the radio or
+    the broker.
+
+    Jobs run one at a time, in submission order: they share one radio.
+    At most max_pending jobs wait at once (submit() returns None beyond
+    that, so a flood of requests cannot queue unbounded work), and the
+    status of the last history jobs is kept for status queries.
+
+    Usage:
+        jobs = JobQueue()
+        asyncio.create_task(jobs.run())
+        job = jobs.submit("publish", self.publish_all, "hello")
+        ...
+        jobs.get(job.id).to_dict()
+    """
+
+    def __init__(self, max_pending=8, history=16, notify=None):
+        """
+        :param max_pending: Jobs waiting to run before submit() refuses
+        :param history: Jobs whose status is kept (finished ones are
+                        forgotten oldest first)
+        :param notify: Called as notify(job) when a job finishes
+        """
+        self.max_pending = max_pending
+        self.history = history
+        self.notify = notify
+        self.pending = []
+        self.jobs = {}
+        self.order = []
+        self.next_id = 1
+        self._wake = asyncio.Event()
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+
+    ###############################
+
+    ###### Submitting ######
+    def submit(self, name, fn, *args):
+        """
+        Queues await fn(*args) and returns its Job, or None when
+        max_pending jobs are already waiting.
+
+        :param name: Short description shown in the job status
+        :param fn: Coroutine function; its return value is the result
+        """
+        if len(self.pending) >= self.max_pending:
+            self.rejected += 1
+            return None
+        job = Job(self.next_id, name, fn, args)
+        self.next_id += 1
+        self.jobs[job.id] = job
+        self.order.append(job.id)
+        self._forget()
+        self.pending.append(job)
+        self.submitted += 1
+        self._wake.set()
+        return job
+
+    def full(self):
+        """
+        True when submit() would refuse a job right now, so callers can
+        answer 503 before doing any part of the work.
+        """
+        return len(self.pending) >= self.max_pending
+
+    def get(self, job_id):
+        """
+        Returns the Job with this id, or None when unknown or forgotten.
+        """
+        return self.jobs.get(job_id)
+
+    def _forget(self):
+        """
+        Drops the oldest finished jobs beyond history. Unfinished jobs are
+        never dropped.
+        """
+        i = 0
+        while len(self.order) > self.history and i < len(self.order):
+            job = self.jobs[self.order[i]]
+            if job.finished:
+                del self.jobs[job.id]
+                self.order.pop(i)
+            else:
+                i += 1
+
+    ########################
+
+    ###### Worker task ######
+    async def run(self):
+        """
+        Runs queued jobs forever, one after the other.
+        """
+        while True:
+            if not self.pending:
+                self._wake.clear()
+                await self._wake.wait()
+                continue
+            job = self.pending.pop(0)
+            job.state = RUNNING
+            job.started_ms = ticks_ms()
+            try:
+                job.result = await job.fn(*job.args)
+                job.state = DONE
+                self.completed += 1
+            except Exception as e:
+                job.error = str(e)
+                job.state = FAILED
+                self.failed += 1
+            job.finished_ms = ticks_ms()
+            job.fn = job.args = None
+            if self.notify is not None:
+                self.notify(job)
+            # Let the HTTP server answer between two transmissions
+            await asyncio.sleep(0)
+
+    #########################
+
+###############################
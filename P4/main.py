@@ -1,12 +1,18 @@
 ############### Imports ###############
-import socket
-from time import sleep
+from time import sleep, ticks_diff, ticks_ms
 
+import gc
+import json
+import machine
 import network
 import uasyncio as asyncio
 import ubinascii
+from httpserver import EventStream, HTTPServer, Router, StaticAsset
+from jobs import JobQueue
+from metrics import Registry
 from sx127x import SX127x
 from machine import SPI, Pin
+from mqttfailover import MQTTFailover
 from umqttsimple import MQTTClient
 
 #######################################
@@ -40,9 +46,34 @@ class UnifiedPublisher:
     WIFI_PASSWORD = "10T@ATC_"
 
     MQTT_SERVER = "172.20.10.2"
+    # Extra brokers, used according to MQTT_MODE ("failover", "weighted"
+    # or "shard", see MQTTFailover)
+    MQTT_BACKUP_SERVERS = ()
+    MQTT_MODE = "failover"
     MQTT_USER = "iot"
     MQTT_PASSWORD = "2024"
     MQTT_TOPIC = b"notification"
+    MQTT_KEEPALIVE = 60
+    MQTT_VERSION = 5
+
+    HTTP_PORT = 80
+    HTTP_MAX_CONNECTIONS = 4
+    HTTP_REQUEST_TIMEOUT_MS = 5000
+    HTTP_IDLE_TIMEOUT_MS = 5000
+    HTTP_PANEL = "panel.html"
+    # Browsers following /events (Server-Sent Events) and the events
+    # queued per browser before a slow one is disconnected
+    HTTP_EVENT_CLIENTS = 2
+    HTTP_EVENT_QUEUE = 8
+    LINK_CHECK_MS = 1000
+    # LoRa/MQTT publishes requested over HTTP run as background jobs:
+    # jobs waiting before new ones get 503, and job statuses kept
+    JOB_QUEUE = 8
+    JOB_HISTORY = 16
+    # Commands accepted in one POST /api/batch, and the LoRa payload
+    # limit its publishes are packed into
+    BATCH_MAX_COMMANDS = 16
+    LORA_MAX_FRAME = 255
 
     LORA_CONFIG = {
         "miso": 19,
@@ -77,7 +108,9 @@ class UnifiedPublisher:
         - Initializes LoRa module.
         - Initializes MQTT client.
         - Creates a lock for button press handling.
-        - Sets up the HTTP server socket.
+        - Creates the background job queue (run in run()).
+        - Sets up the HTTP server (started in run()).
+        - Registers the metrics served at /metrics.
         """
         self.led = Pin(2, Pin.OUT)
         self.button = Pin(36, Pin.IN)
@@ -89,8 +122,11 @@ class UnifiedPublisher:
         self.button_lock = asyncio.Lock()
         self.button_lock.acquire()
 
-        self.server_socket = None
+        self.jobs = JobQueue(
+            max_pending=self.JOB_QUEUE, history=self.JOB_HISTORY, notify=self.notify_job
+        )
         self.init_http_server()
+        self.init_metrics()
 
     ###############################
 
@@ -134,40 +170,147 @@ class UnifiedPublisher:
             device_spi, pins=self.LORA_CONFIG,
             parameters=self.LORA_PARAMETERS
         )
+        # Transmissions yield while on air, so two tasks could otherwise
+        # interleave their FIFO writes
+        self.lora_lock = asyncio.Lock()
 
     ###############################
 
     #### SetUp MQTT connection ####
     def init_mqtt(self):
         """
-        Initializes the MQTT client using the credentials defined.
-        Attempts to connect to the MQTT broker.
+        Initializes one MQTT client per configured broker using the
+        credentials defined and wraps them in an MQTTFailover. The broker
+        connections are opened (and kept open) by the supervisor tasks
+        started in run().
         """
         self.client_id = ubinascii.hexlify(machine.unique_id())
-        self.mqtt = MQTTClient(
-            self.client_id,
-            self.MQTT_SERVER,
-            user=self.MQTT_USER,
-            password=self.MQTT_PASSWORD,
-        )
-        try:
-            self.mqtt.connect()
-            print("MQTT Connected!")
-        except Exception as e:
-            print("MQTT Connection failed:", str(e))
+        clients = [
+            MQTTClient(
+                self.client_id,
+                server,
+                user=self.MQTT_USER,
+                password=self.MQTT_PASSWORD,
+                keepalive=self.MQTT_KEEPALIVE,
+                version=self.MQTT_VERSION,
+            )
+            for server in (self.MQTT_SERVER,) + self.MQTT_BACKUP_SERVERS
+        ]
+        self.mqtt_link = MQTTFailover(clients, mode=self.MQTT_MODE)
 
     ###############################
 
     #### SetUp HTTP Server ####
     def init_http_server(self):
         """
-        Creates a socket to listen for HTTP requests on port 80.
+        Creates the asyncio HTTP server for port 80. It serves up to
+        HTTP_MAX_CONNECTIONS clients concurrently, each request within
+        HTTP_REQUEST_TIMEOUT_MS, without blocking the other tasks.
         """
-        self.server_socket = socket.socket()
-        addr = socket.getaddrinfo("0.0.0.0", 80)[0][-1]
-        self.server_socket.bind(addr)
-        self.server_socket.listen(1)
-        print("HTTP server listening on port 80")
+        self.http = HTTPServer(
+            self.handle_http_request,
+            port=self.HTTP_PORT,
+            max_connections=self.HTTP_MAX_CONNECTIONS,
+            request_timeout_ms=self.HTTP_REQUEST_TIMEOUT_MS,
+            idle_timeout_ms=self.HTTP_IDLE_TIMEOUT_MS,
+            on_response=self.record_http,
+        )
+        # The control panel is loaded once and served precompiled
+        # (gzip when the firmware can compress, ETag, 304)
+        self.http.add_static(
+            b"/", StaticAsset.from_file(self.HTTP_PANEL, "text/html; charset=utf-8")
+        )
+        # LED state, publish results and radio events are pushed to the
+        # panel as they happen instead of being polled
+        self.events = EventStream(
+            max_clients=self.HTTP_EVENT_CLIENTS, queue_size=self.HTTP_EVENT_QUEUE
+        )
+        self.http.add_stream(b"/events", self.events)
+        self.notify_led()
+
+    ###############################
+
+    #### SetUp metrics ####
+    def init_metrics(self):
+        """
+        Registers every metric served at /metrics once, so recording on
+        the hot paths (HTTP responses, LoRa sends, MQTT publishes) only
+        adds to preallocated slots. State the other modules already
+        count (supervisors, server, jobs, heap) is read at scrape time.
+        """
+        m = self.metrics = Registry()
+        http, events, jobs, link = self.http, self.events, self.jobs, self.mqtt_link
+
+        # HTTP
+        self.http_responses = tuple(
+            m.counter("http_responses_total", "HTTP responses by status class",
+                      {"code": "%dxx" % c})
+            for c in range(1, 6)
+        )
+        self.http_duration = m.histogram(
+            "http_request_duration_ms", "Time from a request read to its response sent"
+        )
+        m.counter("http_connections_total", "HTTP connections served", fn=lambda: http.connections)
+        m.counter("http_rejected_total", "HTTP connections refused with 503", fn=lambda: http.rejected)
+        m.counter("http_timeouts_total", "HTTP requests timed out (408)", fn=lambda: http.timeouts)
+        m.counter("http_bad_requests_total", "Malformed or oversized HTTP requests",
+                  fn=lambda: http.bad_requests)
+        m.gauge("http_active_connections", "HTTP connections being served", fn=lambda: http.active)
+        m.gauge("http_event_streams", "Open /events streams", fn=lambda: len(events.subscribers))
+        m.counter("http_event_streams_dropped_total", "Event streams dropped for falling behind",
+                  fn=lambda: events.dropped)
+
+        # LoRa (this node only transmits)
+        self.lora_tx = m.counter("lora_tx_total", "LoRa packets transmitted")
+        self.lora_tx_errors = m.counter("lora_tx_errors_total", "LoRa transmissions that failed")
+        self.lora_airtime = m.histogram(
+            "lora_airtime_ms", "Time on air per LoRa packet", start=8, count=10
+        )
+
+        # MQTT
+        self.mqtt_queued = m.counter("mqtt_publish_total", "Messages queued for MQTT",
+                                     {"result": "queued"})
+        self.mqtt_overflow = m.counter("mqtt_publish_total", "Messages queued for MQTT",
+                                       {"result": "dropped_oldest"})
+        m.counter("mqtt_failovers_total", "Brokers switched away from", fn=lambda: link.failovers)
+        for i, sup in enumerate(link.links):
+            broker = {"broker": str(i)}
+            m.counter("mqtt_reconnects_total", "MQTT (re)connections", broker,
+                      fn=lambda sup=sup: sup.reconnects)
+            m.counter("mqtt_ping_timeouts_total", "Missed PINGRESPs", broker,
+                      fn=lambda sup=sup: sup.ping_timeouts)
+            m.counter("mqtt_queue_dropped_total", "Messages dropped from a full queue or a failed batch",
+                      broker, fn=lambda sup=sup: sup.dropped)
+            m.counter("mqtt_errors_total", "Unexpected errors in the MQTT supervisor", broker,
+                      fn=lambda sup=sup: sup.errors)
+            m.gauge("mqtt_connected", "1 while the broker is connected", broker,
+                    fn=lambda sup=sup: int(sup.connected))
+            m.gauge("mqtt_queue_depth", "Messages waiting to be sent", broker,
+                    fn=lambda sup=sup: len(sup.queue))
+            m.gauge("mqtt_rtt_ms", "Last PINGREQ round trip (-1: none yet)", broker,
+                    fn=lambda sup=sup: sup.client.rtt_ms)
+
+        # Background jobs
+        m.counter("jobs_total", "Background jobs by outcome", {"state": "done"},
+                  fn=lambda: jobs.completed)
+        m.counter("jobs_total", "Background jobs by outcome", {"state": "failed"},
+                  fn=lambda: jobs.failed)
+        m.counter("jobs_total", "Background jobs by outcome", {"state": "rejected"},
+                  fn=lambda: jobs.rejected)
+        m.gauge("jobs_pending", "Jobs waiting to run", fn=lambda: len(jobs.pending))
+
+        # Memory
+        m.gauge("mem_free_bytes", "Free heap (gc.mem_free)", fn=gc.mem_free)
+        m.gauge("mem_alloc_bytes", "Allocated heap (gc.mem_alloc)", fn=gc.mem_alloc)
+
+    def record_http(self, status, elapsed_ms):
+        """
+        Called by HTTPServer after every response.
+        """
+        k = status // 100 - 1
+        if 0 <= k < 5:
+            self.http_responses[k].inc()
+        self.http_duration.observe(elapsed_ms)
 
     ###############################
 
@@ -182,6 +325,7 @@ class UnifiedPublisher:
             if self.button.value():
                 print("Button pressed!")
                 self.led.value(not self.led.value())
+                self.notify_led()
                 status = "ON" if self.led.value() else "OFF"
                 await self.publish_all(f"Button pressed-LED turned {status}")
                 self.button_lock.release()
@@ -206,165 +350,252 @@ class UnifiedPublisher:
     ##################################################
 
     ######## Provides a response for the requested endpoint #########
-    async def handle_http_request(self, client, request):
-        """
-        Handles a single incoming HTTP request.
-
-
-        :param client: The socket client connected for HTTP
-        :param request: The raw HTTP request data
-        """
-        request_line = request.decode().split("\r\n")[0]
-        method, path, _ = request_line.split(" ")
-
-        response_body = ""
-        if path == "/":
-            response_body = """
-            <html>
-            <head>
-                <title>Unified Publisher Control</title>
-                <style>
-                    body { font-family: Arial; margin: 20px; }
-                    .button { 
-                        padding: 10px 20px; 
-                        margin: 5px;
-                        background-color: #4CAF50;
-                        color: white;
-                        border: none;
-                        border-radius: 4px;
-                        cursor: pointer;
-                    }
-                    .button:hover { background-color: #45a049; }
-                    #status { margin: 20px 0; }
-                </style>
-                <script>
-                    async function updateStatus() {
-                        const response = await fetch('/led/status');
-                        const status = await response.text();
-                        document.getElementById('status').textContent=status;
-                    }
-                    
-                    async function controlLED(action) {
-                        await fetch('/led/' + action);
-                        updateStatus();
-                    }
-                    
-                    setInterval(updateStatus, 2000);
-                </script>
-            </head>
-            <body>
-                <h1>Unified Publisher Control Panel</h1>
-                
-                <h2>LED Control</h2>
-                <div id="status">Checking LED status...</div>
-                <button class="button" onclick="controlLED('on')">
-                   Turn LED On
-                </button>
-                <button class="button" onclick="controlLED('off')">
-                   Turn LED Off
-                </button>
-                
-                <h2>Message Publishing</h2>
-                <button class="button" onclick="fetch('/publish/all')">
-                   Publish to All
-                </button>
-                <button class="button" onclick="fetch('/publish/lora')">
-                   Publish to LoRa
-                </button>
-                <button class="button" onclick="fetch('/publish/mqtt')">
-                   Publish to MQTT
-                </button>
-            </body>
-            </html>
-            """
-
-        elif path == "/led/on":
-            self.led.on()
-            await self.publish_all("LED turned ON")
-            response_body = "LED turned on"
+    # Routes are registered on the class; handlers get the app as self
+    ROUTES = Router(not_found=(404, "text/html", "404 Not Found"))
 
-        elif path == "/led/off":
-            self.led.off()
-            await self.publish_all("LED turned OFF")
-            response_body = "LED turned off"
+    async def handle_http_request(self, method, path, body=None):
+        """
+        Handles a single incoming HTTP request (called by HTTPServer) by
+        dispatching it to the route registered for its method and path.
 
-        elif path == "/led/status":
-            status = "ON" if self.led.value() else "OFF"
-            response_body = f"LED is {status}"
+        :param method: The request method (bytes)
+        :param path: The request path (bytes)
+        :param body: The request body (memoryview)
+        :return: (status, content type, body[, extra headers])
+        """
+        return await self.ROUTES.dispatch(method, path, self, body=body)
 
-        elif path == "/publish/all":
-            await self.publish_all("Message from HTTP")
-            response_body = "Published to all protocols"
+    @ROUTES.get("/led/status")
+    async def http_led_status(self):
+        status = "ON" if self.led.value() else "OFF"
+        return 200, "text/html", f"LED is {status}"
 
-        elif path == "/publish/lora":
-            self.send_lora_message("Message from HTTP")
-            response_body = "Published to LoRa"
+    @ROUTES.get("/led/{state}")
+    async def http_led(self, state):
+        """
+        Turns the LED on or off right away and publishes the change in
+        the background. With the job queue full it answers 503 and
+        leaves the LED alone.
+
+        :param state: "on" or "off"
+        """
+        if state in ("on", "off") and self.jobs.full():
+            self.jobs.rejected += 1
+            return self.accepted(None)
+        if state == "on":
+            self.led.on()
+        elif state == "off":
+            self.led.off()
+        else:
+            return 404, "text/html", "404 Not Found"
+        self.notify_led()
+        return self.accepted(
+            self.jobs.submit("led " + state, self.publish_all, f"LED turned {state.upper()}")
+        )
 
-        elif path == "/publish/mqtt":
-            self.send_mqtt_message("Message from HTTP")
-            response_body = "Published to MQTT"
+    @ROUTES.get("/publish/{channel}")
+    async def http_publish(self, channel):
+        """
+        Queues a test message on one channel or on all of them.
 
+        :param channel: "all", "lora" or "mqtt"
+        """
+        if channel == "all":
+            publish = self.publish_all
+        elif channel == "lora":
+            publish = self.publish_lora
+        elif channel == "mqtt":
+            publish = self.publish_mqtt
         else:
-            response_body = "404 Not Found"
+            return 404, "text/html", "404 Not Found"
+        return self.accepted(
+            self.jobs.submit("publish " + channel, publish, "Message from HTTP")
+        )
 
-        response = f"HTTP/1.1 200 OK\r\nContent-Type: 
-                     text/html\r\n\r\n{response_body}"
-        client.send(response.encode())
-        client.close()
+    @ROUTES.get("/metrics")
+    async def http_metrics(self):
+        """
+        Prometheus scrape endpoint, streamed line by line (chunked)
+        instead of rendered into one string.
+        """
+        return 200, "text/plain; version=0.0.4; charset=utf-8", self.metrics.lines()
 
-    ################################################
+    @ROUTES.get("/lora/registers")
+    async def http_lora_registers(self):
+        """
+        Streams a dump of the SX127x registers, one "address value" line
+        each. The FIFO register (0x00) is skipped: reading it advances
+        the FIFO pointer. The registers are read under lora_lock, so the
+        dump never interleaves with a transmission on the SPI bus, and
+        streamed from that snapshot once the lock is released.
+        """
+        values = bytearray(0x7f)
+        async with self.lora_lock:
+            for address in range(1, 0x80):
+                values[address - 1] = self.lora.read_register(address)
+        return 200, "text/plain", self.lora_registers(values)
+
+    def lora_registers(self, values):
+        for address in range(1, 0x80):
+            yield "0x%02x 0x%02x\n" % (address, values[address - 1])
+
+    @ROUTES.get("/jobs/{job_id}")
+    async def http_job(self, job_id):
+        """
+        Returns the status of a background job as JSON.
+        """
+        job = self.jobs.get(int(job_id)) if job_id.isdigit() else None
+        if job is None:
+            return 404, "application/json", '{"error": "unknown job"}'
+        return 200, "application/json", json.dumps(job.to_dict())
 
-    ############ Process Http Requests #############
-    async def handle_http(self):
+    @ROUTES.post("/api/batch", body=True)
+    async def http_batch(self, body):
         """
-        Continuously accepts incoming connections on the HTTP server socket.
-        On each accepted connection, reads the request and delegates handling
-        to the handle_http_request method.
+        Runs a JSON array of commands in order, e.g.
+            [{"cmd": "led", "state": "on"},
+             {"cmd": "publish", "channel": "lora", "message": "hi"},
+             {"cmd": "status"}]
+        LED commands take effect at once. The publishes of the whole
+        batch become one background job: one LoRa frame (more only if
+        they exceed LORA_MAX_FRAME bytes) and one MQTT flush. A batch
+        that needs a job while the job queue is full gets 503 before any
+        command runs, so no LED is switched without its publish.
+
+        :return: {"results": [one result per command], "job": id or null}
         """
-        while True:
-            try:
-                client, addr = self.server_socket.accept()
-                print("Client connected from", addr)
-                request = client.recv(1024)
-                await self.handle_http_request(client, request)
-            except Exception as e:
-                print("HTTP handler error:", str(e))
-            await asyncio.sleep_ms(10)
+        try:
+            commands = json.loads(bytes(body))
+        except ValueError:
+            return 400, "application/json", '{"error": "body is not valid JSON"}'
+        if not isinstance(commands, list) or len(commands) > self.BATCH_MAX_COMMANDS:
+            return 400, "application/json", json.dumps(
+                {"error": "expected an array of at most %d commands" % self.BATCH_MAX_COMMANDS}
+            )
+        if self.jobs.full() and any(
+            isinstance(command, dict) and command.get("cmd") in ("led", "publish")
+            for command in commands
+        ):
+            self.jobs.rejected += 1
+            return 503, "application/json", '{"error": "job queue full"}'
+        lora, mqtt = [], []
+        results = [self.run_command(command, lora, mqtt) for command in commands]
+        job = None
+        if lora or mqtt:
+            # Cannot be refused: nothing ran since the check above
+            job = self.jobs.submit("batch", self.publish_batch, lora, mqtt)
+        return 200, "application/json", json.dumps(
+            {"results": results, "job": job.id if job else None}
+        )
+
+    def run_command(self, command, lora, mqtt):
+        """
+        Runs one batch command. Messages to publish are appended to the
+        lora and mqtt lists instead of being sent.
+
+        :return: Result dict of the command ("ok" plus details or "error")
+        """
+        if not isinstance(command, dict):
+            return {"ok": False, "error": "command must be an object"}
+        cmd = command.get("cmd")
+        if cmd == "led":
+            state = command.get("state")
+            if state == "on":
+                self.led.on()
+            elif state == "off":
+                self.led.off()
+            elif state == "toggle":
+                self.led.value(not self.led.value())
+            else:
+                return {"ok": False, "error": "state must be on, off or toggle"}
+            self.notify_led()
+            status = "ON" if self.led.value() else "OFF"
+            message = f"LED turned {status}"
+            lora.append(message)
+            mqtt.append(message)
+            return {"ok": True, "led": status, "queued": ["lora", "mqtt"]}
+        if cmd == "publish":
+            channel = command.get("channel", "all")
+            message = command.get("message", "Message from HTTP")
+            if channel not in ("all", "lora", "mqtt"):
+                return {"ok": False, "error": "channel must be all, lora or mqtt"}
+            if not isinstance(message, str):
+                return {"ok": False, "error": "message must be a string"}
+            queued = []
+            if channel != "mqtt":
+                lora.append(message)
+                queued.append("lora")
+            if channel != "lora":
+                mqtt.append(message)
+                queued.append("mqtt")
+            return {"ok": True, "queued": queued}
+        if cmd == "status":
+            return {
+                "ok": True,
+                "led": "ON" if self.led.value() else "OFF",
+                "mqtt_connected": self.mqtt_link.connected,
+                "mqtt_queue_depth": self.mqtt_link.queue_depth,
+            }
+        return {"ok": False, "error": "unknown command"}
+
+    def accepted(self, job):
+        """
+        Builds the response for a submitted job: 202 with its id and
+        status URL, or 503 when the job queue is full.
+        """
+        if job is None:
+            return 503, "application/json", '{"error": "job queue full"}'
+        return 202, "application/json", json.dumps(
+            {"job": job.id, "status": "/jobs/%d" % job.id}
+        )
 
     ################################################
 
     ############# Sends LoRa message ###############
-    def send_lora_message(self, message):
+    async def send_lora_message(self, message):
         """
-        Sends a message via the LoRa module.
+        Sends a message via the LoRa module. Other tasks keep running
+        while the packet is on air.
 
         :param message: The string message to be sent via LoRa
+        :return: True when the message was transmitted
         """
         try:
             print(f"Sending LoRa message: {message}")
-            self.lora.println(message)
+            async with self.lora_lock:
+                start = ticks_ms()
+                await self.lora.println_async(message)
+                self.lora_airtime.observe(ticks_diff(ticks_ms(), start))
+            self.lora_tx.inc()
+            self.events.publish("lora", f"Sent: {message}")
+            return True
         except Exception as e:
             print(f"LoRa send error: {str(e)}")
+            self.lora_tx_errors.inc()
+            self.events.publish("lora", f"Send error: {str(e)}")
+            return False
     
     ################################################
 
     ############# Sends MQTT message ###############
     def send_mqtt_message(self, message):
         """
-        Publishes a message to the MQTT broker.
+        Queues a message for the MQTT broker. The supervisor task sends
+        it as soon as the link is up, so this never blocks on the network.
 
         :param message: The string message to be published over MQTT
+        :return: False when the queue was full and the oldest message
+                 was dropped to make room
         """
-        try:
-            print(f"Publishing MQTT message: {message}")
-            self.mqtt.publish(self.MQTT_TOPIC, message.encode())
-        except Exception as e:
-            print(f"MQTT publish error: {str(e)}")
-            try:
-                self.mqtt.connect()
-                self.mqtt.publish(self.MQTT_TOPIC, message.encode())
-            except:
-                print("MQTT reconnection failed")
+        print(f"Publishing MQTT message: {message}")
+        if self.mqtt_link.publish(self.MQTT_TOPIC, message.encode()):
+            self.mqtt_queued.inc()
+            self.events.publish("mqtt", f"Queued: {message}")
+            return True
+        self.mqtt_overflow.inc()
+        print("MQTT queue full, oldest message dropped")
+        self.events.publish("mqtt", f"Queue full, oldest dropped: {message}")
+        return False
      ################################################
 
     ###### Publish a message in all the channels ######
@@ -373,30 +604,110 @@ class UnifiedPublisher:
         Publishes the same message to both LoRa and MQTT.
 
         :param message: The string message to be published
+        :return: {"lora": transmitted, "mqtt": queued without dropping}
         """
+        lora = mqtt = False
         try:
-            self.send_lora_message(message)
-            self.send_mqtt_message(message)
+            lora = await self.send_lora_message(message)
+            mqtt = self.send_mqtt_message(message)
             print("Published to all protocols:", message)
+            self.events.publish("publish", f"All protocols: {message}")
         except Exception as e:
             print("Error publishing to all:", str(e))
+            self.events.publish("publish", f"Error: {str(e)}")
+        return {"lora": lora, "mqtt": mqtt}
+
+    async def publish_batch(self, lora_messages, mqtt_messages):
+        """
+        Publishes the messages collected from one command batch. The MQTT
+        messages are queued back to back, so the supervisor sends them in
+        a single flush; the LoRa messages are joined by newlines into as
+        few frames as LORA_MAX_FRAME allows (usually one).
+
+        :return: {"lora_frames": frames, "lora_sent": frames sent,
+                  "mqtt": messages queued without dropping}
+        """
+        mqtt = 0
+        for message in mqtt_messages:
+            if self.send_mqtt_message(message):
+                mqtt += 1
+        frames = []
+        frame = ""
+        for message in lora_messages:
+            joined = frame + "\n" + message if frame else message
+            if frame and len(joined.encode()) > self.LORA_MAX_FRAME:
+                frames.append(frame)
+                joined = message
+            frame = joined
+        if frame:
+            frames.append(frame)
+        sent = 0
+        for frame in frames:
+            if await self.send_lora_message(frame):
+                sent += 1
+        return {"lora_frames": len(frames), "lora_sent": sent, "mqtt": mqtt}
+
+    async def publish_lora(self, message):
+        return {"lora": await self.send_lora_message(message)}
+
+    async def publish_mqtt(self, message):
+        return {"mqtt": self.send_mqtt_message(message)}
 
 
      ################################################
 
+    ###### Push state changes to the control panel ######
+    def notify_led(self):
+        """
+        Pushes the LED state to every open panel; retained, so panels
+        that connect later start with it.
+        """
+        self.events.publish("led", "ON" if self.led.value() else "OFF", retain=True)
+
+    def notify_job(self, job):
+        """
+        Pushes the final status of a background job to the panels.
+        """
+        self.events.publish("job", json.dumps(job.to_dict()))
+
+    async def watch_links(self):
+        """
+        Pushes the MQTT link state (connected, queued messages) whenever
+        it changes. Reads supervisor state only, no network traffic.
+        """
+        last = None
+        while True:
+            state = (self.mqtt_link.connected, self.mqtt_link.queue_depth)
+            if state != last:
+                last = state
+                self.events.publish(
+                    "link",
+                    "MQTT %s, %d queued" % ("connected" if state[0] else "disconnected", state[1]),
+                    retain=True,
+                )
+            await asyncio.sleep_ms(self.LINK_CHECK_MS)
+
+    ################################################
+
     ###### Function to run the unified publisher ######
     async def run(self):
         """
         Main asynchronous loop that creates tasks for:
+        - MQTT link supervision
         - Button checking
         - Message publishing
-        - HTTP handling
+        - Background jobs (publishes requested over HTTP)
+        - Link state events for the panel
+        - HTTP serving
 
         Runs indefinitely, allowing the tasks to operate concurrently.
         """
+        asyncio.create_task(self.mqtt_link.run())
         asyncio.create_task(self.check_button())
         asyncio.create_task(self.publish_messages())
-        asyncio.create_task(self.handle_http())
+        asyncio.create_task(self.jobs.run())
+        asyncio.create_task(self.watch_links())
+        await self.http.start()
 
         while True:
             await asyncio.sleep(1)
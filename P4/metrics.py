@@ -0,0 +1,186 @@
+########## Metrics registry ##########
+class Registry:
+    """
+    Counters, gauges and histograms rendered in the Prometheus text
+    format, so a node can be scraped at /metrics.
+
+    Every series is registered once at startup and gets fixed slots in
+    one values list; recording only adds to a slot (histograms scan a
+    short tuple of bucket bounds), so with integer values nothing is
+    allocated on the hot path. Series can also be read from existing
+    state at scrape time (fn), e.g. supervisor counters or gc.mem_free.
+
+    Usage:
+        metrics = Registry()
+        sent = metrics.counter("lora_tx_total", "LoRa packets sent")
+        airtime = metrics.histogram("lora_airtime_ms", "Time on air")
+        metrics.gauge("mem_free_bytes", "Free heap", fn=gc.mem_free)
+
+        sent.inc()
+        airtime.observe(elapsed_ms)
+        body = metrics.render()  # or stream metrics.lines()
+    """
+
+    def __init__(self):
+        self.values = []
+        # (name, type, help, [series]) in registration order
+        self.families = []
+        self._by_name = {}
+
+    def _family(self, name, kind, help):
+        family = self._by_name.get(name)
+        if family is None:
+            family = (name, kind, help, [])
+            self._by_name[name] = family
+            self.families.append(family)
+        elif family[1] != kind:
+            raise ValueError("%s already registered as a %s" % (name, family[1]))
+        return family[3]
+
+    def _slots(self, n):
+        slot = len(self.values)
+        self.values.extend([0] * n)
+        return slot
+
+    ###### Registration ######
+    def counter(self, name, help, labels=None, fn=None):
+        """
+        Registers a counter series.
+
+        :param labels: {label: value} of this series; several series may
+                       share a name with different labels
+        :param fn: Read the value from fn() at scrape time instead
+        """
+        series = Counter(self, name, _labels(labels), fn)
+        self._family(name, "counter", help).append(series)
+        return series
+
+    def gauge(self, name, help, labels=None, fn=None):
+        series = Gauge(self, name, _labels(labels), fn)
+        self._family(name, "gauge", help).append(series)
+        return series
+
+    def histogram(self, name, help, start=1, factor=2, count=12, labels=None):
+        """
+        Registers a histogram with count log-spaced buckets, the first
+        one up to start and each following one factor times wider (plus
+        +Inf), e.g. 1, 2, 4 ... 2048 ms.
+        """
+        bounds = tuple(start * factor ** k for k in range(count))
+        series = Histogram(self, name, _labels(labels), bounds)
+        self._family(name, "histogram", help).append(series)
+        return series
+
+    ##########################
+
+    ###### Exposition ######
+    def lines(self):
+        """
+        Yields all series in the Prometheus text format (version 0.0.4),
+        line by line, so a scrape can be streamed instead of built.
+        """
+        for name, kind, help, series in self.families:
+            yield "# HELP %s %s\n# TYPE %s %s\n" % (name, help, name, kind)
+            for s in series:
+                yield from s.lines()
+
+    def render(self):
+        return "".join(self.lines())
+
+    ########################
+
+######################################
+
+
+def _labels(labels):
+    """
+    Formats {label: value} once at registration, e.g. 'code="2xx"'.
+    """
+    if not labels:
+        return ""
+    return ",".join('%s="%s"' % (k, v) for k, v in sorted(labels.items()))
+
+
+def _series(name, labels, extra=""):
+    if labels and extra:
+        return "%s{%s,%s}" % (name, labels, extra)
+    if labels or extra:
+        return "%s{%s}" % (name, labels or extra)
+    return name
+
+
+########## Series ##########
+class Counter:
+    """
+    Monotonic count; inc() adds to its slot.
+    """
+
+    def __init__(self, registry, name, labels, fn):
+        self.values = registry.values
+        self.slot = registry._slots(1)
+        self.key = _series(name, labels)
+        self.fn = fn
+
+    def inc(self, n=1):
+        self.values[self.slot] += n
+
+    def value(self):
+        return self.fn() if self.fn is not None else self.values[self.slot]
+
+    def lines(self):
+        yield "%s %s\n" % (self.key, self.value())
+
+
+class Gauge(Counter):
+    """
+    Value that goes up and down; set() overwrites its slot.
+    """
+
+    def set(self, value):
+        self.values[self.slot] = value
+
+    def dec(self, n=1):
+        self.values[self.slot] -= n
+
+
+class Histogram:
+    """
+    Distribution over fixed bucket bounds. Bucket counts, the sum and
+    the count live in consecutive slots; buckets are stored
+    non-cumulative and summed up when rendered.
+    """
+
+    def __init__(self, registry, name, labels, bounds):
+        self.values = registry.values
+        self.bounds = bounds
+        # len(bounds) buckets, +Inf, sum, count
+        self.slot = registry._slots(len(bounds) + 3)
+        self.name = name
+        self.labels = labels
+
+    def observe(self, value):
+        values = self.values
+        i = self.slot
+        for bound in self.bounds:
+            if value <= bound:
+                break
+            i += 1
+        values[i] += 1
+        end = self.slot + len(self.bounds) + 1
+        values[end] += value
+        values[end + 1] += 1
+
+    def lines(self):
+        values = self.values
+        cumulative = 0
+        i = self.slot
+        for bound in self.bounds:
+            cumulative += values[i]
+            yield "%s %d\n" % (_series(self.name + "_bucket", self.labels, 'le="%s"' % bound), cumulative)
+            i += 1
+        cumulative += values[i]
+        yield "%s %d\n" % (_series(self.name + "_bucket", self.labels, 'le="+Inf"'), cumulative)
+        yield "%s %s\n" % (_series(self.name + "_sum", self.labels), values[i + 1])
+        yield "%s %d\n" % (_series(self.name + "_count", self.labels), values[i + 2])
+
+############################
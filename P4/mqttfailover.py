@@ -0,0 +1,190 @@
+############### Imports ###############
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+from math import log
+
+from mqttsupervisor import MQTTSupervisor
+
+#######################################
+
+
+#### Stable topic hash (FNV-1a + murmur3 finalizer, 32 bit) ####
+def topic_hash(topic, salt):
+    """
+    Hash used for topic sharding. Unlike hash(), it is the same on every
+    node and firmware build, so a topic maps to the same broker fleet-wide.
+    The salt (broker index) is mixed in by the finalizer so the scores of
+    different brokers for one topic are independent.
+    """
+    h = 0x811C9DC5
+    for b in topic:
+        h = ((h ^ b) * 0x01000193) & 0xFFFFFFFF
+    h ^= (salt * 0x9E3779B9) & 0xFFFFFFFF
+    h ^= h >> 16
+    h = (h * 0x85EBCA6B) & 0xFFFFFFFF
+    h ^= h >> 13
+    h = (h * 0xC2B2AE35) & 0xFFFFFFFF
+    return h ^ h >> 16
+
+
+def shard_score(topic, i, weight):
+    """
+    Weighted rendezvous score of broker i for topic: -weight / ln(u),
+    with u the hash mapped uniformly into (0, 1). The broker with the
+    highest score wins, so each one gets a share of the topics
+    proportional to its weight. Only the top 23 bits of the hash are
+    used: u must stay below 1.0 in single precision floats too.
+    """
+    u = ((topic_hash(topic, i) >> 9) + 0.5) / 8388608
+    return -weight / log(u)
+
+
+#################################################################
+
+
+########## Multi-broker client ##########
+class MQTTFailover:
+    """
+    Spreads publishes over several brokers, each kept connected by its
+    own MQTTSupervisor (so every broker is health-checked continuously
+    through its keepalive round trip time).
+
+    Modes:
+    - "failover": every message goes to the first healthy broker in
+      list order; the others are hot standbys.
+    - "weighted": messages are distributed over the healthy brokers in
+      proportion to their weights (smooth weighted round robin).
+    - "shard": each topic is pinned to one healthy broker by weighted
+      rendezvous hashing, which keeps per-topic ordering; only the
+      topics of a failed broker move elsewhere.
+
+    A broker is healthy while it is connected and its last PINGRESP
+    round trip was below max_rtt_ms. Messages still queued on a broker
+    that turns unhealthy are moved to a healthy one, so nothing queued
+    is lost by failing over.
+
+    Usage:
+        link = MQTTFailover([MQTTClient(cid, "10.0.0.1", keepalive=30),
+                             MQTTClient(cid, "10.0.0.2", keepalive=30)])
+        asyncio.create_task(link.run())
+        link.publish(b"notification", b"hello")
+    """
+
+    def __init__(self, clients, weights=None, mode="failover",
+                 max_rtt_ms=2000, check_ms=500, **supervisor_args):
+        """
+        :param clients: One MQTTClient per broker, in priority order
+        :param weights: Relative weight of each broker (default all 1)
+        :param mode: "failover", "weighted" or "shard"
+        :param max_rtt_ms: RTT above which a broker counts as unhealthy
+        :param check_ms: How often queued messages are checked for
+                         brokers that turned unhealthy
+        :param supervisor_args: Passed on to each MQTTSupervisor
+        """
+        assert mode in ("failover", "weighted", "shard")
+        self.links = [MQTTSupervisor(c, **supervisor_args) for c in clients]
+        self.weights = list(weights) if weights else [1] * len(clients)
+        assert len(self.weights) == len(self.links)
+        self.mode = mode
+        self.max_rtt_ms = max_rtt_ms
+        self.check_ms = check_ms
+        self.failovers = 0
+        self._credit = [0] * len(self.links)
+
+    ###############################
+
+    ###### Broker selection ######
+    def healthy(self, i):
+        link = self.links[i]
+        return link.connected and link.client.rtt_ms < self.max_rtt_ms
+
+    def _pick(self, topic):
+        """
+        Returns the index of the broker to use for topic. When no broker
+        is healthy the first one is used, so the message waits in its
+        queue until some broker comes back.
+        """
+        up = [i for i in range(len(self.links)) if self.healthy(i)]
+        if not up:
+            return 0
+        if self.mode == "failover":
+            return up[0]
+        if self.mode == "shard":
+            best = up[0]
+            best_score = -1
+            for i in up:
+                score = shard_score(topic, i, self.weights[i])
+                if score > best_score:
+                    best, best_score = i, score
+            return best
+        # Smooth weighted round robin over the healthy brokers
+        total = 0
+        best = up[0]
+        for i in up:
+            self._credit[i] += self.weights[i]
+            total += self.weights[i]
+            if self._credit[i] > self._credit[best]:
+                best = i
+        self._credit[best] -= total
+        return best
+
+    ###############################
+
+    ###### Publisher facing API ######
+    def publish(self, topic, msg, retain=False, qos=0):
+        return self.links[self._pick(topic)].publish(topic, msg, retain, qos)
+
+    def subscribe(self, topic, qos=0, f=None):
+        """
+        Subscribes on every broker, as commands may arrive through any.
+        """
+        for link in self.links:
+            link.subscribe(topic, qos, f)
+
+    @property
+    def connected(self):
+        return any(link.connected for link in self.links)
+
+    @property
+    def queue_depth(self):
+        return sum(len(link.queue) for link in self.links)
+
+    ###############################
+
+    ###### Failover task ######
+    def _rescue(self):
+        """
+        Moves messages queued on unhealthy brokers to healthy ones.
+        """
+        for i, link in enumerate(self.links):
+            if not link.queue or self.healthy(i):
+                continue
+            moved = False
+            while link.queue:
+                topic, msg, qos, retain = link.queue[0]
+                j = self._pick(topic)
+                if j == i or not self.healthy(j):
+                    break
+                link.queue.pop(0)
+                self.links[j].publish(topic, msg, retain, qos)
+                moved = True
+            if moved:
+                self.failovers += 1
+
+    async def run(self):
+        """
+        Starts one supervisor task per broker, then periodically rescues
+        messages stuck on brokers that went down.
+        """
+        for link in self.links:
+            asyncio.create_task(link.run())
+        while True:
+            await asyncio.sleep(self.check_ms / 1000)
+            self._rescue()
+
+    ###############################
+
+#######################################
@@ -0,0 +1,299 @@
+############### Imports ###############
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+try:
+    import urandom as random
+except ImportError:
+    import random
+
+from ticks import ticks_diff, ticks_ms
+from umqttsimple import MQTTException
+
+#######################################
+
+
+########## MQTT Link Supervisor ##########
+class MQTTSupervisor:
+    """
+    Keeps an MQTTClient connected from a background task.
+
+    Publishers never talk to the socket directly: publish() only appends
+    the message to a bounded queue and returns immediately, so a broker
+    outage never blocks the caller. The supervisor task drains the queue
+    while the link is up and, when any operation fails, reconnects with
+    jittered exponential backoff.
+
+    The client's socket calls are blocking, so every one of them is
+    bounded by io_timeout_ms: a broker that accepts TCP but never answers
+    (or stops reading) makes the call fail with OSError after at most
+    that long, instead of freezing the event loop for good.
+
+    Any other exception (a bug, str credentials, a payload that cannot be
+    encoded) is logged and counted in errors instead of ending the task.
+    A failed connect backs off as usual; a failed send discards the
+    queued batch, which would only fail again, and backs off too.
+
+    Connections are opened with clean_session=False so the broker keeps
+    subscriptions and QoS 1 state across reconnects. If the broker reports
+    that no session was present, every recorded subscription is sent again.
+
+    When the client has a non-zero keepalive, a second task sends PINGREQ
+    once nothing was sent or nothing was received for the keepalive
+    interval and declares the connection dead if no PINGRESP arrives
+    within ping_timeout_ms. The last round trip time is kept in
+    client.rtt_ms.
+
+    Usage:
+        link = MQTTSupervisor(MQTTClient(client_id, server))
+        asyncio.create_task(link.run())
+        link.publish(b"notification", b"hello")
+    """
+
+    def __init__(self, client, queue_size=32, min_backoff_ms=500,
+                 max_backoff_ms=60000, poll_ms=100, ping_timeout_ms=None,
+                 io_timeout_ms=3000):
+        """
+        :param client: The MQTTClient instance to supervise
+        :param queue_size: Maximum number of messages kept while offline;
+                           the oldest message is dropped when full (and
+                           counted in dropped, like a discarded batch)
+        :param min_backoff_ms: First reconnect delay
+        :param max_backoff_ms: Upper bound for the reconnect delay
+        :param poll_ms: How often inbound messages are polled when idle
+        :param ping_timeout_ms: How long to wait for PINGRESP before the
+                                link is declared dead; defaults to half
+                                the client keepalive
+        :param io_timeout_ms: Longest a single socket operation (connect,
+                              write, read) may block; set as the client's
+                              socket_timeout unless it already has one
+        """
+        self.client = client
+        self.queue_size = queue_size
+        self.min_backoff_ms = min_backoff_ms
+        self.max_backoff_ms = max_backoff_ms
+        self.poll_ms = poll_ms
+        if ping_timeout_ms is None:
+            ping_timeout_ms = client.keepalive * 500
+        self.ping_timeout_ms = ping_timeout_ms
+        if client.socket_timeout is None:
+            client.socket_timeout = io_timeout_ms / 1000
+
+        self.queue = []
+        self.subscriptions = {}
+        self._pending_subs = False
+        self.connected = False
+        self.reconnects = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.pings = 0
+        self.ping_timeouts = 0
+        self.errors = 0
+
+        self._wake = asyncio.Event()
+
+    ###############################
+
+    ###### Publisher facing API ######
+    def publish(self, topic, msg, retain=False, qos=0):
+        """
+        Enqueues a message for the supervisor task and returns at once.
+
+        :return: False if the queue was full and the oldest message
+                 had to be dropped to make room, True otherwise
+        """
+        accepted = True
+        if len(self.queue) >= self.queue_size:
+            self.queue.pop(0)
+            self.dropped += 1
+            accepted = False
+        self.queue.append((topic, msg, qos, retain))
+        self._wake.set()
+        return accepted
+
+    def subscribe(self, topic, qos=0, f=None):
+        """
+        Records a subscription so it survives reconnects. The SUBSCRIBE
+        packet itself is sent by the supervisor task.
+
+        :param f: Optional handler for messages matching this topic filter
+                  (MQTT "+" and "#" wildcards allowed)
+        """
+        if f is not None:
+            self.client.router.add(topic, f)
+        self.subscriptions[topic] = qos
+        self._pending_subs = True
+        self._wake.set()
+
+    ###############################
+
+    ###### Connection handling ######
+    def _close_socket(self):
+        try:
+            self.client.sock.close()
+        except Exception:
+            pass
+
+    def _drop(self, reason):
+        """
+        Marks the link as down and releases the socket.
+        """
+        print("MQTT link down:", reason)
+        self.connected = False
+        self._close_socket()
+
+    def _resubscribe(self):
+        for topic, qos in self.subscriptions.items():
+            self.client.subscribe(topic, qos)
+        self._pending_subs = False
+
+    def _backoff_ms(self, delay):
+        """
+        Returns a delay in [delay/2, delay] ("equal jitter"), so a fleet
+        of nodes does not reconnect in lockstep after a broker restart.
+        """
+        half = delay // 2
+        return half + random.getrandbits(16) % (half + 1)
+
+    async def _reconnect(self):
+        """
+        Tries to connect until it succeeds, sleeping with jittered
+        exponential backoff between attempts.
+        """
+        delay = self.min_backoff_ms
+        while True:
+            try:
+                session_present = self.client.connect(clean_session=False)
+                if not session_present or self._pending_subs:
+                    self._resubscribe()
+                self.connected = True
+                self.reconnects += 1
+                print("MQTT Connected! (session present: %d)" % session_present)
+                return
+            except (OSError, MQTTException, IndexError, AssertionError) as e:
+                print("MQTT connect failed:", str(e))
+                self._close_socket()
+            except Exception as e:
+                # Not the link but the configuration: retrying will not
+                # help, but the error must show up in the log and stats
+                self.errors += 1
+                print("MQTT connect failed: %s: %s" % (type(e).__name__, e))
+                self._close_socket()
+            await asyncio.sleep(self._backoff_ms(delay) / 1000)
+            delay = min(delay * 2, self.max_backoff_ms)
+
+    ###############################
+
+    ###### Queue draining ######
+    def _flush(self):
+        """
+        Sends every queued message in one batch (a single socket write,
+        see MQTTClient.publish_many). Messages are removed only after the
+        batch completed, so QoS 1 messages whose PUBACK never came back
+        are sent again after the reconnect.
+        """
+        if not self.queue:
+            return
+        results = self.client.publish_many(self.queue)
+        self.queue = []
+        self.rejected += results.count(False)
+
+    async def _idle(self):
+        # Poll faster while a PINGRESP is due so rtt_ms is not inflated
+        # by the idle polling interval.
+        timeout_ms = self.poll_ms
+        if self.client.ping_outstanding:
+            timeout_ms = min(timeout_ms, 5)
+        try:
+            await asyncio.wait_for(self._wake.wait(), timeout_ms / 1000)
+        except asyncio.TimeoutError:
+            pass
+        self._wake.clear()
+
+    ###############################
+
+    ###### Keepalive task ######
+    async def keepalive(self):
+        """
+        Keepalive loop:
+        1) Send PINGREQ once nothing was sent, or nothing was received,
+           for the keepalive interval. A node publishing QoS 0 faster
+           than that never goes quiet, but hears nothing back from the
+           broker: without the second condition it would never ping and
+           a dead NAT mapping would go unnoticed.
+        2) If the PINGRESP is still missing after ping_timeout_ms, drop
+           the link so the supervisor task reconnects right away instead
+           of waiting for a publish to fail on a half-open socket.
+
+        This task only runs while the loop does. A write that blocks on a
+        dead link with a full send buffer is not left to it: the write
+        itself fails after io_timeout_ms and run() drops the link.
+        """
+        interval_ms = self.client.keepalive * 1000
+        if not interval_ms:
+            return
+        tick_s = min(interval_ms, self.ping_timeout_ms) / 4000
+        while True:
+            await asyncio.sleep(tick_s)
+            if not self.connected:
+                continue
+            client = self.client
+            try:
+                if client.ping_outstanding:
+                    waited = ticks_diff(ticks_ms(), client.ping_sent)
+                    if waited > self.ping_timeout_ms:
+                        self.ping_timeouts += 1
+                        self._drop("PINGRESP timeout")
+                        self._wake.set()
+                elif client.idle_ms() >= interval_ms or client.rx_idle_ms() >= interval_ms:
+                    client.ping()
+                    self.pings += 1
+                    self._wake.set()
+            except OSError as e:
+                self._drop(str(e))
+                self._wake.set()
+
+    ###############################
+
+    ###### Supervisor task ######
+    async def run(self):
+        """
+        Supervisor loop (also starts the keepalive task):
+        1) Reconnect (with backoff) whenever the link is down.
+        2) Send pending subscriptions and queued messages.
+        3) Poll for inbound messages, then sleep until woken or
+           until poll_ms elapsed.
+        Unexpected exceptions back off with the reconnect delays before
+        the link is opened again.
+        """
+        asyncio.create_task(self.keepalive())
+        delay = self.min_backoff_ms
+        while True:
+            if not self.connected:
+                await self._reconnect()
+            try:
+                if self._pending_subs:
+                    self._resubscribe()
+                self._flush()
+                if self.subscriptions or self.client.ping_outstanding:
+                    self.client.check_msg()
+            except (OSError, MQTTException, IndexError, AssertionError) as e:
+                self._drop(str(e))
+                continue
+            except Exception as e:
+                # Sending the same batch again would fail the same way
+                self.errors += 1
+                self.dropped += len(self.queue)
+                self.queue = []
+                self._drop("%s: %s" % (type(e).__name__, e))
+                await asyncio.sleep(self._backoff_ms(delay) / 1000)
+                delay = min(delay * 2, self.max_backoff_ms)
+                continue
+            delay = self.min_backoff_ms
+            await self._idle()
+
+    ###############################
+
+#######################################
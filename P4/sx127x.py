@@ -1,6 +1,13 @@
 import gc
 from time import sleep
 
+from ticks import ticks_diff, ticks_ms
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
 from machine import SPI, Pin
 
 PA_OUTPUT_RFO_PIN = 0
@@ -185,6 +192,41 @@ class SX127x:
 
         self.collect_garbage()
 
+    async def end_packet_async(self, poll_ms = 5, timeout_ms = None):
+        # same as end_packet, but yields to other tasks while the packet
+        # is on air (tens of ms up to seconds at high spreading factors).
+        # A radio that never raises TX_DONE is put back in standby and
+        # OSError is raised after timeout_ms (default: twice the computed
+        # airtime plus 100 ms), so callers holding a lock get it back.
+        if timeout_ms is None:
+            timeout_ms = 2 * self.airtime_ms(self.read_register(REG_PAYLOAD_LENGTH)) + 100
+        start = ticks_ms()
+        self.write_register(REG_OP_MODE, MODE_LONG_RANGE_MODE | MODE_TX)
+
+        while self.read_register(REG_IRQ_FLAGS) & IRQ_TX_DONE_MASK == 0:
+            if ticks_diff(ticks_ms(), start) > timeout_ms:
+                self.standby()
+                self.write_register(REG_IRQ_FLAGS, 0xff)
+                raise OSError("LoRa TX_DONE timeout after %d ms" % timeout_ms)
+            await asyncio.sleep(poll_ms / 1000)
+
+        self.write_register(REG_IRQ_FLAGS, IRQ_TX_DONE_MASK)
+
+        self.collect_garbage()
+
+    def airtime_ms(self, size):
+        # time on air of a size byte payload with the configured
+        # parameters (SX1276 datasheet, section 4.1.1.7)
+        p = self._parameters
+        sf = p['spreading_factor']
+        symbol_ms = 1000 * 2**sf / p['signal_bandwidth']
+        ldro = 1 if symbol_ms > 16 else 0
+        implicit = 1 if self._implicit_header_mode else 0
+        cr = min(max(p['coding_rate'], 5), 8) - 4
+        bits = 8 * size - 4 * sf + 28 + 16 * p['enable_CRC'] - 20 * implicit
+        symbols = 8 + max(-(-bits // (4 * (sf - 2 * ldro))) * (cr + 4), 0)
+        return (p['preamble_length'] + 4.25 + symbols) * symbol_ms
+
     def write(self, buffer):
         currentLength = self.read_register(REG_PAYLOAD_LENGTH)
         size = len(buffer)
@@ -208,9 +250,7 @@ class SX127x:
 
         self.begin_packet(implicit_header)
 
-        if isinstance(msg, str):
-            message = msg.encode()
-            
+        message = msg.encode() if isinstance(msg, str) else msg
         self.write(message)
 
         self.end_packet()
@@ -218,6 +258,21 @@ class SX127x:
         self.set_lock(False) # unlock when done writing
         self.collect_garbage()
 
+    async def println_async(self, msg, implicit_header = False):
+        # println for uasyncio applications: the event loop keeps running
+        # until TX_DONE instead of busy-waiting on the IRQ register
+        self.set_lock(True)
+        try:
+            self.begin_packet(implicit_header)
+
+            message = msg.encode() if isinstance(msg, str) else msg
+            self.write(message)
+
+            await self.end_packet_async()
+        finally:
+            self.set_lock(False)
+        self.collect_garbage()
+
     def get_irq_flags(self):
         irq_flags = self.read_register(REG_IRQ_FLAGS)
         self.write_register(REG_IRQ_FLAGS, irq_flags)
@@ -0,0 +1,685 @@
+"""
+Concurrent request benchmark for the HTTP servers of Session 1 and 4 (CPython).
+
+Runs the real P1 request handlers (main.router.dispatch) behind
+httpserver.HTTPServer on loopback. The MicroPython-only modules it
+imports (machine, network, uasyncio) are replaced by a small shim, so
+no hardware is needed. Client threads send GET requests concurrently
+while a ticker task in the server's event loop records how late it is
+woken up every TICK_MS, which is what a button polling or LoRa task on
+the device would experience. For every case it reports:
+- requests/s and p50/p99 request latency
+- responses rejected with 503 (connection cap reached)
+- p99 and maximum event loop lag
+
+--server blocking runs the previous accept loop (blocking accept() and
+recv(1024) inside a coroutine) for comparison. --mode selects how the
+clients use connections: "close" opens a new connection per request,
+"keep-alive" sends all requests of a client over one persistent
+connection and "pipeline" additionally sends PIPELINE_DEPTH requests
+before reading their responses.
+
+--parser instead measures the request parser alone: how many typical
+browser requests per second httpserver.HTTPRequest parses from a
+stream (delivered whole or in PARSER_CHUNK byte pieces), against the
+readline() header loop the server used before.
+
+--router measures route lookups per second of httpserver.Router for
+ROUTE_COUNTS routes, against an if/elif chain over the same paths.
+
+--stream measures serving STREAM_SIZES byte text bodies, rendered into
+one string against yielded line by line (sent chunked from the
+server's preallocated send buffer): responses/s and the peak memory
+traced (tracemalloc) while serving, which is what has to fit in the
+heap of the board.
+
+Results are printed; with --output they are also written as JSON, so
+runs can be compared over time:
+    python3 tools/bench_http.py --output before.json
+    python3 tools/bench_http.py --output after.json --compare before.json
+"""
+
+############### Imports ###############
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+import types
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "P1"))
+
+#######################################
+
+
+######## MicroPython shim ########
+class FakePin:
+    OUT = 1
+    IN = 0
+
+    def __init__(self, pin, mode=None):
+        self._value = 0
+
+    def value(self, v=None):
+        if v is None:
+            return self._value
+        self._value = 1 if v else 0
+
+    def on(self):
+        self._value = 1
+
+    def off(self):
+        self._value = 0
+
+
+def install_shim():
+    """
+    Makes `machine`, `network` and `uasyncio` importable on CPython.
+    """
+    machine = types.ModuleType("machine")
+    machine.Pin = FakePin
+    sys.modules["machine"] = machine
+    sys.modules["network"] = types.ModuleType("network")
+    sys.modules["uasyncio"] = asyncio
+
+
+install_shim()
+
+import httpserver  # noqa: E402
+import main as p1  # noqa: E402
+
+# Keep per-request logging out of the measurements
+p1.print = httpserver.print = lambda *args: None
+
+##################################
+
+######## Sweep configuration ########
+CLIENTS = (1, 8, 32)
+REQUESTS_PER_CLIENT = 200
+MAX_CONNECTIONS = 4
+TICK_MS = 10
+PATHS = (b"/on", b"/off")
+PIPELINE_DEPTH = 8
+MODES = ("close", "keep-alive", "pipeline")
+
+# A panel request as a browser sends it
+BROWSER_REQUEST = (
+    b"GET /led/status?t=1712345678 HTTP/1.1\r\n"
+    b"Host: 192.168.1.50\r\n"
+    b"User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:124.0) Gecko/20100101 Firefox/124.0\r\n"
+    b"Accept: text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8\r\n"
+    b"Accept-Language: en-US,en;q=0.5\r\n"
+    b"Accept-Encoding: gzip, deflate\r\n"
+    b"Connection: keep-alive\r\n"
+    b"Referer: http://192.168.1.50/\r\n"
+    b"\r\n"
+)
+PARSER_REQUESTS = 20000
+PARSER_CHUNK = 64
+
+ROUTE_COUNTS = (6, 50, 200)
+ROUTER_LOOKUPS = 100000
+
+STREAM_SIZES = (4096, 65536)
+STREAM_LINE = 32
+STREAM_RESPONSES = 20
+
+QUICK = {"clients": (1, 8), "requests": 50, "parser_requests": 2000, "router_lookups": 10000,
+         "stream_responses": 5}
+
+#####################################
+
+
+########## Servers under test ##########
+async def blocking_server(sock):
+    """
+    The accept loop the servers used before: blocking accept() and
+    recv(1024) inside a coroutine.
+    """
+    while True:
+        cl, _ = sock.accept()
+        request = cl.recv(1024)
+        parts = request.split()
+        status, content_type, body = await p1.router.dispatch(parts[0], parts[1])
+        cl.send(b"HTTP/1.1 %d OK\r\nContent-Type: %s\r\n\r\n%s"
+                % (status, content_type.encode(), body.encode()))
+        cl.close()
+
+
+class ServerThread(threading.Thread):
+    """
+    Runs the server and the lag ticker in an event loop of their own.
+    """
+
+    def __init__(self, kind, max_connections):
+        super().__init__(daemon=True)
+        self.kind = kind
+        self.max_connections = max_connections
+        self.lags = []
+        self.last_tick = time.perf_counter()
+        self.ready = threading.Event()
+        self.port = None
+        self.server = None
+
+    async def ticker(self):
+        while True:
+            await asyncio.sleep(TICK_MS / 1000)
+            now = time.perf_counter()
+            self.lags.append((now - self.last_tick) * 1000 - TICK_MS)
+            self.last_tick = now
+
+    def lag_ms(self):
+        """
+        Returns the recorded lags plus the time since the last tick, so a
+        loop that never got to tick during a case still shows its stall.
+        """
+        now = time.perf_counter()
+        return self.lags + [max(0.0, (now - self.last_tick) * 1000 - TICK_MS)]
+
+    async def main(self):
+        if self.kind == "blocking":
+            sock = socket.socket()
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(("127.0.0.1", 0))
+            sock.listen(1)
+            self.port = sock.getsockname()[1]
+            asyncio.create_task(self.ticker())
+            self.ready.set()
+            await blocking_server(sock)
+        else:
+            self.server = httpserver.HTTPServer(
+                p1.router.dispatch, host="127.0.0.1", port=0,
+                max_connections=self.max_connections,
+            )
+            await self.server.start()
+            self.port = self.server.server.sockets[0].getsockname()[1]
+            asyncio.create_task(self.ticker())
+            self.ready.set()
+            await asyncio.Event().wait()
+
+    def run(self):
+        asyncio.run(self.main())
+
+
+########################################
+
+
+########## Parser benchmark ##########
+async def readline_parse(reader):
+    """
+    The previous parsing: readline() per header line, decoded names.
+    """
+    request_line = await reader.readline()
+    method, path, _ = request_line.split()
+    headers = {}
+    length = 0
+    while True:
+        line = await reader.readline()
+        if not line or line == b"\r\n":
+            break
+        name, _, value = line.partition(b":")
+        name = name.strip().lower()
+        headers[name] = value.strip()
+        if name == b"content-length":
+            length = int(value)
+    if length:
+        await reader.readexactly(length)
+    return method, path
+
+
+async def parse_requests(kind, count, chunk):
+    """
+    Feeds count pipelined requests into a StreamReader, chunk bytes at a
+    time (0: everything at once), and parses them all. Returns the
+    elapsed seconds.
+    """
+    reader = asyncio.StreamReader()
+    data = BROWSER_REQUEST * count
+    start = time.perf_counter()
+    if chunk:
+        feeder = asyncio.ensure_future(feed(reader, data, chunk))
+    else:
+        reader.feed_data(data)
+        reader.feed_eof()
+    if kind == "incremental":
+        request = httpserver.HTTPRequest()
+        for _ in range(count):
+            await request.wait(reader)
+            await request.read(reader)
+            assert request.path == b"/led/status"
+    else:
+        for _ in range(count):
+            _, path = await readline_parse(reader)
+            assert path == b"/led/status?t=1712345678"
+    if chunk:
+        await feeder
+    return time.perf_counter() - start
+
+
+async def feed(reader, data, chunk):
+    for i in range(0, len(data), chunk):
+        reader.feed_data(data[i:i + chunk])
+        await asyncio.sleep(0)
+    reader.feed_eof()
+
+
+def run_parser(count):
+    results = []
+    print("parser       delivery   requests/s")
+    for chunk in (0, PARSER_CHUNK):
+        for kind in ("readline", "incremental"):
+            elapsed = asyncio.run(parse_requests(kind, count, chunk))
+            r = {
+                "parser": kind,
+                "delivery": "chunk%d" % chunk if chunk else "whole",
+                "requests": count,
+                "seconds": round(elapsed, 4),
+                "requests_per_s": round(count / elapsed, 1),
+            }
+            results.append(r)
+            print("%-12s %-10s %10.1f" % (kind, r["delivery"], r["requests_per_s"]))
+    return results
+
+
+######################################
+
+
+########## Router benchmark ##########
+def if_chain(paths):
+    """
+    Returns a function comparing a path against paths one by one, like
+    the if/elif dispatch the apps used before.
+    """
+    def lookup(path):
+        for p in paths:
+            if path == p:
+                return p
+        return None
+    return lookup
+
+
+def run_router(lookups):
+    """
+    Looks up the last registered exact and parameterized path (worst case
+    for the chain) with n routes of each kind.
+    """
+    results = []
+    print("routes  router exact/s  router param/s   if-chain/s")
+    for n in ROUTE_COUNTS:
+        router = httpserver.Router()
+        for i in range(n):
+            router.get("/r%d" % i)(None)
+            router.get("/p%d/{value}" % i)(None)
+        exact = b"/r%d" % (n - 1)
+        param = b"/p%d/42" % (n - 1)
+        chain = if_chain([b"/r%d" % i for i in range(n)])
+        rates = []
+        for fn, path in ((router.match, exact), (router.match, param), (chain, exact)):
+            start = time.perf_counter()
+            for _ in range(lookups):
+                fn(path)
+            rates.append(round(lookups / (time.perf_counter() - start), 1))
+        r = {"routes": n, "lookups": lookups, "router_exact_per_s": rates[0],
+             "router_param_per_s": rates[1], "if_chain_per_s": rates[2]}
+        results.append(r)
+        print("%-6d %15.1f %15.1f %12.1f" % (n, rates[0], rates[1], rates[2]))
+    return results
+
+
+######################################
+
+
+########## Streaming benchmark ##########
+async def stream_case(kind, size, responses):
+    """
+    Serves responses GET requests of a size byte body over one keep-alive
+    connection and returns (seconds, peak traced bytes).
+    """
+    line = "x" * (STREAM_LINE - 1) + "\n"
+    lines = size // STREAM_LINE
+
+    async def handler(method, path, body=None):
+        if kind == "rendered":
+            return 200, "text/plain", "".join(line for _ in range(lines))
+        return 200, "text/plain", (line for _ in range(lines))
+
+    server = httpserver.HTTPServer(handler, host="127.0.0.1", port=0)
+    await server.start()
+    port = server.server.sockets[0].getsockname()[1]
+    # Small client buffers, so the peak is the server's. CPython's socket
+    # transports recv() into a 256 KiB buffer every time; that transient
+    # would hide everything else
+    transport = sys.modules["asyncio.selector_events"]._SelectorTransport
+    max_size = transport.max_size
+    transport.max_size = STREAM_LINE * 64
+    reader, writer = await asyncio.open_connection("127.0.0.1", port, limit=STREAM_LINE * 64)
+
+    async def get():
+        writer.write(b"GET /data HTTP/1.1\r\n\r\n")
+        head = await reader.readuntil(b"\r\n\r\n")
+        if b"Content-Length: " in head:
+            length = int(head.split(b"Content-Length: ")[1].split(b"\r\n")[0])
+            while length:
+                length -= len(await reader.read(min(length, STREAM_LINE * 64)))
+            return
+        while True:
+            size = int(await reader.readuntil(b"\r\n"), 16)
+            await reader.readexactly(size + 2)
+            if not size:
+                return
+
+    await get()  # warm up: first connection task, pools, code paths
+    tracemalloc.start()
+    start = time.perf_counter()
+    for _ in range(responses):
+        await get()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    transport.max_size = max_size
+    writer.close()
+    await writer.wait_closed()
+    # Let the connection task see EOF and end before the loop stops
+    await asyncio.sleep(0.05)
+    server.server.close()
+    return elapsed, peak
+
+
+def run_stream(responses):
+    results = []
+    print("body       bytes  responses/s  peak KiB")
+    for size in STREAM_SIZES:
+        for kind in ("rendered", "streamed"):
+            elapsed, peak = asyncio.run(stream_case(kind, size, responses))
+            r = {
+                "body": kind,
+                "bytes": size,
+                "responses": responses,
+                "seconds": round(elapsed, 4),
+                "requests_per_s": round(responses / elapsed, 1),
+                "peak_bytes": peak,
+            }
+            results.append(r)
+            print("%-8s %7d %12.1f %9.1f" % (kind, size, r["requests_per_s"], peak / 1024))
+    return results
+
+
+#########################################
+
+
+########## Measurement helpers ##########
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    k = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[k]
+
+
+def request_bytes(i, close):
+    return b"GET %s HTTP/1.1\r\nHost: bench\r\n%s\r\n" % (
+        PATHS[i % len(PATHS)], b"Connection: close\r\n" if close else b"")
+
+
+class ResponseReader:
+    """
+    Reads responses framed by Content-Length (or by the connection
+    closing, as the blocking server does) from a client socket.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buf = b""
+
+    def read(self):
+        """
+        Returns (status, keep_alive) of the next response.
+        """
+        while b"\r\n\r\n" not in self.buf:
+            data = self.sock.recv(4096)
+            if not data:
+                raise OSError("connection closed")
+            self.buf += data
+        head, _, self.buf = self.buf.partition(b"\r\n\r\n")
+        lines = head.split(b"\r\n")
+        status = int(lines[0].split(b" ", 2)[1])
+        length = None
+        keep_alive = False
+        for line in lines[1:]:
+            name, _, value = line.partition(b":")
+            name = name.strip().lower()
+            if name == b"content-length":
+                length = int(value)
+            elif name == b"connection":
+                keep_alive = value.strip().lower() == b"keep-alive"
+        if length is None:
+            while True:
+                data = self.sock.recv(4096)
+                if not data:
+                    break
+                self.buf += data
+            self.buf = b""
+            return status, False
+        while len(self.buf) < length:
+            data = self.sock.recv(4096)
+            if not data:
+                raise OSError("connection closed")
+            self.buf += data
+        self.buf = self.buf[length:]
+        return status, keep_alive
+
+
+def client(port, requests, latencies, statuses, mode):
+    """
+    Sends requests either on a new connection each ("close") or over
+    persistent connections, one at a time or pipelined. Connections the
+    server closes are reopened.
+    """
+    depth = PIPELINE_DEPTH if mode == "pipeline" else 1
+    sock = reader = None
+    i = 0
+    while i < requests:
+        n = min(depth, requests - i)
+        answered = 0
+        start = time.perf_counter()
+        try:
+            if sock is None:
+                sock = socket.create_connection(("127.0.0.1", port), 10)
+                reader = ResponseReader(sock)
+            sock.sendall(b"".join(request_bytes(i + k, mode == "close") for k in range(n)))
+            while answered < n:
+                status, keep_alive = reader.read()
+                latencies.append(time.perf_counter() - start)
+                statuses.append(status)
+                answered += 1
+                if not keep_alive:
+                    sock.close()
+                    sock = None
+                    break
+        except OSError:
+            if sock is not None:
+                sock.close()
+            sock = None
+        # Requests without a response (e.g. sent after the server
+        # decided to close) count as failed
+        statuses.extend([0] * (n - answered))
+        i += n
+    if sock is not None:
+        sock.close()
+
+
+#########################################
+
+
+############ Single case ############
+def run_case(port, server, clients, requests, mode):
+    latencies = []
+    statuses = []
+    server.lags.clear()
+    server.last_tick = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(port, requests, latencies, statuses, mode))
+               for _ in range(clients)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    lags = sorted(server.lag_ms())
+    ok = statuses.count(200)
+    return {
+        "server": server.kind,
+        "mode": mode,
+        "clients": clients,
+        "requests": clients * requests,
+        "ok": ok,
+        "rejected": statuses.count(503),
+        "failed": len(statuses) - ok - statuses.count(503),
+        "seconds": round(elapsed, 4),
+        "requests_per_s": round(ok / elapsed, 1),
+        "latency_p50_ms": round(percentile(latencies, 50) * 1000, 3) if latencies else None,
+        "latency_p99_ms": round(percentile(latencies, 99) * 1000, 3) if latencies else None,
+        "loop_lag_p99_ms": round(percentile(lags, 99), 3) if lags else None,
+        "loop_lag_max_ms": round(lags[-1], 3) if lags else None,
+    }
+
+
+#####################################
+
+
+########## Comparison ##########
+def case_key(r):
+    if "routes" in r:
+        return ("router", r["routes"])
+    if "parser" in r:
+        return ("parser", r["parser"], r["delivery"])
+    if "body" in r:
+        return ("stream", r["body"], r["bytes"])
+    return (r["server"], r.get("mode", "close"), r["clients"])
+
+
+def compare(results, baseline_path):
+    """
+    Prints requests/s and p99 latency changes against a previous run.
+    """
+    with open(baseline_path) as f:
+        baseline = {case_key(r): r for r in json.load(f)["results"]}
+    print("\nchange vs %s" % baseline_path)
+    for r in results:
+        old = baseline.get(case_key(r))
+        key = "router_exact_per_s" if "routes" in r else "requests_per_s"
+        if old is None or not old[key]:
+            continue
+        rate = (r[key] / old[key] - 1) * 100
+        if "routes" in r:
+            print("routes=%-4d  router exact/s %+6.1f%%  param/s %+6.1f%%" % (
+                r["routes"], rate,
+                (r["router_param_per_s"] / old["router_param_per_s"] - 1) * 100))
+            continue
+        if "parser" in r:
+            print("parser=%-12s delivery=%-8s  req/s %+6.1f%%" % (r["parser"], r["delivery"], rate))
+            continue
+        if "body" in r:
+            print("body=%-8s bytes=%-6d  responses/s %+6.1f%%  peak %d -> %d bytes"
+                  % (r["body"], r["bytes"], rate, old["peak_bytes"], r["peak_bytes"]))
+            continue
+        print("server=%-8s mode=%-10s clients=%-3d  req/s %+6.1f%%  p99 %s -> %s ms"
+              % (case_key(r) + (rate, old["latency_p99_ms"], r["latency_p99_ms"])))
+
+
+def finish(args, report):
+    """
+    Writes the report if --output was given and compares it with
+    --compare if given.
+    """
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print("results written to", args.output)
+    if args.compare:
+        compare(report["results"], args.compare)
+
+
+################################
+
+
+############ Main Function ############
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--output", help="also write the results as JSON to this file")
+    parser.add_argument("--compare", help="previous JSON result to compare with")
+    parser.add_argument("--quick", action="store_true", help="small sweep")
+    parser.add_argument("--server", choices=("asyncio", "blocking"), default="asyncio")
+    parser.add_argument("--mode", choices=MODES, default="keep-alive")
+    parser.add_argument("--max-connections", type=int, default=MAX_CONNECTIONS)
+    parser.add_argument("--parser", action="store_true", help="benchmark the request parser only")
+    parser.add_argument("--router", action="store_true", help="benchmark route lookups only")
+    parser.add_argument("--stream", action="store_true", help="benchmark large response bodies only")
+    args = parser.parse_args()
+
+    clients, requests = CLIENTS, REQUESTS_PER_CLIENT
+    parser_requests = PARSER_REQUESTS
+    router_lookups = ROUTER_LOOKUPS
+    stream_responses = STREAM_RESPONSES
+    if args.quick:
+        clients, requests = QUICK["clients"], QUICK["requests"]
+        parser_requests = QUICK["parser_requests"]
+        router_lookups = QUICK["router_lookups"]
+        stream_responses = QUICK["stream_responses"]
+
+    if args.parser or args.router or args.stream:
+        if args.parser:
+            results = run_parser(parser_requests)
+        elif args.router:
+            results = run_router(router_lookups)
+        else:
+            results = run_stream(stream_responses)
+        report = {
+            "meta": {
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "python": sys.version.split()[0],
+                "platform": platform.platform(),
+                "request_bytes": len(BROWSER_REQUEST),
+            },
+            "results": results,
+        }
+        finish(args, report)
+        return
+
+    server = ServerThread(args.server, args.max_connections)
+    server.start()
+    server.ready.wait()
+
+    results = []
+    print("server   mode       cli    req/s   ok    503  fail   p50 ms   p99 ms  lag p99  lag max")
+    for n in clients:
+        r = run_case(server.port, server, n, requests, args.mode)
+        results.append(r)
+        print("%-8s %-10s %-4d %8.1f %5d %5d %5d %8s %8s %8s %8s" % (
+            r["server"], r["mode"], n, r["requests_per_s"], r["ok"], r["rejected"], r["failed"],
+            r["latency_p50_ms"], r["latency_p99_ms"],
+            r["loop_lag_p99_ms"], r["loop_lag_max_ms"]))
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "requests_per_client": requests,
+            "max_connections": args.max_connections,
+        },
+        "results": results,
+    }
+    finish(args, report)
+
+
+if __name__ == "__main__":
+    main()
+
+#######################################
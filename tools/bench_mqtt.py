@@ -0,0 +1,309 @@
+"""
+Throughput and latency benchmark for umqttsimple.MQTTClient (CPython).
+
+Runs the client over loopback against the local broker stand-in
+(mqttbroker.py, started as a subprocess so its work neither competes for
+the GIL nor shows up in the allocation figures) and sweeps payload size,
+QoS, in-flight window and number of concurrent publishing clients. For every combination it reports:
+- msgs/s and payload bytes/s, measured from the first publish to the
+  last delivery at the subscriber
+- p50/p99 publish-to-delivery latency (each payload carries its send
+  timestamp)
+- peak transient heap bytes per publish call, sampled with tracemalloc
+
+Results are printed; with --output they are also written as JSON, so
+runs can be compared over time:
+    python3 tools/bench_mqtt.py --output before.json
+    python3 tools/bench_mqtt.py --output after.json --compare before.json
+"""
+
+############### Imports ###############
+import argparse
+import json
+import os
+import platform
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "P3"))
+
+from umqttsimple import MQTTClient  # noqa: E402
+
+#######################################
+
+######## Sweep configuration ########
+PAYLOAD_SIZES = (16, 128, 1024)
+QOS_LEVELS = (0, 1)
+WINDOWS = (1, 16)
+CLIENTS = (1, 4)
+MESSAGES_PER_CLIENT = 2000
+RECEIVE_TIMEOUT_S = 5
+
+QUICK = {
+    "payload_sizes": (16, 256),
+    "qos_levels": (0, 1),
+    "windows": (1, 16),
+    "clients": (1, 2),
+    "messages": 300,
+}
+
+#####################################
+
+# Timestamp prefix of every benchmark payload
+STAMP = struct.Struct("!d")
+
+
+########## Broker subprocess ##########
+def start_broker(latency_ms, stall=None):
+    """
+    Starts mqttbroker.py on a free loopback port and waits until it
+    accepts connections. Returns (process, port).
+
+    :param stall: Fault to inject (see mqttbroker.py --stall)
+    """
+    probe = socket.socket()
+    probe.bind(("127.0.0.1", 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, "mqttbroker.py"),
+         "--host", "127.0.0.1", "--port", str(port),
+         "--latency-ms", str(latency_ms)] + (["--stall", stall] if stall else []),
+        stdout=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port), 0.1).close()
+            return proc, port
+        except OSError:
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError("broker did not start")
+
+
+#######################################
+
+
+########## Measurement helpers ##########
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    k = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[k]
+
+
+def make_payload(size):
+    return bytearray(max(size, STAMP.size))
+
+
+def publish_batch(client, topic, payload, qos, window, count):
+    """
+    Publishes count messages, one at a time (window 1) or in
+    publish_many batches of window messages.
+    """
+    if window == 1:
+        for _ in range(count):
+            STAMP.pack_into(payload, 0, time.perf_counter())
+            client.publish(topic, payload, qos=qos)
+        return
+    sent = 0
+    while sent < count:
+        n = min(window, count - sent)
+        batch = []
+        for _ in range(n):
+            msg = bytearray(payload)
+            STAMP.pack_into(msg, 0, time.perf_counter())
+            batch.append((topic, msg, qos))
+        client.publish_many(batch)
+        sent += n
+
+
+def alloc_per_publish(port, payload_size, qos, window, samples=50):
+    """
+    Returns the average tracemalloc peak (bytes above the baseline)
+    while publishing one message, or one batch of window messages
+    divided by window.
+    """
+    client = MQTTClient(b"bench-alloc", "127.0.0.1", port=port)
+    client.connect()
+    payload = make_payload(payload_size)
+    batch = [(b"bench/alloc", payload, qos)] * window
+    tracemalloc.start()
+    total = 0
+    for _ in range(samples):
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        if window == 1:
+            client.publish(b"bench/alloc", payload, qos=qos)
+        else:
+            client.publish_many(batch)
+        total += tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    client.disconnect()
+    return total / samples / window
+
+
+#########################################
+
+
+############ Single case ############
+def run_case(port, payload_size, qos, window, clients, messages):
+    """
+    Runs one benchmark case and returns its result dict.
+    """
+    expected = clients * messages
+    latencies = []
+    received = [0]
+    done = threading.Event()
+    errors = []
+
+    def on_message(topic, msg):
+        latencies.append(time.perf_counter() - STAMP.unpack_from(msg)[0])
+        received[0] += 1
+
+    sub = MQTTClient(b"bench-sub", "127.0.0.1", port=port)
+    sub.connect()
+    sub.set_callback(on_message)
+    sub.subscribe(b"bench/+", qos)
+    sub.sock.sock.settimeout(RECEIVE_TIMEOUT_S)
+
+    def subscriber():
+        try:
+            while received[0] < expected:
+                sub.wait_msg()
+        except OSError:
+            pass
+        done.set()
+
+    def publisher(i):
+        try:
+            client = MQTTClient(b"bench-pub-%d" % i, "127.0.0.1", port=port)
+            client.connect()
+            publish_batch(client, b"bench/%d" % i, make_payload(payload_size),
+                          qos, window, messages)
+            client.disconnect()
+        except Exception as e:
+            errors.append(repr(e))
+
+    sub_thread = threading.Thread(target=subscriber)
+    sub_thread.start()
+    pubs = [threading.Thread(target=publisher, args=(i,)) for i in range(clients)]
+    start = time.perf_counter()
+    for t in pubs:
+        t.start()
+    for t in pubs:
+        t.join()
+    done.wait()
+    elapsed = time.perf_counter() - start
+    sub_thread.join()
+    sub.sock.close()
+
+    latencies.sort()
+    delivered = received[0]
+    return {
+        "payload_size": payload_size,
+        "qos": qos,
+        "window": window,
+        "clients": clients,
+        "messages": expected,
+        "delivered": delivered,
+        "seconds": round(elapsed, 4),
+        "msgs_per_s": round(delivered / elapsed, 1),
+        "bytes_per_s": round(delivered * max(payload_size, STAMP.size) / elapsed, 1),
+        "latency_p50_ms": round(percentile(latencies, 50) * 1000, 3) if latencies else None,
+        "latency_p99_ms": round(percentile(latencies, 99) * 1000, 3) if latencies else None,
+        "alloc_bytes_per_msg": round(alloc_per_publish(port, payload_size, qos, window), 1),
+        "errors": errors,
+    }
+
+
+#####################################
+
+
+########## Comparison ##########
+def case_key(r):
+    return (r["payload_size"], r["qos"], r["window"], r["clients"])
+
+
+def compare(results, baseline_path):
+    """
+    Prints msgs/s and p99 latency changes against a previous run.
+    """
+    with open(baseline_path) as f:
+        baseline = {case_key(r): r for r in json.load(f)["results"]}
+    print("\nchange vs %s" % baseline_path)
+    for r in results:
+        old = baseline.get(case_key(r))
+        if old is None:
+            continue
+        rate = (r["msgs_per_s"] / old["msgs_per_s"] - 1) * 100
+        print("size=%-5d qos=%d window=%-3d clients=%d  msgs/s %+6.1f%%  p99 %s -> %s ms"
+              % (case_key(r) + (rate, old["latency_p99_ms"], r["latency_p99_ms"])))
+
+
+################################
+
+
+############ Main Function ############
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--output", help="also write the results as JSON to this file")
+    parser.add_argument("--compare", help="previous JSON result to compare with")
+    parser.add_argument("--quick", action="store_true", help="small sweep")
+    parser.add_argument("--latency-ms", type=float, default=0,
+                        help="latency injected by the broker")
+    args = parser.parse_args()
+
+    sizes, qos_levels, windows, clients, messages = (
+        PAYLOAD_SIZES, QOS_LEVELS, WINDOWS, CLIENTS, MESSAGES_PER_CLIENT)
+    if args.quick:
+        sizes, qos_levels, windows, clients, messages = (
+            QUICK["payload_sizes"], QUICK["qos_levels"], QUICK["windows"],
+            QUICK["clients"], QUICK["messages"])
+
+    broker, port = start_broker(args.latency_ms)
+
+    results = []
+    print("size   qos win cli     msgs/s      bytes/s   p50 ms   p99 ms  alloc B/msg")
+    for size in sizes:
+        for qos in qos_levels:
+            for window in windows:
+                for n in clients:
+                    r = run_case(port, size, qos, window, n, messages)
+                    results.append(r)
+                    print("%-6d %-3d %-3d %-3d %10.1f %12.1f %8s %8s %12.1f" % (
+                        size, qos, window, n, r["msgs_per_s"], r["bytes_per_s"],
+                        r["latency_p50_ms"], r["latency_p99_ms"],
+                        r["alloc_bytes_per_msg"]))
+
+    broker.terminate()
+    broker.wait()
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "messages_per_client": messages,
+            "broker_latency_ms": args.latency_ms,
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print("results written to", args.output)
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
+
+#######################################
@@ -0,0 +1,500 @@
+"""
+Small in-process MQTT 3.1.1 broker for local integration tests and
+load benchmarks (CPython, asyncio).
+
+It stands in for the real broker so MQTTClient, the P3 publisher and the
+P4 UnifiedPublisher can be exercised without the lab network. Supported:
+- CONNECT (clean and persistent sessions, optional credentials, last
+  will), CONNACK with return code 1 for other protocol levels
+- PUBLISH with QoS 0, 1 and 2 in both directions
+- SUBSCRIBE / UNSUBSCRIBE with "+" and "#" wildcards
+- Retained messages
+- Keepalive (connections silent for 1.5 x keepalive are closed)
+- Optional TLS (--tls-cert/--tls-key), with session tickets so client
+  session resumption can be exercised
+- Fault injection: fixed latency on every packet sent to clients, a
+  drop rate for PUBLISH packets in either direction, and stalled
+  brokers that never answer CONNECT, stop reading after CONNACK or
+  never answer PINGREQ
+
+Usage:
+    python3 tools/mqttbroker.py --port 1883 --latency-ms 20 --drop-rate 0.01
+
+or from Python:
+    broker = Broker(port=0)
+    await broker.start()      # broker.port holds the bound port
+    ...
+    await broker.stop()
+"""
+
+############### Imports ###############
+import argparse
+import asyncio
+import random
+import ssl
+import struct
+
+#######################################
+
+######## Packet types ########
+CONNECT = 0x10
+CONNACK = 0x20
+PUBLISH = 0x30
+PUBACK = 0x40
+PUBREC = 0x50
+PUBREL = 0x60
+PUBCOMP = 0x70
+SUBSCRIBE = 0x80
+SUBACK = 0x90
+UNSUBSCRIBE = 0xA0
+UNSUBACK = 0xB0
+PINGREQ = 0xC0
+PINGRESP = 0xD0
+DISCONNECT = 0xE0
+
+# PUBLISH flag marking a redelivery
+DUP = 0x08
+
+##############################
+
+
+########## Encoding helpers ##########
+def encode_len(n):
+    """
+    Encodes an MQTT remaining length (variable byte integer).
+    """
+    out = bytearray()
+    while True:
+        b = n & 0x7F
+        n >>= 7
+        if n:
+            out.append(b | 0x80)
+        else:
+            out.append(b)
+            return bytes(out)
+
+
+def packet(first, body=b""):
+    return bytes((first,)) + encode_len(len(body)) + body
+
+
+def with_dup(pkt):
+    """
+    Returns a PUBLISH packet with the DUP flag set, for redelivery.
+    """
+    return bytes((pkt[0] | DUP,)) + pkt[1:]
+
+
+def topic_matches(topic_filter, topic):
+    """
+    Returns True if topic (bytes) matches the MQTT topic filter (bytes).
+    Wildcards never match topics starting with "$" at the first level.
+    """
+    f = topic_filter.split(b"/")
+    t = topic.split(b"/")
+    if topic.startswith(b"$") and f[0] in (b"+", b"#"):
+        return False
+    for i, level in enumerate(f):
+        if level == b"#":
+            return True
+        if i >= len(t):
+            return False
+        if level != b"+" and level != t[i]:
+            return False
+    return len(f) == len(t)
+
+
+#######################################
+
+
+########## Client session ##########
+class Session:
+    """
+    State the broker keeps per client id. Persistent sessions
+    (clean_session=False) outlive the connection: subscriptions are kept
+    and QoS 1/2 messages are queued while the client is offline.
+
+    Every outbound QoS 1/2 message stays in inflight until the client
+    acknowledges it, and is sent again, in order, when the session is
+    resumed. A PUBLISH that went out before is resent with DUP set. For
+    QoS 2 past PUBREC, the PUBREL is resent instead.
+    """
+
+    def __init__(self, client_id, clean):
+        self.client_id = client_id
+        self.clean = clean
+        self.subscriptions = {}
+        self.writer = None
+        self.next_pid = 0
+        # pid -> packet to (re)send until acknowledged, in delivery order
+        self.inflight = {}
+        # pids of inbound QoS 2 messages awaiting PUBREL
+        self.qos2_in = set()
+
+    def new_pid(self):
+        self.next_pid = self.next_pid % 65535 + 1
+        return self.next_pid
+
+
+#######################################
+
+
+############### Broker ###############
+class Broker:
+    """
+    asyncio MQTT 3.1.1 broker.
+
+    :param host: Interface to listen on
+    :param port: TCP port; 0 picks a free port (see .port after start())
+    :param latency_ms: Delay applied to every packet sent to clients
+    :param drop_rate: Probability of silently dropping a PUBLISH, applied
+                      to both inbound publishes and outbound deliveries
+    :param credentials: Optional {username: password} dict; if given,
+                        CONNECTs with other credentials get return code 4
+    :param seed: Seed for the drop decisions, for reproducible runs
+    :param ssl_context: Server-side SSLContext to accept TLS connections
+    :param stall: "connack" reads CONNECT but never answers it, "read"
+                  stops reading after CONNACK (the client's writes block
+                  once the TCP buffers are full); both keep the
+                  connection open until stop(). "pingresp" serves the
+                  connection normally but never answers PINGREQ, like a
+                  link whose return path died
+    """
+
+    def __init__(self, host="127.0.0.1", port=1883, latency_ms=0,
+                 drop_rate=0.0, credentials=None, seed=None, ssl_context=None,
+                 stall=None):
+        self.host = host
+        self.port = port
+        self.latency_ms = latency_ms
+        self.drop_rate = drop_rate
+        self.credentials = credentials
+        self.ssl_context = ssl_context
+        self.stall = stall
+        self.random = random.Random(seed)
+        self._unstall = asyncio.Event()
+
+        self.sessions = {}
+        self.retained = {}
+        self.server = None
+        self.stats = {
+            "connections": 0,
+            "publish_in": 0,
+            "publish_out": 0,
+            "dropped": 0,
+            "bytes_in": 0,
+            "bytes_out": 0,
+        }
+
+    ###### Lifecycle ######
+    async def start(self):
+        self.server = await asyncio.start_server(
+            self._handle, self.host, self.port, ssl=self.ssl_context)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        """
+        Closes the listening socket and every client connection, as a
+        broker restart would. Session state is kept.
+        """
+        self._unstall.set()
+        self.server.close()
+        for session in self.sessions.values():
+            if session.writer is not None:
+                session.writer.close()
+        await self.server.wait_closed()
+
+    #######################
+
+    ###### Output ######
+    def _send(self, session, data):
+        writer = session.writer
+        if writer is None or writer.is_closing():
+            return
+        self.stats["bytes_out"] += len(data)
+        if self.latency_ms:
+            loop = asyncio.get_running_loop()
+            loop.call_later(self.latency_ms / 1000, self._write, writer, data)
+        else:
+            writer.write(data)
+
+    @staticmethod
+    def _write(writer, data):
+        if not writer.is_closing():
+            writer.write(data)
+
+    def _drop(self):
+        if self.drop_rate and self.random.random() < self.drop_rate:
+            self.stats["dropped"] += 1
+            return True
+        return False
+
+    ####################
+
+    ###### Routing ######
+    def _deliver(self, session, topic, payload, qos, retain=False):
+        """
+        Sends (or queues, if the client is offline) one message to a
+        subscriber at the given QoS.
+        """
+        first = PUBLISH | qos << 1 | retain
+        body = struct.pack("!H", len(topic)) + topic
+        if qos:
+            pid = session.new_pid()
+            body += struct.pack("!H", pid)
+        pkt = packet(first, body + payload)
+        if session.writer is None:
+            if qos:
+                session.inflight[pid] = pkt
+            return
+        if qos:
+            # Sent (or lost by _drop, as if sent): a resend is a redelivery
+            session.inflight[pid] = with_dup(pkt)
+        if self._drop():
+            return
+        self.stats["publish_out"] += 1
+        self._send(session, pkt)
+
+    def _route(self, topic, payload, qos, retain):
+        if retain:
+            if payload:
+                self.retained[topic] = (payload, qos)
+            else:
+                self.retained.pop(topic, None)
+        for session in self.sessions.values():
+            granted = -1
+            for topic_filter, sub_qos in session.subscriptions.items():
+                if sub_qos > granted and topic_matches(topic_filter, topic):
+                    granted = sub_qos
+            if granted < 0:
+                continue
+            if session.writer is None and not granted:
+                continue
+            self._deliver(session, topic, payload, min(qos, granted))
+
+    #####################
+
+    ###### Connection handling ######
+    async def _read_packet(self, reader, timeout):
+        first = await asyncio.wait_for(reader.readexactly(1), timeout)
+        n = 0
+        shift = 0
+        while True:
+            b = (await reader.readexactly(1))[0]
+            n |= (b & 0x7F) << shift
+            if not b & 0x80:
+                break
+            shift += 7
+        body = await reader.readexactly(n) if n else b""
+        self.stats["bytes_in"] += 2 + n
+        return first[0], body
+
+    async def _connect(self, reader, writer):
+        """
+        Reads and validates CONNECT. Returns (session, keepalive, will)
+        or None if the connection was refused.
+        """
+        first, body = await self._read_packet(reader, 10)
+        if first != CONNECT:
+            return None
+        if self.stall == "connack":
+            await self._unstall.wait()
+            return None
+        name_len = struct.unpack_from("!H", body)[0]
+        i = 2 + name_len
+        level, flags, keepalive = struct.unpack_from("!BBH", body, i)
+        i += 4
+        if level != 4:
+            writer.write(packet(CONNACK, b"\x00\x01"))
+            return None
+
+        def field():
+            nonlocal i
+            n = struct.unpack_from("!H", body, i)[0]
+            value = body[i + 2:i + 2 + n]
+            i += 2 + n
+            return value
+
+        client_id = field()
+        will = None
+        if flags & 0x04:
+            will_topic = field()
+            will = (will_topic, field(), flags >> 3 & 3, bool(flags & 0x20))
+        user = field() if flags & 0x80 else None
+        password = field() if flags & 0x40 else None
+        if self.credentials is not None:
+            if user is None or self.credentials.get(user.decode()) != \
+                    (password or b"").decode():
+                writer.write(packet(CONNACK, b"\x00\x04"))
+                return None
+
+        clean = bool(flags & 0x02)
+        if not client_id:
+            client_id = b"auto-%d" % id(writer)
+        session = self.sessions.get(client_id)
+        if session is not None and session.writer is not None:
+            session.writer.close()
+        present = session is not None and not clean
+        if not present:
+            session = Session(client_id, clean)
+            self.sessions[client_id] = session
+        session.clean = clean
+        session.writer = writer
+        writer.write(packet(CONNACK, bytes((present, 0))))
+
+        if present:
+            for pid, pkt in session.inflight.items():
+                self._send(session, pkt)
+                if pkt[0] & 0xF0 == PUBLISH:
+                    session.inflight[pid] = with_dup(pkt)
+        return session, keepalive, will
+
+    async def _handle(self, reader, writer):
+        self.stats["connections"] += 1
+        session = None
+        will = None
+        try:
+            accepted = await self._connect(reader, writer)
+            if accepted is None:
+                return
+            session, keepalive, will = accepted
+            if self.stall == "read":
+                await self._unstall.wait()
+                return
+            timeout = keepalive * 1.5 if keepalive else None
+            while True:
+                first, body = await self._read_packet(reader, timeout)
+                kind = first & 0xF0
+                if kind == DISCONNECT:
+                    will = None
+                    return
+                self._dispatch(session, first, kind, body)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError,
+                ConnectionError, struct.error):
+            pass
+        finally:
+            if session is not None and session.writer is writer:
+                session.writer = None
+                if session.clean:
+                    del self.sessions[session.client_id]
+                if will is not None:
+                    self._route(*will)
+            writer.close()
+
+    def _dispatch(self, session, first, kind, body):
+        if kind == PUBLISH:
+            qos = first >> 1 & 3
+            n = struct.unpack_from("!H", body)[0]
+            topic = body[2:2 + n]
+            i = 2 + n
+            if qos:
+                pid = struct.unpack_from("!H", body, i)[0]
+                i += 2
+            if self._drop():
+                return
+            self.stats["publish_in"] += 1
+            if qos == 2:
+                self._send(session, packet(PUBREC, struct.pack("!H", pid)))
+                if pid in session.qos2_in:
+                    return
+                session.qos2_in.add(pid)
+            elif qos == 1:
+                self._send(session, packet(PUBACK, struct.pack("!H", pid)))
+            self._route(topic, body[i:], qos, first & 1)
+
+        elif kind == PUBREL:
+            pid = struct.unpack("!H", body[:2])[0]
+            session.qos2_in.discard(pid)
+            self._send(session, packet(PUBCOMP, body[:2]))
+
+        elif kind in (PUBACK, PUBCOMP):
+            session.inflight.pop(struct.unpack("!H", body[:2])[0], None)
+
+        elif kind == PUBREC:
+            pid = struct.unpack("!H", body[:2])[0]
+            pubrel = packet(PUBREL | 0x02, body[:2])
+            if pid in session.inflight:
+                session.inflight[pid] = pubrel
+            self._send(session, pubrel)
+
+        elif kind == SUBSCRIBE:
+            pid = body[:2]
+            codes = bytearray()
+            i = 2
+            new = []
+            while i < len(body):
+                n = struct.unpack_from("!H", body, i)[0]
+                topic_filter = body[i + 2:i + 2 + n]
+                qos = min(body[i + 2 + n] & 3, 2)
+                i += 3 + n
+                session.subscriptions[topic_filter] = qos
+                codes.append(qos)
+                new.append((topic_filter, qos))
+            self._send(session, packet(SUBACK, pid + codes))
+            for topic_filter, qos in new:
+                for topic, (payload, msg_qos) in self.retained.items():
+                    if topic_matches(topic_filter, topic):
+                        self._deliver(session, topic, payload,
+                                      min(qos, msg_qos), retain=True)
+
+        elif kind == UNSUBSCRIBE:
+            i = 2
+            while i < len(body):
+                n = struct.unpack_from("!H", body, i)[0]
+                session.subscriptions.pop(body[i + 2:i + 2 + n], None)
+                i += 2 + n
+            self._send(session, packet(UNSUBACK, body[:2]))
+
+        elif kind == PINGREQ and self.stall != "pingresp":
+            self._send(session, packet(PINGRESP))
+
+    #################################
+
+#######################################
+
+
+def tls_server_context(cert, key=None):
+    ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    ctx.load_cert_chain(cert, key)
+    return ctx
+
+
+############ Main Function ############
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--drop-rate", type=float, default=0.0)
+    parser.add_argument("--user", help="require this username")
+    parser.add_argument("--password", default="")
+    parser.add_argument("--tls-cert", help="PEM certificate; enables TLS")
+    parser.add_argument("--tls-key", help="PEM private key for --tls-cert")
+    parser.add_argument("--stall", choices=("connack", "read", "pingresp"),
+                        help="never answer CONNECT, stop reading after CONNACK, "
+                             "or never answer PINGREQ")
+    args = parser.parse_args()
+
+    credentials = {args.user: args.password} if args.user else None
+    ssl_context = None
+    if args.tls_cert:
+        ssl_context = tls_server_context(args.tls_cert, args.tls_key)
+    broker = Broker(args.host, args.port, args.latency_ms, args.drop_rate,
+                    credentials, ssl_context=ssl_context, stall=args.stall)
+
+    async def serve():
+        await broker.start()
+        print("MQTT broker listening on %s:%d" % (args.host, broker.port))
+        await broker.server.serve_forever()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        print(broker.stats)
+
+
+if __name__ == "__main__":
+    main()
+
+#######################################
@@ -0,0 +1,302 @@
+"""
+Behaviour tests for the HTTP server of Sessions 1 and 4 (CPython).
+
+P1/httpserver.py and P4/httpserver.py are the same file; the P4 copy is
+tested. The request parser is fed from a fake stream that hands out
+data in the pieces a test asks for, so requests can arrive byte by byte
+or split at any point; the error statuses are also checked end to end
+through a running HTTPServer. Router is tested through dispatch().
+
+Run with pytest, or directly:
+    python3 tools/test_httpserver.py
+"""
+
+############### Imports ###############
+import asyncio
+import os
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "P4"))
+
+from httpserver import HTTPError, HTTPRequest, HTTPServer, Router  # noqa: E402
+
+#######################################
+
+######## Test configuration ########
+MAX_HEAD = 128
+MAX_BODY = 64
+
+GET = b"GET /led/status?x=1 HTTP/1.1\r\nHost: esp32\r\nAccept: */*\r\n\r\n"
+POST = b"POST /api/batch HTTP/1.1\r\nContent-Length: 11\r\n\r\nhello world"
+
+####################################
+
+
+########## Harness ##########
+class PieceReader:
+    """
+    Stand-in for asyncio.StreamReader returning the given pieces one per
+    read() (cut further when a read asks for less), then EOF.
+    """
+
+    def __init__(self, pieces):
+        self.pieces = list(pieces)
+
+    async def read(self, n):
+        if not self.pieces:
+            return b""
+        piece = self.pieces.pop(0)
+        if len(piece) > n:
+            self.pieces.insert(0, piece[n:])
+            piece = piece[:n]
+        return piece
+
+
+def parse(pieces, count=1):
+    """
+    Parses count requests from pieces with one HTTPRequest, as a
+    connection does. Returns (method, path, query, version, headers,
+    body, keep_alive) per request, or the HTTPError status raised.
+    """
+    async def run():
+        request = HTTPRequest(MAX_HEAD, MAX_BODY)
+        reader = PieceReader(pieces)
+        parsed = []
+        for _ in range(count):
+            assert await request.wait(reader)
+            try:
+                await request.read(reader)
+            except HTTPError as e:
+                return e.status
+            parsed.append((request.method, request.path, request.query, request.version,
+                           dict(request.headers), bytes(request.body), request.keep_alive))
+        return parsed
+
+    return asyncio.run(run())
+
+
+def bytewise(data):
+    return [data[i:i + 1] for i in range(len(data))]
+
+
+async def ok(method, path, body=None):
+    return 200, "text/plain", "ok"
+
+
+def exchange(data, handler=ok):
+    """
+    Sends data to a running HTTPServer and returns the raw response.
+    """
+    async def run():
+        server = await HTTPServer(handler, host="127.0.0.1", port=0,
+                                  max_head=MAX_HEAD, max_body=MAX_BODY).start()
+        port = server.server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(data)
+        response = await asyncio.wait_for(reader.read(), 5)
+        writer.close()
+        await server.stop()
+        return response
+
+    return asyncio.run(run())
+
+
+#############################
+
+
+########## Request parser tests ##########
+def test_parse_fields():
+    (method, path, query, version, headers, body, keep_alive), = parse([GET])
+    assert (method, path, query, version) == (b"GET", b"/led/status", b"x=1", b"HTTP/1.1")
+    assert headers == {b"host": b"esp32", b"accept": b"*/*"}
+    assert body == b""
+    assert keep_alive
+
+
+def test_parse_byte_by_byte():
+    assert parse(bytewise(GET)) == parse([GET])
+    assert parse(bytewise(POST)) == parse([POST])
+
+
+def test_parse_split_anywhere():
+    whole = parse([POST])
+    # Every cut point, the ones inside "\r\n\r\n" and the body included
+    for i in range(1, len(POST)):
+        assert parse([POST[:i], POST[i:]]) == whole, i
+
+
+def test_parse_pipelined():
+    parsed = parse([GET + POST + GET], count=3)
+    assert [p[0] for p in parsed] == [b"GET", b"POST", b"GET"]
+    assert parsed[1][5] == b"hello world"
+    # Split so the second request starts in the read that ends the first
+    assert parse([GET + POST[:5], POST[5:]], count=2) == parsed[:2]
+
+
+def test_parse_keep_alive():
+    def keep_alive(version, connection=None):
+        head = b"GET / " + version + b"\r\n"
+        if connection:
+            head += b"Connection: " + connection + b"\r\n"
+        return parse([head + b"\r\n"])[0][6]
+
+    assert keep_alive(b"HTTP/1.1")
+    assert not keep_alive(b"HTTP/1.1", b"close")
+    assert not keep_alive(b"HTTP/1.0")
+    assert keep_alive(b"HTTP/1.0", b"Keep-Alive")
+
+
+def test_parse_disconnect_halfway():
+    for data in (GET[:10], POST[:-3]):
+        try:
+            parse([data])
+        except EOFError:
+            continue
+        raise AssertionError("no EOFError for %r" % data)
+
+
+def test_head_too_large_431():
+    head = b"GET / HTTP/1.1\r\nX-Pad: " + b"a" * MAX_HEAD + b"\r\n\r\n"
+    assert parse([head]) == 431
+    # Rejected once max_head bytes are buffered, before the rest arrives
+    assert parse([head[:MAX_HEAD]]) == 431
+
+
+def test_body_too_large_413():
+    # Refused on Content-Length alone, none of the body is sent
+    head = b"POST / HTTP/1.1\r\nContent-Length: %d\r\n\r\n" % (MAX_BODY + 1)
+    assert parse([head]) == 413
+    head = b"POST / HTTP/1.1\r\nContent-Length: %d\r\n\r\n" % MAX_BODY
+    assert parse([head + b"x" * MAX_BODY])[0][5] == b"x" * MAX_BODY
+
+
+def test_bad_requests_400():
+    for head in (b"GET /\r\n\r\n",
+                 b"GET  / HTTP/1.1\r\n\r\n",
+                 b"G3T / HTTP/1.1\r\n\r\n",
+                 b"GET led HTTP/1.1\r\n\r\n",
+                 b"GET / HTTP/1.1\r\nno colon\r\n\r\n",
+                 b"POST / HTTP/1.1\r\nContent-Length: -1\r\n\r\n",
+                 b"POST / HTTP/1.1\r\nContent-Length: 1x\r\n\r\n"):
+        assert parse([head]) == 400, head
+
+
+def test_version_not_supported_505():
+    assert parse([b"GET / HTTP/2.0\r\n\r\n"]) == 505
+    assert parse([b"GET / FTP/1.1\r\n\r\n"]) == 505
+
+
+def test_transfer_encoding_not_implemented_501():
+    assert parse([b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n"]) == 501
+
+
+def test_error_statuses_sent_by_server():
+    cases = ((b"GET / HTTP/1.1\r\nX-Pad: " + b"a" * MAX_HEAD + b"\r\n\r\n", 431),
+             (b"POST / HTTP/1.1\r\nContent-Length: 999\r\n\r\n", 413),
+             (b"GET / HTTP/1.1\r\nno colon\r\n\r\n", 400),
+             (b"GET / HTTP/2.0\r\n\r\n", 505),
+             (b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n", 501))
+    for data, status in cases:
+        response = exchange(data)
+        assert response.startswith(b"HTTP/1.1 %d " % status), response
+        assert b"Connection: close" in response, response
+
+
+##########################################
+
+
+########## Router tests ##########
+def make_router():
+    router = Router()
+
+    @router.get("/led/status")
+    async def led_status():
+        return 200, "text/plain", "status"
+
+    @router.get("/led/{state}")
+    async def led(state):
+        return 200, "text/plain", "led " + state
+
+    @router.get("/jobs/{job_id}")
+    async def job(job_id):
+        return 200, "text/plain", "job " + job_id
+
+    @router.get("/jobs/{job_id}/log")
+    async def job_log(job_id):
+        return 200, "text/plain", "log " + job_id
+
+    @router.get("/jobs/latest/log")
+    async def latest_log():
+        return 200, "text/plain", "latest log"
+
+    @router.post("/api/batch", body=True)
+    async def batch(body):
+        return 200, "text/plain", "batch " + bytes(body).decode()
+
+    @router.get("/api/batch")
+    async def batch_help():
+        return 200, "text/plain", "POST commands here"
+
+    @router.route("DELETE", "/jobs/{job_id}")
+    async def cancel(job_id):
+        return 202, "text/plain", "cancel " + job_id
+
+    return router
+
+
+def dispatch(router, method, path, body=None):
+    return asyncio.run(router.dispatch(method, path, body=body))
+
+
+def test_router_exact_and_parameters():
+    router = make_router()
+    assert dispatch(router, b"GET", b"/led/status")[2] == "status"
+    assert dispatch(router, b"GET", b"/led/on")[2] == "led on"
+    assert dispatch(router, b"GET", b"/jobs/7")[2] == "job 7"
+    assert dispatch(router, b"GET", b"/jobs/7/log")[2] == "log 7"
+    # A literal segment wins over a parameter at the same position
+    assert dispatch(router, b"GET", b"/jobs/latest/log")[2] == "latest log"
+    assert dispatch(router, b"DELETE", b"/jobs/7")[:3] == (202, "text/plain", "cancel 7")
+    assert dispatch(router, b"POST", b"/api/batch", memoryview(b"[]"))[2] == "batch []"
+
+
+def test_router_404():
+    router = make_router()
+    for path in (b"/", b"/led", b"/led/on/x", b"/jobs//log", b"/jobs/", b"/nope"):
+        assert dispatch(router, b"GET", path) == router.not_found, path
+
+
+def test_router_405_lists_allowed_methods():
+    router = make_router()
+    assert dispatch(router, b"POST", b"/led/on") == (
+        405, "text/plain", "Method Not Allowed", b"Allow: GET\r\n")
+    assert dispatch(router, b"PUT", b"/jobs/7")[3] == b"Allow: DELETE, GET\r\n"
+    assert dispatch(router, b"DELETE", b"/api/batch")[3] == b"Allow: GET, POST\r\n"
+
+
+def test_router_parameter_name_clash():
+    router = make_router()
+    try:
+        router.get("/jobs/{id}/status")(ok)
+    except ValueError:
+        return
+    raise AssertionError("clashing parameter names accepted")
+
+
+def test_405_allow_header_sent_by_server():
+    router = make_router()
+    response = exchange(b"POST /led/on HTTP/1.1\r\nConnection: close\r\n\r\n", router.dispatch)
+    head = response.split(b"\r\n\r\n")[0].split(b"\r\n")
+    assert head[0] == b"HTTP/1.1 405 Method Not Allowed", response
+    assert b"Allow: GET" in head, response
+
+
+##################################
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(name, "ok")
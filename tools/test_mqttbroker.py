@@ -0,0 +1,193 @@
+"""
+Behaviour tests for the broker stand-in's session replay (CPython).
+
+The broker runs in-process; the tests speak raw MQTT 3.1.1 to it, so
+they can hold back acknowledgements and look at the flags of every
+packet they get.
+
+Run with pytest, or directly:
+    python3 tools/test_mqttbroker.py
+"""
+
+############### Imports ###############
+import asyncio
+import struct
+
+from mqttbroker import (CONNACK, CONNECT, DUP, PUBACK, PUBCOMP, PUBLISH, PUBREC, PUBREL,
+                        SUBACK, SUBSCRIBE, Broker, packet)
+
+#######################################
+
+
+########## Raw client ##########
+class RawClient:
+    """
+    Minimal MQTT 3.1.1 client that never acknowledges on its own.
+    """
+
+    async def connect(self, port, client_id, clean=False):
+        self.reader, self.writer = await asyncio.open_connection("127.0.0.1", port)
+        body = (struct.pack("!H", 4) + b"MQTT" + bytes((4, 2 if clean else 0)) + b"\0\0"
+                + struct.pack("!H", len(client_id)) + client_id)
+        self.writer.write(packet(CONNECT, body))
+        first, body = await self.read()
+        assert first == CONNACK and body[1] == 0
+        return body[0] & 1
+
+    async def read(self, timeout=2):
+        first = (await asyncio.wait_for(self.reader.readexactly(1), timeout))[0]
+        n = 0
+        shift = 0
+        while True:
+            b = (await self.reader.readexactly(1))[0]
+            n |= (b & 0x7F) << shift
+            if not b & 0x80:
+                break
+            shift += 7
+        return first, await self.reader.readexactly(n)
+
+    async def read_all(self, timeout=0.3):
+        """
+        Returns every packet arriving until the connection is quiet.
+        """
+        packets = []
+        try:
+            while True:
+                packets.append(await self.read(timeout))
+        except asyncio.TimeoutError:
+            return packets
+
+    async def subscribe(self, topic_filter, qos):
+        self.writer.write(packet(SUBSCRIBE | 0x02, struct.pack("!HH", 1, len(topic_filter))
+                                 + topic_filter + bytes((qos,))))
+        first, _ = await self.read()
+        assert first == SUBACK
+
+    def publish(self, topic, payload, qos):
+        body = struct.pack("!H", len(topic)) + topic
+        if qos:
+            body += struct.pack("!H", 1)
+        self.writer.write(packet(PUBLISH | qos << 1, body + payload))
+
+    def ack(self, kind, pid):
+        self.writer.write(packet(kind, struct.pack("!H", pid)))
+
+    async def close(self):
+        self.writer.close()
+        await asyncio.sleep(0.05)
+
+
+def publishes(packets):
+    """
+    Returns (payload, dup, pid) for every PUBLISH in packets.
+    """
+    out = []
+    for first, body in packets:
+        if first & 0xF0 == PUBLISH:
+            n = struct.unpack_from("!H", body)[0]
+            pid = struct.unpack_from("!H", body, 2 + n)[0]
+            out.append((body[4 + n:], bool(first & DUP), pid))
+    return out
+
+
+def run(scenario, **broker_args):
+    async def main():
+        broker = await Broker(port=0, **broker_args).start()
+        try:
+            await scenario(broker.port)
+        finally:
+            await broker.stop()
+
+    asyncio.run(main())
+
+
+################################
+
+
+########## Tests ##########
+def test_resumed_session_gets_dup_on_redelivery():
+    async def scenario(port):
+        sub, pub = RawClient(), RawClient()
+        await sub.connect(port, b"sub")
+        await sub.subscribe(b"t/#", 1)
+        await pub.connect(port, b"pub", clean=True)
+        pub.publish(b"t/a", b"sent", 1)
+        got = publishes(await sub.read_all())
+        assert [(p, d) for p, d, _ in got] == [(b"sent", False)]
+        # Disconnect without PUBACK; one more message arrives meanwhile
+        await sub.close()
+        pub.publish(b"t/a", b"queued", 1)
+        await asyncio.sleep(0.05)
+
+        assert await sub.connect(port, b"sub")
+        got = publishes(await sub.read_all())
+        assert [(p, d) for p, d, _ in got] == [(b"sent", True), (b"queued", False)]
+        for _, _, pid in got:
+            sub.ack(PUBACK, pid)
+        await asyncio.sleep(0.05)
+        await sub.close()
+
+        # Acknowledged messages are gone from the session
+        assert await sub.connect(port, b"sub")
+        assert publishes(await sub.read_all()) == []
+        await sub.close()
+        await pub.close()
+
+    run(scenario)
+
+
+def test_unacked_message_redelivered_twice_keeps_dup():
+    async def scenario(port):
+        sub, pub = RawClient(), RawClient()
+        await sub.connect(port, b"sub")
+        await sub.subscribe(b"t", 1)
+        await sub.close()
+        await pub.connect(port, b"pub", clean=True)
+        pub.publish(b"t", b"m", 1)
+        await asyncio.sleep(0.05)
+        flags = []
+        for _ in range(3):
+            await sub.connect(port, b"sub")
+            flags += [d for _, d, _ in publishes(await sub.read_all())]
+            await sub.close()
+        assert flags == [False, True, True]
+        await pub.close()
+
+    run(scenario)
+
+
+def test_qos2_resumes_with_pubrel_after_pubrec():
+    async def scenario(port):
+        sub, pub = RawClient(), RawClient()
+        await sub.connect(port, b"sub")
+        await sub.subscribe(b"t", 2)
+        await pub.connect(port, b"pub", clean=True)
+        pub.publish(b"t", b"m", 2)
+        (_, _, pid), = publishes(await sub.read_all())
+        sub.ack(PUBREC, pid)
+        first, _ = await sub.read()
+        assert first & 0xF0 == PUBREL
+        await sub.close()
+
+        await sub.connect(port, b"sub")
+        packets = await sub.read_all()
+        assert [first & 0xF0 for first, _ in packets] == [PUBREL]
+        sub.ack(PUBCOMP, pid)
+        await asyncio.sleep(0.05)
+        await sub.close()
+        await sub.connect(port, b"sub")
+        assert await sub.read_all() == []
+        await sub.close()
+        await pub.close()
+
+    run(scenario)
+
+
+###########################
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(name, "ok")
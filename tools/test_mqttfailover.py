@@ -0,0 +1,77 @@
+"""
+Behaviour tests for the shard mode of P4's MQTTFailover (CPython).
+
+No broker is needed: the links are marked connected by hand and only
+the broker selection (_pick) is exercised.
+
+Run with pytest, or directly:
+    python3 tools/test_mqttfailover.py
+"""
+
+############### Imports ###############
+import os
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "P4"))
+
+from mqttfailover import MQTTFailover  # noqa: E402
+from umqttsimple import MQTTClient  # noqa: E402
+
+#######################################
+
+######## Test configuration ########
+TOPICS = [b"sensors/node%d/temperature" % i for i in range(20000)]
+# Allowed deviation of a broker's topic share from its weight share
+TOLERANCE = 0.015
+
+####################################
+
+
+########## Harness ##########
+def sharded(weights):
+    link = MQTTFailover([MQTTClient(b"shard", "127.0.0.1") for _ in weights],
+                        weights, mode="shard")
+    for sup in link.links:
+        sup.connected = True
+    return link
+
+
+def shares(link):
+    counts = [0] * len(link.links)
+    for topic in TOPICS:
+        counts[link._pick(topic)] += 1
+    return [n / len(TOPICS) for n in counts]
+
+
+#############################
+
+
+########## Tests ##########
+def test_shares_follow_weights():
+    for weights in ([1, 1], [1, 2], [1, 4], [1, 1, 2], [3, 1, 1, 5]):
+        total = sum(weights)
+        for share, weight in zip(shares(sharded(weights)), weights):
+            assert abs(share - weight / total) < TOLERANCE, (weights, share)
+
+
+def test_failed_broker_only_moves_its_topics():
+    link = sharded([1, 2, 3])
+    before = [link._pick(topic) for topic in TOPICS]
+    link.links[1].connected = False
+    after = [link._pick(topic) for topic in TOPICS]
+    for old, new in zip(before, after):
+        assert new == old or old == 1
+    # Its topics are spread over the others by weight as well (1:3)
+    moved = [new for old, new in zip(before, after) if old == 1]
+    assert abs(moved.count(2) / len(moved) - 0.75) < 3 * TOLERANCE
+
+
+###########################
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(name, "ok")
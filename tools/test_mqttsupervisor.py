@@ -0,0 +1,145 @@
+"""
+Fault tests for the MQTT supervisor of Session 4 (CPython).
+
+Every test runs P4's MQTTSupervisor in its own event loop, in a thread,
+next to a ticker that records how late the loop wakes it up, against
+mqttbroker.py started with a --stall fault. The supervisor's socket calls
+block, so a stalled broker must make them fail within io_timeout_ms and
+send the link back into its backoff path: the loop may lag by about that
+much, but never freeze. The same harness feeds the supervisor input that
+makes the client raise something other than a socket error, which must
+be counted and backed off from rather than end the task.
+
+Run with pytest, or directly:
+    python3 tools/test_mqttsupervisor.py
+"""
+
+############### Imports ###############
+import asyncio
+import os
+import sys
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "P4"))
+
+import mqttsupervisor  # noqa: E402
+from mqttsupervisor import MQTTSupervisor  # noqa: E402
+from umqttsimple import MQTTClient  # noqa: E402
+
+from bench_mqtt import start_broker  # noqa: E402
+
+#######################################
+
+######## Test configuration ########
+IO_TIMEOUT_MS = 300
+TICK_MS = 10
+# Published every tick against a broker that stops reading: enough to
+# fill the loopback TCP buffers with one queue flush
+PAYLOAD_SIZE = 512 * 1024
+RUN_S = 3
+# A loop lag above this means a socket call was not bounded
+MAX_LAG_MS = 3 * IO_TIMEOUT_MS
+
+####################################
+
+
+########## Harness ##########
+def run_supervisor(stall, payload=None, **client_args):
+    """
+    Runs a supervisor against a broker with the given stall (None for a
+    healthy broker) for RUN_S seconds, publishing payload every tick if
+    given. Returns its final state, the maximum loop lag and the lines it
+    printed.
+    """
+    proc, port = start_broker(0, stall)
+    log = []
+    mqttsupervisor.print = lambda *args: log.append(" ".join(str(a) for a in args))
+    result = {}
+
+    async def scenario():
+        client = MQTTClient(b"stall-test", "127.0.0.1", port, **client_args)
+        link = MQTTSupervisor(client, min_backoff_ms=100, max_backoff_ms=200,
+                              io_timeout_ms=IO_TIMEOUT_MS)
+        asyncio.create_task(link.run())
+        lag = 0
+        last = time.monotonic()
+        end = last + RUN_S
+        while last < end:
+            if payload is not None:
+                link.publish(b"stall-test", payload)
+            await asyncio.sleep(TICK_MS / 1000)
+            now = time.monotonic()
+            lag = max(lag, (now - last) * 1000 - TICK_MS)
+            last = now
+        result.update(connected=link.connected, reconnects=link.reconnects,
+                      errors=link.errors, dropped=link.dropped, pings=link.pings,
+                      ping_timeouts=link.ping_timeouts, lag_ms=lag)
+
+    thread = threading.Thread(target=asyncio.run, args=(scenario(),), daemon=True)
+    thread.start()
+    thread.join(RUN_S + 10)
+    frozen = thread.is_alive()
+    proc.kill()
+    proc.wait()
+    del mqttsupervisor.print
+    assert not frozen, "event loop frozen in a blocking socket call"
+    return result, log
+
+
+#############################
+
+
+########## Tests ##########
+def test_broker_never_sends_connack():
+    result, log = run_supervisor("connack")
+    assert not result["connected"]
+    assert sum("connect failed" in line for line in log) >= 2, log
+    assert result["lag_ms"] < MAX_LAG_MS, result
+
+
+def test_broker_stops_reading():
+    result, log = run_supervisor("read", bytes(PAYLOAD_SIZE))
+    # Every connection got CONNACK; the blocked write dropped it again
+    assert result["reconnects"] >= 2, log
+    assert any(line.startswith("MQTT link down") for line in log), log
+    assert result["lag_ms"] < MAX_LAG_MS, result
+
+
+def test_missing_pingresp_drops_busy_link():
+    # QoS 0 every tick: the client never goes quiet, but hears nothing
+    # back, so it must ping anyway and give up on the missing PINGRESP
+    result, log = run_supervisor("pingresp", b"busy", keepalive=1)
+    assert result["pings"] >= 1, result
+    assert result["ping_timeouts"] >= 1, result
+    assert result["reconnects"] >= 2, log
+    assert "MQTT link down: PINGRESP timeout" in log, log
+
+
+def test_str_credentials_do_not_end_the_task():
+    # _send_str() cannot write str on CPython: TypeError on every connect
+    result, log = run_supervisor(None, user="user", password="secret")
+    assert not result["connected"]
+    assert result["errors"] >= 2, log
+    assert sum("connect failed: TypeError" in line for line in log) >= 2, log
+
+
+def test_unsendable_payload_is_discarded():
+    result, log = run_supervisor(None, "not bytes")
+    # Every batch fails with TypeError; the supervisor drops it, backs off
+    # and connects again instead of dying on the first one
+    assert result["errors"] >= 2, log
+    assert result["dropped"] >= result["errors"], result
+    assert result["reconnects"] >= 2, log
+    assert any(line.startswith("MQTT link down: TypeError") for line in log), log
+
+
+###########################
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(name, "ok")
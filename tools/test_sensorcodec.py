@@ -0,0 +1,129 @@
+"""
+Behaviour tests for the sensor payload codec (CPython).
+
+P2/sensorcodec.py and P3/sensorcodec.py are the same file; the P3 copy
+is tested.
+
+Run with pytest, or directly:
+    python3 tools/test_sensorcodec.py
+"""
+
+############### Imports ###############
+import os
+import struct
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "P3"))
+
+from sensorcodec import (  # noqa: E402
+    BATCH_FLAG, SENSOR_V1, SUMMARY_V2, SensorCodec, SensorSchema)
+
+#######################################
+
+######## Test configuration ########
+SAMPLES = [(56, "OK", 22.47), (57, "Error", -3.5), (0, "OK", 0.0)]
+
+####################################
+
+
+########## Harness ##########
+def raises_value_error(fn, *args):
+    try:
+        fn(*args)
+    except ValueError:
+        return True
+    return False
+
+
+#############################
+
+
+########## Tests ##########
+def test_single_round_trip():
+    packet = bytes(SENSOR_V1.encode((56, "OK", 22.47)))
+    assert packet == struct.pack("<BBBh", 1, 56, 0, 2247)
+    assert len(packet) == SENSOR_V1.size == 5
+    codec = SensorCodec(SENSOR_V1, SUMMARY_V2)
+    assert codec.decode(packet) == (1, {"humidity": 56, "status": "OK", "temperature": 22.47})
+    assert not codec.is_batch(packet)
+
+
+def test_encode_dict_matches_encode():
+    reading = {"temperature": -3.5, "status": "Error", "humidity": 57}
+    assert bytes(SENSOR_V1.encode_dict(reading)) == bytes(SENSOR_V1.encode((57, "Error", -3.5)))
+
+
+def test_encode_rejects_bad_values():
+    assert raises_value_error(SENSOR_V1.encode, (56, "Unknown", 22.47))
+    assert raises_value_error(SENSOR_V1.encode, (256, "OK", 22.47))
+    # 400.00 * 100 does not fit the int16 temperature
+    assert raises_value_error(SENSOR_V1.encode, (56, "OK", 400.0))
+
+
+def test_unnamed_enum_code_decodes_as_int():
+    packet = struct.pack("<BBBh", 1, 56, 7, 0)
+    assert SensorCodec(SENSOR_V1).decode(packet)[1]["status"] == 7
+
+
+def test_batch_header():
+    packet = bytes(SENSOR_V1.encode_batch(0x1_0000_0005, 1000, SAMPLES))
+    version, count, seq, period_ms = struct.unpack_from("<BBII", packet)
+    assert version == 1 | BATCH_FLAG
+    assert count == len(SAMPLES)
+    # seq wraps at 32 bits
+    assert seq == 5
+    assert period_ms == 1000
+    # Samples follow the 10 byte header without their version byte
+    assert len(packet) == 10 + len(SAMPLES) * (SENSOR_V1.size - 1)
+    assert packet[10:14] == bytes(SENSOR_V1.encode(SAMPLES[0]))[1:]
+
+
+def test_batch_round_trip():
+    codec = SensorCodec(SENSOR_V1)
+    packet = bytes(SENSOR_V1.encode_batch(42, 500, SAMPLES))
+    assert codec.is_batch(packet)
+    version, seq, period_ms, readings = codec.decode_batch(packet)
+    assert (version, seq, period_ms) == (1, 42, 500)
+    assert [tuple(r.values()) for r in readings] == SAMPLES
+
+
+def test_empty_and_full_batches():
+    assert SENSOR_V1.decode_batch(bytes(SENSOR_V1.encode_batch(1, 10, []))) == (1, 10, [])
+    full = [SAMPLES[0]] * 255
+    assert len(SENSOR_V1.decode_batch(bytes(SENSOR_V1.encode_batch(1, 10, full)))[2]) == 255
+    assert raises_value_error(SENSOR_V1.encode_batch, 1, 10, full + [SAMPLES[0]])
+
+
+def test_truncated_packets():
+    codec = SensorCodec(SENSOR_V1)
+    single = bytes(SENSOR_V1.encode(SAMPLES[0]))
+    batch = bytes(SENSOR_V1.encode_batch(1, 10, SAMPLES))
+    assert raises_value_error(codec.decode, b"")
+    assert raises_value_error(codec.decode_batch, b"")
+    for n in range(1, len(single)):
+        assert raises_value_error(codec.decode, single[:n])
+        assert raises_value_error(SENSOR_V1.decode, single[:n])
+    # Cut inside the header as well as inside the samples
+    for n in range(1, len(batch)):
+        assert raises_value_error(codec.decode_batch, batch[:n])
+
+
+def test_wrong_kind_or_version():
+    codec = SensorCodec(SENSOR_V1)
+    batch = bytes(SENSOR_V1.encode_batch(1, 10, SAMPLES))
+    assert raises_value_error(codec.decode, batch)
+    assert raises_value_error(SENSOR_V1.decode_batch, bytes(SENSOR_V1.encode(SAMPLES[0])))
+    other = SensorSchema(3, (("x", "B"),))
+    assert raises_value_error(codec.decode, bytes(other.encode((1,))))
+    assert raises_value_error(SENSOR_V1.decode, bytes(other.encode((1,))))
+
+
+###########################
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(name, "ok")
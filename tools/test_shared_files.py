@@ -0,0 +1,48 @@
+"""
+Checks that the files shared between session directories are identical.
+
+Every session directory (P1-P4) is flashed to its board on its own, so a
+module used by two sessions exists once in each. They must not drift
+apart: a fix made in one copy goes into the other one too.
+
+Run with pytest, or directly:
+    python3 tools/test_shared_files.py
+"""
+
+############### Imports ###############
+import os
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, "..")
+
+#######################################
+
+######## Shared files ########
+SHARED = {
+    "httpserver.py": ("P1", "P4"),
+    "sx127x.py": ("P2", "P4"),
+    "umqttsimple.py": ("P3", "P4"),
+    "sensorcodec.py": ("P2", "P3"),
+    "ticks.py": ("P1", "P2", "P3", "P4"),
+}
+
+##############################
+
+
+########## Tests ##########
+def test_shared_files_identical():
+    for name, dirs in SHARED.items():
+        copies = []
+        for d in dirs:
+            with open(os.path.join(ROOT, d, name), "rb") as f:
+                copies.append(f.read())
+        for d, data in zip(dirs[1:], copies[1:]):
+            assert data == copies[0], "%s/%s differs from %s/%s" % (d, name, dirs[0], name)
+
+
+###########################
+
+
+if __name__ == "__main__":
+    test_shared_files_identical()
+    print("test_shared_files_identical ok")
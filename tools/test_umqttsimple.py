@@ -0,0 +1,217 @@
+"""
+Behaviour tests for umqttsimple.MQTTClient (CPython).
+
+The client runs against mqttbroker.py, started as a subprocess, or
+against a bare socket where the broker has to misbehave in a way the
+stand-in cannot. TopicRouter is tested on its own.
+
+Run with pytest, or directly:
+    python3 tools/test_umqttsimple.py
+"""
+
+############### Imports ###############
+import os
+import ssl
+import socket
+import sys
+import threading
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "P4"))
+
+from umqttsimple import MQTTClient, MQTTException, TopicRouter  # noqa: E402
+
+from bench_mqtt import start_broker  # noqa: E402
+
+#######################################
+
+######## Test configuration ########
+SOCKET_TIMEOUT_S = 0.3
+
+####################################
+
+
+########## Harness ##########
+def hang_up_server():
+    """
+    Listens on a free loopback port and closes every connection once
+    the client has sent its CONNECT, as some 3.1.1 brokers do with an
+    MQTT 5 one. Returns (listening socket, port).
+    """
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(4)
+
+    def serve():
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                return
+            # Read the whole CONNECT first: closing with unread data
+            # would send a reset instead of EOF
+            conn.settimeout(0.1)
+            try:
+                while conn.recv(1024):
+                    pass
+            except OSError:
+                pass
+            conn.close()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return listener, listener.getsockname()[1]
+
+
+def routed(filters, topic):
+    """
+    Registers one recording handler per filter and dispatches topic.
+    Returns the filters whose handler ran, and dispatch()'s count.
+    """
+    router = TopicRouter()
+    hits = []
+    for topic_filter in filters:
+        router.add(topic_filter, lambda t, m, f=topic_filter: hits.append(f))
+    n = router.dispatch(topic, b"payload")
+    return sorted(hits), n
+
+
+#############################
+
+
+########## Tests ##########
+def test_router_exact_and_plus():
+    filters = [b"a/b/c", b"a/+/c", b"+/+/+", b"a/+", b"a/b/c/d"]
+    assert routed(filters, b"a/b/c") == ([b"+/+/+", b"a/+/c", b"a/b/c"], 3)
+    assert routed(filters, b"a/x/c") == ([b"+/+/+", b"a/+/c"], 2)
+    assert routed(filters, b"a/b") == ([b"a/+"], 1)
+    # "+" matches exactly one level, an empty one included
+    assert routed([b"a/+/c"], b"a//c") == ([b"a/+/c"], 1)
+    assert routed([b"a/+"], b"a/b/c") == ([], 0)
+
+
+def test_router_hash():
+    filters = [b"#", b"a/#", b"a/b/#", b"a/+/#"]
+    assert routed(filters, b"a/b/c") == (sorted(filters), 4)
+    # "#" also matches the parent level itself
+    assert routed(filters, b"a/b") == ([b"#", b"a/#", b"a/+/#", b"a/b/#"], 4)
+    assert routed(filters, b"a") == ([b"#", b"a/#"], 2)
+    assert routed(filters, b"x") == ([b"#"], 1)
+
+
+def test_router_dollar_topics():
+    # Wildcards never match "$" topics at the first level
+    filters = [b"#", b"+/x", b"$SYS/#", b"$SYS/+"]
+    assert routed(filters, b"$SYS/x") == ([b"$SYS/#", b"$SYS/+"], 2)
+    assert routed([b"a/+"], b"a/$x") == ([b"a/+"], 1)
+
+
+def test_router_several_handlers_per_filter():
+    router = TopicRouter()
+    calls = []
+    router.add(b"a/+", lambda t, m: calls.append(1))
+    router.add(b"a/+", lambda t, m: calls.append(2))
+    assert router.count == 2
+    assert router.dispatch(b"a/b", b"") == 2
+    assert calls == [1, 2]
+
+
+def test_client_dispatches_to_handlers_before_callback():
+    proc, port = start_broker(0)
+    try:
+        client = MQTTClient(b"router", "127.0.0.1", port,
+                            socket_timeout=SOCKET_TIMEOUT_S)
+        handled = []
+        unmatched = []
+        client.set_callback(lambda t, m: unmatched.append(bytes(t)))
+        client.connect()
+        client.subscribe(b"sensors/+/temp", 0, lambda t, m: handled.append(bytes(t)))
+        client.subscribe(b"other/#")
+        client.publish(b"sensors/a/temp", b"21")
+        client.publish(b"other/x", b"1")
+        client.wait_msg()
+        client.wait_msg()
+        client.disconnect()
+        assert handled == [b"sensors/a/temp"]
+        assert unmatched == [b"other/x"]
+    finally:
+        proc.kill()
+        proc.wait()
+
+
+def test_router_rejects_bad_filters():
+    for topic_filter in (b"a/#/b", b"a#", b"a/b+", b"+a/b"):
+        try:
+            TopicRouter().add(topic_filter, print)
+        except AssertionError:
+            continue
+        raise AssertionError("filter accepted: %r" % topic_filter)
+
+
+def test_v5_falls_back_on_return_code_1():
+    proc, port = start_broker(0)
+    try:
+        client = MQTTClient(b"v5-refused", "127.0.0.1", port, version=5,
+                            socket_timeout=SOCKET_TIMEOUT_S)
+        client.connect()
+        assert client.version == 4
+        client.disconnect()
+    finally:
+        proc.kill()
+        proc.wait()
+
+
+def test_v5_falls_back_on_immediate_eof():
+    listener, port = hang_up_server()
+    try:
+        client = MQTTClient(b"v5-eof", "127.0.0.1", port, version=5,
+                            socket_timeout=SOCKET_TIMEOUT_S)
+        # The 3.1.1 retry is hung up on as well
+        try:
+            client.connect()
+        except OSError:
+            pass
+        assert client.version == 4
+    finally:
+        listener.close()
+
+
+def test_v5_kept_after_connack_timeout():
+    proc, port = start_broker(0, "connack")
+    try:
+        client = MQTTClient(b"v5-stalled", "127.0.0.1", port, version=5,
+                            socket_timeout=SOCKET_TIMEOUT_S)
+        for _ in range(2):
+            try:
+                client.connect()
+            except MQTTException as e:
+                raise AssertionError("timeout taken for a refusal: %r" % e)
+            except OSError:
+                pass
+            else:
+                raise AssertionError("connected to a stalled broker")
+            client.sock.close()
+            assert client.version == 5
+    finally:
+        proc.kill()
+        proc.wait()
+
+
+def test_ssl_params_checked_at_construction():
+    for params in ({"ciphers": "HIGH"}, {"cert": "c.pem"}, {"key": "k.pem"}):
+        try:
+            MQTTClient(b"tls", "127.0.0.1", ssl=True, ssl_params=params)
+        except ValueError:
+            continue
+        raise AssertionError("ssl_params accepted: %r" % params)
+    MQTTClient(b"tls", "127.0.0.1", ssl=True,
+               ssl_params={"cert_reqs": ssl.CERT_NONE, "server_hostname": "broker"})
+
+
+###########################
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(name, "ok")